@@ -0,0 +1,494 @@
+# -*- test-case-name: admin.test.test_benchmark -*-
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+"""
+Micro-benchmarks for performance sensitive parts of the control service
+and convergence agents.
+"""
+
+import sys
+from json import JSONEncoder, dumps, loads
+from timeit import repeat
+from uuid import UUID
+
+from eliot import addDestination, removeDestination
+
+from pyrsistent import PMap, PRecord, PSet, PVector, pmap
+
+from jsonschema import draft4_format_checker
+from jsonschema.validators import validator_for
+
+from twisted.internet.defer import succeed
+from twisted.internet.task import Clock
+from twisted.python.filepath import FilePath
+from twisted.python.usage import Options, UsageError
+
+from flocker.control import (
+    Application, AttachedVolume, Dataset, Deployment, DeploymentState,
+    DockerImage, Manifestation, Node, NodeState, Port,
+)
+from flocker.control._clusterstate import ClusterStateService
+from flocker.control._logging import (
+    full_state_logging, set_full_state_logging,
+)
+from flocker.control._model import SERIALIZABLE_CLASSES
+from flocker.control._persistence import (
+    _CLASS_MARKER, wire_decode, wire_encode,
+)
+from flocker.control._protocol import ControlAMPService
+from flocker.control.httpapi import ConfigurationAPIUserV1, SCHEMAS
+from flocker.node import in_parallel
+from flocker.node._loop import build_convergence_loop_fsm, _ClientStatusUpdate
+from flocker.restapi import _schema
+from flocker.restapi._schema import LocalRefResolver, getValidator
+
+
+# Mapping from benchmark names to functions taking the parsed
+# ``BenchmarkOptions`` and a function which writes a line of output:
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    """
+    Register a benchmark under the given name.
+
+    :param str name: The name used to select the benchmark on the command
+        line.
+
+    :return: A decorator which registers the decorated function.
+    """
+    def register(function):
+        BENCHMARKS[name] = function
+        return function
+    return register
+
+
+def best_time(function, repetitions):
+    """
+    Time a function.
+
+    :param function: A callable taking no arguments.
+    :param int repetitions: The number of times to call it.
+
+    :return float: The fastest of the calls, in seconds.
+    """
+    return min(repeat(function, number=1, repeat=repetitions))
+
+
+def build_cluster(node_count, applications_per_node=5):
+    """
+    Generate desired configuration and matching cluster state.
+
+    Every node runs ``applications_per_node`` applications, each with its
+    own dataset.
+
+    :param int node_count: The number of nodes in the cluster.
+    :param int applications_per_node: The number of applications on each
+        node.
+
+    :return: A tuple of a ``Deployment`` and a ``DeploymentState``.
+    """
+    nodes = []
+    node_states = []
+    for i in range(node_count):
+        uuid = UUID(int=i + 1)
+        hostname = u"10.%d.%d.%d" % (i >> 16, (i >> 8) & 0xff, i & 0xff)
+        applications = []
+        manifestations = {}
+        paths = {}
+        for j in range(applications_per_node):
+            dataset_id = unicode(UUID(int=(i << 32) + j + 1))
+            manifestation = Manifestation(
+                dataset=Dataset(dataset_id=dataset_id,
+                                metadata={u"name": u"data-%d-%d" % (i, j)}),
+                primary=True)
+            manifestations[dataset_id] = manifestation
+            paths[dataset_id] = FilePath(b"/flocker").child(
+                dataset_id.encode("ascii"))
+            applications.append(Application(
+                name=u"app-%d-%d" % (i, j),
+                image=DockerImage.from_string(u"clusterhq/app:%d" % (j,)),
+                ports=[Port(internal_port=80, external_port=10000 + j)],
+                volume=AttachedVolume(manifestation=manifestation,
+                                      mountpoint=FilePath(b"/data")),
+                environment={u"NODE": hostname},
+            ))
+        nodes.append(Node(uuid=uuid, hostname=hostname,
+                          applications=applications,
+                          manifestations=manifestations))
+        node_states.append(NodeState(
+            uuid=uuid, hostname=hostname, applications=applications,
+            used_ports=[port.external_port
+                        for application in applications
+                        for port in application.ports],
+            manifestations=manifestations, paths=paths))
+    return Deployment(nodes=nodes), DeploymentState(nodes=node_states)
+
+
+class _FakeConfigurationService(object):
+    """
+    A configuration service which always has the same configuration.
+    """
+    def __init__(self, configuration):
+        self._configuration = configuration
+
+    def get(self):
+        return self._configuration
+
+    def register(self, change_callback):
+        pass
+
+
+class _FakeAgentConnection(object):
+    """
+    A connection to an agent which serializes commands but discards them
+    rather than sending them anywhere.
+    """
+    def callRemote(self, command, **kwargs):
+        command.makeArguments(kwargs, self)
+        return succeed({})
+
+
+@benchmark("broadcast")
+def broadcast_benchmark(options, write):
+    """
+    Measure how long the control service takes to send the cluster status
+    to a varying number of agents.
+    """
+    configuration, state = build_cluster(options["nodes"])
+    cluster_state = ClusterStateService()
+    cluster_state.apply_changes(state.nodes)
+    service = ControlAMPService(
+        Clock(), cluster_state, _FakeConfigurationService(configuration),
+        None)
+
+    encode_time = best_time(
+        lambda: (wire_encode(configuration), wire_encode(state)),
+        options["repeat"])
+    write(b"broadcast: %d nodes, encoding once takes %.2f ms" % (
+        options["nodes"], encode_time * 1000))
+    write(b"%8s %12s %14s" % (b"agents", b"total ms", b"per agent ms"))
+    for agent_count in options["agents"]:
+        connections = [_FakeAgentConnection() for i in range(agent_count)]
+        elapsed = best_time(
+            lambda: service._send_state_to_connections(connections),
+            options["repeat"])
+        write(b"%8d %12.2f %14.3f" % (
+            agent_count, elapsed * 1000, elapsed * 1000 / agent_count))
+
+
+@benchmark("nodes")
+def nodes_benchmark(options, write):
+    """
+    Measure looking up and updating nodes by UUID in ``Deployment`` and
+    ``DeploymentState``.
+    """
+    configuration, state = build_cluster(options["model-nodes"])
+    uuids = [node.uuid for node in configuration.nodes]
+    updated_nodes = [node.set(applications=list(node.applications)[1:])
+                     for node in configuration.nodes]
+    updated_node_states = [node.set(used_ports=[1])
+                           for node in state.nodes]
+
+    def lookup(deployment):
+        for uuid in uuids:
+            deployment.get_node(uuid)
+
+    def update(deployment, nodes):
+        for node in nodes:
+            deployment.update_node(node)
+
+    write(b"nodes: %d nodes" % (options["model-nodes"],))
+    write(b"%-32s %12s" % (b"operation", b"us per node"))
+    for name, function in [
+            (b"Deployment.get_node", lambda: lookup(configuration)),
+            (b"DeploymentState.get_node", lambda: lookup(state)),
+            (b"Deployment.update_node",
+             lambda: update(configuration, updated_nodes)),
+            (b"DeploymentState.update_node",
+             lambda: update(state, updated_node_states)),
+    ]:
+        elapsed = best_time(function, options["repeat"])
+        write(b"%-32s %12.2f" % (name, elapsed * 1000000 / len(uuids)))
+
+
+class _GenericConfigurationEncoder(JSONEncoder):
+    """
+    The original generic JSON encoder for the configuration model, kept as a
+    baseline for the codec benchmark.
+    """
+    def default(self, obj):
+        if isinstance(obj, PRecord):
+            result = dict(obj)
+            result[_CLASS_MARKER] = obj.__class__.__name__
+            return result
+        elif isinstance(obj, PMap):
+            return {_CLASS_MARKER: u"PMap", u"values": dict(obj).items()}
+        elif isinstance(obj, (PSet, PVector, set)):
+            return list(obj)
+        elif isinstance(obj, FilePath):
+            return {_CLASS_MARKER: u"FilePath",
+                    u"path": obj.path.decode("utf-8")}
+        elif isinstance(obj, UUID):
+            return {_CLASS_MARKER: u"UUID",
+                    "hex": unicode(obj)}
+        return JSONEncoder.default(self, obj)
+
+
+def _generic_wire_encode(obj):
+    """
+    The original implementation of ``wire_encode``.
+    """
+    return dumps(obj, cls=_GenericConfigurationEncoder)
+
+
+def _generic_wire_decode(data):
+    """
+    The original implementation of ``wire_decode``.
+    """
+    classes = {cls.__name__: cls for cls in SERIALIZABLE_CLASSES}
+
+    def decode_object(dictionary):
+        class_name = dictionary.get(_CLASS_MARKER, None)
+        if class_name == u"FilePath":
+            return FilePath(dictionary.get(u"path").encode("utf-8"))
+        elif class_name == u"PMap":
+            return pmap(dictionary[u"values"])
+        elif class_name == u"UUID":
+            return UUID(dictionary[u"hex"])
+        elif class_name in classes:
+            dictionary = dictionary.copy()
+            dictionary.pop(_CLASS_MARKER)
+            return classes[class_name].create(dictionary)
+        else:
+            return dictionary
+    return loads(data, object_hook=decode_object)
+
+
+@benchmark("codec")
+def codec_benchmark(options, write):
+    """
+    Measure encoding and decoding cluster state, comparing ``wire_encode``
+    and ``wire_decode`` with the original generic implementation.
+    """
+    configuration, state = build_cluster(options["nodes"])
+    data = wire_encode(state)
+
+    write(b"codec: %d nodes, %d bytes" % (options["nodes"], len(data)))
+    write(b"%-24s %12s" % (b"operation", b"ms"))
+    for name, function in [
+            (b"generic encode", lambda: _generic_wire_encode(state)),
+            (b"wire_encode", lambda: wire_encode(state)),
+            (b"generic decode", lambda: _generic_wire_decode(data)),
+            (b"wire_decode", lambda: wire_decode(data)),
+            (b"wire_decode trusted",
+             lambda: wire_decode(data, trusted=True)),
+    ]:
+        elapsed = best_time(function, options["repeat"])
+        write(b"%-24s %12.2f" % (name, elapsed * 1000))
+
+
+def _referencing_validator(schema, schema_store):
+    """
+    The original implementation of ``getValidator``, which resolves
+    references every time something is validated.
+    """
+    resolver = LocalRefResolver(
+        base_uri=b'', referrer=schema, store=schema_store)
+    resolver.resolution_scope = b''
+    return validator_for(schema)(
+        schema, resolver=resolver, format_checker=draft4_format_checker)
+
+
+def _endpoint_schemas():
+    """
+    Find the input and output schemas of the control service API.
+
+    :return: ``list`` of JSON Schemas.
+    """
+    schemas = []
+    for endpoint in ConfigurationAPIUserV1.app._endpoints.values():
+        attributes = vars(endpoint)
+        for name in ["inputSchema", "outputSchema"]:
+            if name in attributes:
+                schemas.append(attributes[name])
+    return schemas
+
+
+def _compiled_validators(schemas):
+    """
+    Create validators for schemas with ``getValidator``, as if for the
+    first time.
+    """
+    _schema._validators.clear()
+    _schema._store_digests.clear()
+    return [getValidator(schema, SCHEMAS) for schema in schemas]
+
+
+@benchmark("validation")
+def validation_benchmark(options, write):
+    """
+    Measure creating validators for the control service API at startup, and
+    validating a large request body, comparing ``getValidator`` with the
+    original implementation.
+    """
+    schemas = _endpoint_schemas()
+    batch_schema = {
+        '$ref': '/v1/endpoints.json#/definitions/configuration_datasets_batch'}
+    configuration, state = build_cluster(options["nodes"])
+    operations = [
+        {u"action": u"create", u"primary": unicode(node.uuid),
+         u"dataset_id": dataset_id, u"maximum_size": 1024 * 1024 * 1024,
+         u"metadata": {u"name": manifestation.dataset.metadata[u"name"]}}
+        for node in configuration.nodes
+        for dataset_id, manifestation in node.manifestations.items()
+    ][:1000]
+    body = {u"operations": operations}
+
+    def validate(validator):
+        return list(validator.iter_errors(body))
+
+    original = _referencing_validator(batch_schema, SCHEMAS)
+    compiled = getValidator(batch_schema, SCHEMAS)
+    write(b"validation: %d endpoint schemas, %d batch operations" % (
+        len(schemas), len(operations)))
+    write(b"%-32s %12s" % (b"operation", b"ms"))
+    for name, function in [
+            (b"original create validators",
+             lambda: [_referencing_validator(schema, SCHEMAS)
+                      for schema in schemas]),
+            (b"getValidator first time",
+             lambda: _compiled_validators(schemas)),
+            (b"getValidator shared",
+             lambda: [getValidator(schema, SCHEMAS) for schema in schemas]),
+            (b"original validate batch", lambda: validate(original)),
+            (b"getValidator validate batch", lambda: validate(compiled)),
+    ]:
+        elapsed = best_time(function, options["repeat"])
+        write(b"%-32s %12.2f" % (name, elapsed * 1000))
+
+
+class _ConvergedDeployer(object):
+    """
+    A deployer whose node already matches the configuration.
+    """
+    def __init__(self, node_state):
+        self._node_state = node_state
+        self.node_uuid = node_state.uuid
+        self.hostname = node_state.hostname
+
+    def discover_state(self, node_state):
+        return succeed((self._node_state,))
+
+    def calculate_changes(self, configuration, cluster_state):
+        return in_parallel(changes=[])
+
+
+class _DiscardingClient(object):
+    """
+    A connection to the control service which discards commands.
+    """
+    def callRemote(self, command, **kwargs):
+        return succeed({})
+
+
+@benchmark("logging")
+def logging_benchmark(options, write):
+    """
+    Measure the cost of logging cluster configuration and state in a
+    convergence agent iteration and a control service broadcast, with
+    summaries and with full state logging.
+    """
+    configuration, state = build_cluster(options["nodes"])
+    deployer = _ConvergedDeployer(next(iter(state.nodes)))
+    cluster_state = ClusterStateService()
+    cluster_state.apply_changes(state.nodes)
+    service = ControlAMPService(
+        Clock(), cluster_state, _FakeConfigurationService(configuration),
+        None)
+
+    def iteration():
+        loop = build_convergence_loop_fsm(Clock(), deployer)
+        loop.receive(_ClientStatusUpdate(
+            client=_DiscardingClient(), configuration=configuration,
+            state=state))
+
+    def broadcast():
+        # With no connections only the logging and generation bookkeeping
+        # are measured:
+        service._send_state_to_connections([])
+
+    # Messages are only serialized if there is somewhere to send them:
+    def discard(message):
+        pass
+    addDestination(discard)
+    previous = full_state_logging()
+    write(b"logging: %d nodes" % (options["nodes"],))
+    write(b"%-24s %12s %12s" % (b"operation", b"summary ms", b"full ms"))
+    try:
+        for name, function in [(b"agent iteration", iteration),
+                               (b"broadcast", broadcast)]:
+            elapsed = []
+            for full in (False, True):
+                set_full_state_logging(full)
+                elapsed.append(best_time(function, options["repeat"]))
+            write(b"%-24s %12.2f %12.2f" % (
+                name, elapsed[0] * 1000, elapsed[1] * 1000))
+    finally:
+        set_full_state_logging(previous)
+        removeDestination(discard)
+
+
+class BenchmarkOptions(Options):
+    """
+    Command line options for ``run-benchmark``.
+    """
+    synopsis = "Usage: run-benchmark [options] [benchmark...]"
+
+    optParameters = [
+        ["repeat", None, 3,
+         "The number of times to run each measurement.", int],
+        ["nodes", None, 100,
+         "The number of nodes in the generated cluster.", int],
+        ["agents", None, "1,10,100,500",
+         "Comma separated numbers of connected agents."],
+        ["model-nodes", None, 1000,
+         "The number of nodes in the cluster used by the nodes benchmark.",
+         int],
+    ]
+
+    def parseArgs(self, *benchmarks):
+        unknown = set(benchmarks) - set(BENCHMARKS)
+        if unknown:
+            raise UsageError(
+                "Unknown benchmarks: %s" % (", ".join(sorted(unknown)),))
+        self["benchmarks"] = list(benchmarks) or sorted(BENCHMARKS)
+
+    def postOptions(self):
+        try:
+            self["agents"] = [int(count) for count in
+                              self["agents"].split(",")]
+        except ValueError:
+            raise UsageError("--agents must be a list of integers.")
+
+
+def main(args, base_path, stdout=sys.stdout):
+    """
+    Run the selected benchmarks, writing the results to ``stdout``.
+
+    :param list args: The arguments passed to the script.
+    :param FilePath base_path: The executable being run.
+    :param stdout: A file to write the results to.
+    """
+    options = BenchmarkOptions()
+    try:
+        options.parseOptions(args)
+    except UsageError as e:
+        sys.stderr.write("%s: %s\n" % (base_path.basename(), e))
+        raise SystemExit(1)
+
+    def write(line):
+        stdout.write(line + b"\n")
+        stdout.flush()
+
+    for name in options["benchmarks"]:
+        BENCHMARKS[name](options, write)
@@ -0,0 +1,139 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+"""
+Tests for ``admin.benchmark``.
+"""
+
+from StringIO import StringIO
+
+from twisted.python.filepath import FilePath
+from twisted.python.usage import UsageError
+from twisted.trial.unittest import SynchronousTestCase
+
+from flocker.control._logging import full_state_logging
+
+from ..benchmark import BENCHMARKS, BenchmarkOptions, build_cluster, main
+
+
+class BuildClusterTests(SynchronousTestCase):
+    """
+    Tests for ``build_cluster``.
+    """
+    def test_sizes(self):
+        """
+        ``build_cluster`` returns configuration and state with the requested
+        number of nodes, each with the requested number of applications.
+        """
+        configuration, state = build_cluster(3, applications_per_node=2)
+        self.assertEqual(
+            ([len(node.applications) for node in configuration.nodes],
+             [len(node.applications) for node in state.nodes]),
+            ([2] * 3, [2] * 3))
+
+    def test_matching_state(self):
+        """
+        The generated state has the same nodes as the configuration.
+        """
+        configuration, state = build_cluster(3)
+        self.assertEqual(
+            set(node.uuid for node in configuration.nodes),
+            set(node.uuid for node in state.nodes))
+
+
+class BenchmarkOptionsTests(SynchronousTestCase):
+    """
+    Tests for ``BenchmarkOptions``.
+    """
+    def test_default_benchmarks(self):
+        """
+        All benchmarks are run if none are given.
+        """
+        options = BenchmarkOptions()
+        options.parseOptions([])
+        self.assertEqual(options["benchmarks"], sorted(BENCHMARKS))
+
+    def test_unknown_benchmark(self):
+        """
+        An unknown benchmark name is rejected.
+        """
+        options = BenchmarkOptions()
+        self.assertRaises(UsageError, options.parseOptions, ["unknown"])
+
+    def test_agents(self):
+        """
+        ``--agents`` is parsed into a list of integers.
+        """
+        options = BenchmarkOptions()
+        options.parseOptions(["--agents", "1,5"])
+        self.assertEqual(options["agents"], [1, 5])
+
+    def test_invalid_agents(self):
+        """
+        ``--agents`` must only contain integers.
+        """
+        options = BenchmarkOptions()
+        self.assertRaises(UsageError, options.parseOptions,
+                          ["--agents", "1,x"])
+
+
+class MainTests(SynchronousTestCase):
+    """
+    Tests for ``main``.
+    """
+    def test_broadcast(self):
+        """
+        The broadcast benchmark writes a line for each number of agents.
+        """
+        stdout = StringIO()
+        main(["--repeat", "1", "--nodes", "2", "--agents", "1,3",
+              "broadcast"], FilePath(b"run-benchmark"), stdout)
+        lines = stdout.getvalue().splitlines()
+        self.assertEqual([line.split()[0] for line in lines[2:]],
+                         ["1", "3"])
+
+    def test_nodes(self):
+        """
+        The nodes benchmark writes a line for each operation it measures.
+        """
+        stdout = StringIO()
+        main(["--repeat", "1", "--model-nodes", "3", "nodes"],
+             FilePath(b"run-benchmark"), stdout)
+        lines = stdout.getvalue().splitlines()
+        self.assertEqual(
+            [line.split()[0] for line in lines[2:]],
+            ["Deployment.get_node", "DeploymentState.get_node",
+             "Deployment.update_node", "DeploymentState.update_node"])
+
+    def test_codec(self):
+        """
+        The codec benchmark writes a line for each operation it measures.
+        """
+        stdout = StringIO()
+        main(["--repeat", "1", "--nodes", "2", "codec"],
+             FilePath(b"run-benchmark"), stdout)
+        lines = stdout.getvalue().splitlines()
+        self.assertEqual(len(lines[2:]), 5)
+
+    def test_logging(self):
+        """
+        The logging benchmark writes a line for each operation it measures,
+        and leaves full state logging as it was.
+        """
+        stdout = StringIO()
+        before = full_state_logging()
+        main(["--repeat", "1", "--nodes", "2", "logging"],
+             FilePath(b"run-benchmark"), stdout)
+        lines = stdout.getvalue().splitlines()
+        self.assertEqual(
+            ([line.split()[0] for line in lines[2:]], full_state_logging()),
+            (["agent", "broadcast"], before))
+
+    def test_validation(self):
+        """
+        The validation benchmark writes a line for each operation it
+        measures.
+        """
+        stdout = StringIO()
+        main(["--repeat", "1", "--nodes", "2", "validation"],
+             FilePath(b"run-benchmark"), stdout)
+        lines = stdout.getvalue().splitlines()
+        self.assertEqual(len(lines[2:]), 5)
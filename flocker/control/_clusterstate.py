@@ -4,6 +4,10 @@
 Combine and retrieve current cluster state.
 """
 
+from uuid import uuid4
+
+from eliot import Logger, write_traceback
+
 from twisted.application.service import Service
 
 from ._model import DeploymentState
@@ -20,9 +24,40 @@ class ClusterStateService(Service):
 
     :ivar DeploymentState _deployment_state: The current known cluster
         state.
+    :ivar unicode _epoch: Identifies this run of the service, so versions
+        are never reused across restarts.
+    :ivar int _generation: The number of changes to the cluster state since
+        the service started.
     """
+    logger = Logger()
+
     def __init__(self):
         self._deployment_state = DeploymentState()
+        self._change_callbacks = []
+        self._epoch = uuid4().hex.decode("ascii")
+        self._generation = 0
+
+    def register(self, change_callback):
+        """
+        Register a function to be called whenever the cluster state changes.
+
+        :param change_callback: Callable that takes no arguments, will be
+            called when cluster state changes.
+        """
+        self._change_callbacks.append(change_callback)
+
+    def get_version(self):
+        """
+        Retrieve an identifier for the current cluster state.
+
+        Every change to the cluster state changes the version, and versions
+        are never reused, so clients can use them to find out whether the
+        cluster state changed.
+
+        :return unicode: The version of the cluster state returned by
+            ``as_deployment``.
+        """
+        return u"{}-{}".format(self._epoch, self._generation)
 
     def manifestation_path(self, node_uuid, dataset_id):
         """
@@ -50,11 +85,27 @@ class ClusterStateService(Service):
 
         :param list changes: Some ``IClusterStateChange`` providers to use to
             update the internal cluster state.
+
+        :return bool: Whether the changes resulted in different cluster
+            state.
         """
         # XXX: Multiple nodes may report being primary for a dataset. Enforce
         # consistency here. See
         # https://clusterhq.atlassian.net/browse/FLOC-1303
+        original = self._deployment_state
         for change in changes:
             self._deployment_state = change.update_cluster_state(
                 self._deployment_state
             )
+        # Changes which don't alter anything return the existing state, so
+        # comparing identity is sufficient unless changes cancelled out:
+        changed = (self._deployment_state is not original and
+                   self._deployment_state != original)
+        if changed:
+            self._generation += 1
+            for callback in self._change_callbacks:
+                try:
+                    callback()
+                except:
+                    write_traceback(self.logger, u"")
+        return changed
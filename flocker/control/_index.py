@@ -0,0 +1,180 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+# -*- test-case-name: flocker.control.test.test_index -*-
+
+"""
+Indexes of the datasets and containers in a ``Deployment``, allowing
+filtered and paged listings without scanning every node.
+"""
+
+from bisect import bisect_left
+from collections import defaultdict
+
+
+class _Index(object):
+    """
+    Some datasets or containers, sorted by name.
+
+    :ivar list entries: ``(name, node_uuid, item, node)`` tuples sorted by
+        name and then by node UUID (as ``unicode``).
+    :ivar set keys: The ``(name, node_uuid)`` of each of the entries.
+    """
+    def __init__(self):
+        self.entries = []
+        self.keys = set()
+
+    def add(self, entry):
+        """
+        Add an entry.  ``sort`` must be called once all are added.
+
+        :param tuple entry: An entry as described by ``entries``.
+        """
+        self.entries.append(entry)
+        self.keys.add(entry[:2])
+
+    def sort(self):
+        """
+        Sort the entries.
+        """
+        self.entries.sort()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+_EMPTY = _Index()
+
+
+def _query(indexes, prefix=u"", after=None, limit=None):
+    """
+    Find the items which are in all of the given indexes.
+
+    Only the smallest index is traversed, and only from the first item which
+    may be wanted.
+
+    :param list indexes: ``_Index`` instances.
+    :param unicode prefix: Only find items whose names start with this.
+    :param unicode after: If not ``None``, only find items whose names sort
+        after this one.
+    :param limit: If not ``None``, the number of items to stop after.  Items
+        with the same name are never split between pages, so a few more
+        items may be found.
+
+    :return: ``list`` of ``(item, node)`` tuples, sorted by name.
+    """
+    smallest = min(indexes, key=len)
+    others = [index.keys for index in indexes if index is not smallest]
+    start = (prefix,)
+    if after is not None:
+        # No string sorts between ``after`` and this one:
+        start = max(start, (after + u"\0",))
+    entries = smallest.entries
+    result = []
+    for position in xrange(bisect_left(entries, start), len(entries)):
+        entry = entries[position]
+        name = entry[0]
+        if not name.startswith(prefix):
+            break
+        if (limit is not None and len(result) >= limit and
+                name != result[-1][0]):
+            break
+        if all(entry[:2] in keys for keys in others):
+            result.append(entry)
+    return [found[2:] for found in result]
+
+
+class DeploymentIndex(object):
+    """
+    Indexes of the primary datasets and the containers of a ``Deployment``
+    or ``DeploymentState``.
+
+    :ivar deployment: The indexed deployment.
+    """
+    def __init__(self, deployment):
+        self.deployment = deployment
+        self._datasets = _Index()
+        self._datasets_by_primary = defaultdict(_Index)
+        self._datasets_by_metadata_key = defaultdict(_Index)
+        self._datasets_by_metadata = defaultdict(_Index)
+        self._datasets_by_deleted = defaultdict(_Index)
+        self._containers = _Index()
+        self._containers_by_node = defaultdict(_Index)
+
+        for node in deployment.nodes:
+            node_key = unicode(node.uuid)
+            for manifestation in (node.manifestations or {}).values():
+                if not manifestation.primary:
+                    continue
+                dataset = manifestation.dataset
+                entry = (dataset.dataset_id, node_key, dataset, node)
+                self._datasets.add(entry)
+                self._datasets_by_primary[node.uuid].add(entry)
+                self._datasets_by_deleted[dataset.deleted].add(entry)
+                for item in dataset.metadata.items():
+                    self._datasets_by_metadata_key[item[0]].add(entry)
+                    self._datasets_by_metadata[item].add(entry)
+            for application in node.applications or ():
+                entry = (application.name, node_key, application, node)
+                self._containers.add(entry)
+                self._containers_by_node[node.uuid].add(entry)
+
+        for index in [self._datasets, self._containers]:
+            index.sort()
+        for indexes in [self._datasets_by_primary,
+                        self._datasets_by_metadata_key,
+                        self._datasets_by_metadata,
+                        self._datasets_by_deleted,
+                        self._containers_by_node]:
+            for index in indexes.values():
+                index.sort()
+
+    def datasets(self, primary=None, metadata_key=None, metadata_value=None,
+                 deleted=None, after=None, limit=None):
+        """
+        Find primary datasets.
+
+        :param UUID primary: If not ``None``, only find datasets whose
+            primary manifestation is on the node with this UUID.
+        :param unicode metadata_key: If not ``None``, only find datasets
+            with this metadata key.
+        :param unicode metadata_value: If not ``None``, only find datasets
+            with this value for ``metadata_key``.
+        :param bool deleted: If not ``None``, only find datasets which are
+            or aren't deleted.
+        :param unicode after: If not ``None``, only find datasets whose
+            identifiers sort after this one.
+        :param limit: If not ``None``, the number of datasets to find.
+
+        :return: ``list`` of ``(Dataset, Node)`` tuples, sorted by dataset
+            identifier.
+        """
+        indexes = [self._datasets]
+        if primary is not None:
+            indexes.append(self._datasets_by_primary.get(primary, _EMPTY))
+        if metadata_value is not None:
+            indexes.append(self._datasets_by_metadata.get(
+                (metadata_key, metadata_value), _EMPTY))
+        elif metadata_key is not None:
+            indexes.append(
+                self._datasets_by_metadata_key.get(metadata_key, _EMPTY))
+        if deleted is not None:
+            indexes.append(self._datasets_by_deleted.get(deleted, _EMPTY))
+        return _query(indexes, after=after, limit=limit)
+
+    def containers(self, node_uuid=None, prefix=u"", after=None, limit=None):
+        """
+        Find containers.
+
+        :param UUID node_uuid: If not ``None``, only find containers on the
+            node with this UUID.
+        :param unicode prefix: Only find containers whose names start with
+            this.
+        :param unicode after: If not ``None``, only find containers whose
+            names sort after this one.
+        :param limit: If not ``None``, the number of containers to find.
+
+        :return: ``list`` of ``(Application, Node)`` tuples, sorted by name.
+        """
+        indexes = [self._containers]
+        if node_uuid is not None:
+            indexes.append(self._containers_by_node.get(node_uuid, _EMPTY))
+        return _query(indexes, prefix=prefix, after=after, limit=limit)
@@ -0,0 +1,113 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+# -*- test-case-name: flocker.control.test.test_logging -*-
+
+"""
+Eliot fields for cluster configuration and state.
+
+These objects describe the whole cluster, so logging their ``repr`` on every
+convergence iteration or broadcast is expensive.  By default only summaries
+are logged; full dumps are logged only if ``FLOCKER_LOG_FULL_STATE`` is set
+in the environment or ``set_full_state_logging`` has been called.
+"""
+
+from os import environ
+
+from eliot import Field
+
+from ._model import (
+    Deployment, DeploymentState, Node, NodeState, NonManifestDatasets,
+)
+
+
+_full_state_logging = bool(environ.get("FLOCKER_LOG_FULL_STATE"))
+
+
+def set_full_state_logging(enabled):
+    """
+    Choose whether cluster configuration and state are logged in full.
+
+    :param bool enabled: If ``True`` log full dumps, otherwise summaries.
+    """
+    global _full_state_logging
+    _full_state_logging = enabled
+
+
+def full_state_logging():
+    """
+    :return bool: Whether cluster configuration and state are logged in full.
+    """
+    return _full_state_logging
+
+
+def _count_nodes(nodes):
+    """
+    :param nodes: ``Node`` or ``NodeState`` instances.
+
+    :return: ``dict`` with the number of nodes and the numbers of datasets
+        and applications on them.
+    """
+    datasets = applications = 0
+    for node in nodes:
+        datasets += len(node.manifestations or ())
+        applications += len(node.applications or ())
+    return {u"nodes": len(nodes), u"datasets": datasets,
+            u"applications": applications}
+
+
+def summarize(value):
+    """
+    Summarize cluster configuration or state for logging.
+
+    :param value: A ``Deployment``, ``DeploymentState``, ``Node``,
+        ``NodeState`` or ``NonManifestDatasets``, or a ``list`` or ``tuple``
+        of them.  The ``repr`` of anything else is used as its summary.
+
+    :return: A JSON-compatible summary giving the type, the numbers of
+        nodes, datasets and applications and a hash of ``value``.
+    """
+    if isinstance(value, (list, tuple)):
+        return [summarize(item) for item in value]
+    if isinstance(value, (Deployment, DeploymentState)):
+        summary = _count_nodes(value.nodes)
+        if isinstance(value, DeploymentState):
+            summary[u"datasets"] += len(value.nonmanifest_datasets)
+    elif isinstance(value, (Node, NodeState)):
+        summary = _count_nodes([value])
+    elif isinstance(value, NonManifestDatasets):
+        summary = {u"datasets": len(value.datasets)}
+    else:
+        return repr(value)
+    summary[u"type"] = type(value).__name__
+    try:
+        summary[u"hash"] = hash(value)
+    except TypeError:
+        # Something inside isn't hashable:
+        summary[u"hash"] = None
+    return summary
+
+
+def serialize_state(value):
+    """
+    Serialize cluster configuration or state for logging: ``repr`` if full
+    state logging is enabled, otherwise ``summarize``.
+
+    :param value: See ``summarize``.
+
+    :return: ``unicode`` or a JSON-compatible summary.
+    """
+    if _full_state_logging:
+        return repr(value)
+    return summarize(value)
+
+
+def state_field(key, description):
+    """
+    Create a field for cluster configuration or state, which is serialized
+    with ``serialize_state``.
+
+    :param unicode key: The name of the field.
+    :param description: A description of the field.
+
+    :return Field: The field.
+    """
+    return Field(key, serialize_state, description)
@@ -14,6 +14,7 @@ There are different categories of classes:
 3. Configuration-specific classes, none implemented yet.
 """
 
+from collections import OrderedDict
 from uuid import UUID
 from warnings import warn
 from hashlib import md5
@@ -46,14 +47,15 @@ def _sequence_field(checked_class, suffix, item_type, optional, initial):
         __type__ = item_type
     TheType.__name__ = item_type.__name__.capitalize() + suffix
 
-    if optional:
-        def factory(argument):
-            if argument is None:
-                return None
-            else:
-                return TheType(argument)
-    else:
-        factory = TheType
+    def factory(argument):
+        if optional and argument is None:
+            return None
+        elif isinstance(argument, TheType):
+            # Already checked, and rebuilding it would mean rehashing every
+            # item:
+            return argument
+        else:
+            return TheType(argument)
     return field(type=optional_type(TheType) if optional else TheType,
                  factory=factory, mandatory=True,
                  initial=factory(initial))
@@ -121,14 +123,15 @@ def pmap_field(
     TheMap.__name__ = (key_type.__name__.capitalize() +
                        value_type.__name__.capitalize() + "PMap")
 
-    if optional:
-        def factory(argument):
-            if argument is None:
-                return None
-            else:
-                return TheMap(argument)
-    else:
-        factory = TheMap
+    def factory(argument):
+        if optional and argument is None:
+            return None
+        elif isinstance(argument, TheMap):
+            # Already checked, and rebuilding it would mean rehashing every
+            # item:
+            return argument
+        else:
+            return TheMap(argument)
 
     if initial is _UNDEFINED:
         initial = TheMap()
@@ -462,6 +465,176 @@ def same_node(node1, node2):
     return node1.uuid == node2.uuid
 
 
+class _InstanceCache(object):
+    """
+    A bounded cache of values derived from immutable objects.
+
+    ``PRecord`` instances can't have attributes set on them, so values
+    computed from them are stored here instead, keyed by the identity of the
+    object they were computed from.  Cached objects are kept alive by the
+    cache so their identities can't be reused while they are in it.
+
+    :ivar _compute: A one-argument callable which computes the value for an
+        object.
+    :ivar int _size: The maximum number of objects to cache values for.
+    :ivar OrderedDict _entries: Mapping from ``id`` of an object to a tuple
+        of the object and its value, least recently used first.
+    """
+    def __init__(self, compute, size=64):
+        self._compute = compute
+        self._size = size
+        self._entries = OrderedDict()
+
+    def get(self, obj):
+        """
+        :param obj: An immutable object.
+
+        :return: The value for the object, computing it if it isn't cached.
+        """
+        entry = self._entries.pop(id(obj), None)
+        if entry is None:
+            entry = (obj, self._compute(obj))
+        self._store(obj, entry)
+        return entry[1]
+
+    def seed(self, obj, value):
+        """
+        Cache a value for an object which was cheaply derived from the value
+        for another object.
+
+        :param obj: An immutable object.
+        :param value: The value ``get`` would compute for the object.
+        """
+        self._entries.pop(id(obj), None)
+        self._store(obj, (obj, value))
+
+    def peek(self, obj):
+        """
+        :param obj: An immutable object.
+
+        :return: The cached value for the object, or ``None`` if there is
+            none.
+        """
+        entry = self._entries.get(id(obj))
+        if entry is None:
+            return None
+        return entry[1]
+
+    def _store(self, obj, entry):
+        self._entries[id(obj)] = entry
+        while len(self._entries) > self._size:
+            self._entries.popitem(last=False)
+
+
+def _index_nodes(deployment):
+    """
+    :param deployment: A ``Deployment`` or ``DeploymentState``.
+
+    :return PMap: Mapping from ``UUID`` to the node in ``deployment`` with
+        that UUID.
+    """
+    return pmap({node.uuid: node for node in deployment.nodes})
+
+
+# Node indexes of recently used ``Deployment`` and ``DeploymentState``
+# instances:
+_NODE_INDEX = _InstanceCache(_index_nodes)
+
+
+def _node_manifestations(node):
+    """
+    :param node: A ``Node`` or ``NodeState``.
+
+    :return: Mapping from dataset ID to ``Manifestation`` for the
+        manifestations on the node, empty if they are unknown.
+    """
+    if node.manifestations is None:
+        return {}
+    return node.manifestations
+
+
+def _index_datasets(deployment):
+    """
+    :param deployment: A ``Deployment`` or ``DeploymentState``.
+
+    :return PMap: Mapping from dataset ID to a ``tuple`` of
+        ``(Manifestation, node)`` pairs for every manifestation of that
+        dataset in ``deployment``.
+    """
+    index = {}
+    for node in deployment.nodes:
+        for dataset_id, manifestation in _node_manifestations(node).items():
+            index.setdefault(dataset_id, []).append((manifestation, node))
+    return pmap({dataset_id: tuple(pairs)
+                 for dataset_id, pairs in index.items()})
+
+
+def _reindex_datasets(index, original_node, node):
+    """
+    Update a dataset index for the replacement of a single node.
+
+    :param PMap index: The index, as returned by ``_index_datasets``.
+    :param original_node: The node being replaced, or ``None``.
+    :param node: The node replacing it.
+
+    :return PMap: The updated index.
+    """
+    if original_node is not None:
+        for dataset_id in _node_manifestations(original_node):
+            pairs = tuple(pair for pair in index[dataset_id]
+                          if pair[1].uuid != original_node.uuid)
+            if pairs:
+                index = index.set(dataset_id, pairs)
+            else:
+                index = index.discard(dataset_id)
+    for dataset_id, manifestation in _node_manifestations(node).items():
+        index = index.set(
+            dataset_id,
+            index.get(dataset_id, ()) + ((manifestation, node),))
+    return index
+
+
+# Dataset indexes of recently used ``Deployment`` and ``DeploymentState``
+# instances:
+_DATASET_INDEX = _InstanceCache(_index_datasets)
+
+
+def _dataset_manifestations(deployment, dataset_id):
+    """
+    Find all the manifestations of a dataset.
+
+    :param unicode dataset_id: The ID of the dataset.
+
+    :return: A ``tuple`` of ``(Manifestation, node)`` pairs, one for each
+        node which has a manifestation of the dataset.
+    """
+    return _DATASET_INDEX.get(deployment).get(dataset_id, ())
+
+
+def _update_node(deployment, node):
+    """
+    Replace the node with the same UUID as the given node, or add the given
+    node if there is none.
+
+    :param deployment: A ``Deployment`` or ``DeploymentState``.
+    :param node: A ``Node`` or ``NodeState`` respectively.
+
+    :return: The updated ``deployment``.
+    """
+    index = _NODE_INDEX.get(deployment)
+    original_node = index.get(node.uuid)
+    nodes = deployment.nodes
+    if original_node is not None:
+        nodes = nodes.discard(original_node)
+    updated = deployment.set(nodes=nodes.add(node))
+    _NODE_INDEX.seed(updated, index.set(node.uuid, node))
+    datasets = _DATASET_INDEX.peek(deployment)
+    if datasets is not None:
+        _DATASET_INDEX.seed(
+            updated, _reindex_datasets(datasets, original_node, node))
+    return updated
+
+
 def _get_node(default_factory):
     """
     Create a helper function for getting a node from a deployment.
@@ -478,12 +651,10 @@ def _get_node(default_factory):
              is found.
     """
     def get_node(deployment, uuid, **defaults):
-        nodes = list(
-            node for node in deployment.nodes if node.uuid == uuid
-        )
-        if len(nodes) == 0:
+        node = _NODE_INDEX.get(deployment).get(uuid)
+        if node is None:
             return default_factory(uuid=uuid, **defaults)
-        return nodes[0]
+        return node
     return get_node
 
 
@@ -499,6 +670,8 @@ class Deployment(PRecord):
 
     get_node = _get_node(Node)
 
+    dataset_manifestations = _dataset_manifestations
+
     def applications(self):
         """
         Return all applications in all nodes.
@@ -520,9 +693,7 @@ class Deployment(PRecord):
 
         :return Deployment: Updated with new ``Node``.
         """
-        return Deployment(nodes=frozenset(
-            list(n for n in self.nodes if not same_node(n, node)) +
-            [node]))
+        return _update_node(self, node)
 
     def move_application(self, application, target_node):
         """
@@ -622,7 +793,8 @@ class IClusterStateChange(Interface):
             cluster.
 
         :return: A new ``DeploymentState`` similar to ``cluster_state`` but
-            with changes from this object applied to it.
+            with changes from this object applied to it.  If this object
+            changes nothing, ``cluster_state`` itself should be returned.
         """
 
 
@@ -714,6 +886,8 @@ class DeploymentState(PRecord):
 
     get_node = _get_node(NodeState)
 
+    dataset_manifestations = _dataset_manifestations
+
     nonmanifest_datasets = pmap_field(
         unicode, Dataset, invariant=_keys_match_dataset_id
     )
@@ -731,18 +905,19 @@ class DeploymentState(PRecord):
         :param NodeState node: An update for ``NodeState`` with same
              hostname in this ``DeploymentState``.
 
-        :return DeploymentState: Updated with new ``NodeState``.
+        :return DeploymentState: Updated with new ``NodeState``, or this
+            very ``DeploymentState`` if the update changes nothing.
         """
-        nodes = {n for n in self.nodes if same_node(n, node_state)}
-        if not nodes:
-            return self.transform(["nodes"], lambda s: s.add(node_state))
-        [original_node] = nodes
+        original_node = _NODE_INDEX.get(self).get(node_state.uuid)
+        if original_node is None:
+            return _update_node(self, node_state)
         updated_node = original_node
         for key, value in node_state.items():
             if value is not None:
                 updated_node = updated_node.set(key, value)
-        return self.set(
-            "nodes", self.nodes.discard(original_node).add(updated_node))
+        if updated_node == original_node:
+            return self
+        return _update_node(self, updated_node)
 
 
 @implementer(IClusterStateChange)
@@ -754,12 +929,163 @@ class NonManifestDatasets(PRecord):
     datasets = pmap_field(unicode, Dataset, invariant=_keys_match_dataset_id)
 
     def update_cluster_state(self, cluster_state):
+        if cluster_state.nonmanifest_datasets == self.datasets:
+            return cluster_state
         return cluster_state.set(nonmanifest_datasets=self.datasets)
 
 
+def _diff_nodes(old_nodes, new_nodes):
+    """
+    Compare two collections of nodes, matching nodes up by UUID.
+
+    :param old_nodes: Iterable of ``Node`` or ``NodeState`` instances.
+    :param new_nodes: Iterable of ``Node`` or ``NodeState`` instances.
+
+    :return: Tuple of a ``list`` of the nodes in ``new_nodes`` which were
+        added or changed, and a ``list`` of the ``UUID``\ s of nodes which
+        are only present in ``old_nodes``.
+    """
+    old_by_uuid = {node.uuid: node for node in old_nodes}
+    changed = []
+    for node in new_nodes:
+        old_node = old_by_uuid.pop(node.uuid, None)
+        # Unchanged nodes are usually the very same object, so check
+        # identity before falling back to the more expensive comparison:
+        if old_node is None or (old_node is not node and old_node != node):
+            changed.append(node)
+    return changed, list(old_by_uuid)
+
+
+def _apply_node_diff(nodes, changed_nodes, removed_nodes):
+    """
+    Apply node changes from a diff.
+
+    :param nodes: The existing ``Node`` or ``NodeState`` instances.
+    :param changed_nodes: Nodes which replace any existing node with the
+        same UUID.
+    :param removed_nodes: ``UUID``\ s of nodes to remove.
+
+    :return list: The updated nodes.
+    """
+    replaced = set(removed_nodes) | {node.uuid for node in changed_nodes}
+    return [node for node in nodes
+            if node.uuid not in replaced] + list(changed_nodes)
+
+
+class DeploymentDiff(PRecord):
+    """
+    The changes necessary to turn one ``Deployment`` into another.
+
+    :ivar PSet changed_nodes: ``Node`` instances which were added or whose
+        configuration changed.  Each replaces any existing ``Node`` with the
+        same UUID.
+    :ivar PSet removed_nodes: The ``UUID``\ s of nodes which were removed.
+    """
+    changed_nodes = pset_field(Node)
+    removed_nodes = pset_field(UUID)
+
+    def apply(self, deployment):
+        """
+        Apply this diff.
+
+        :param Deployment deployment: The ``Deployment`` this diff was
+            created from.
+
+        :return Deployment: The ``Deployment`` this diff was created to.
+        """
+        return deployment.set(nodes=_apply_node_diff(
+            deployment.nodes, self.changed_nodes, self.removed_nodes))
+
+
+class DeploymentStateDiff(PRecord):
+    """
+    The changes necessary to turn one ``DeploymentState`` into another.
+
+    :ivar PSet changed_nodes: ``NodeState`` instances which were added or
+        changed.  Each replaces any existing ``NodeState`` with the same
+        UUID; unlike ``DeploymentState.update_node`` no information is
+        merged.
+    :ivar PSet removed_nodes: The ``UUID``\ s of nodes which were removed.
+    :ivar PMap changed_nonmanifest_datasets: Non-manifest ``Dataset``
+        instances which were added or changed, keyed by dataset ID.
+    :ivar PSet removed_nonmanifest_datasets: The IDs of non-manifest datasets
+        which were removed.
+    """
+    changed_nodes = pset_field(NodeState)
+    removed_nodes = pset_field(UUID)
+    changed_nonmanifest_datasets = pmap_field(
+        unicode, Dataset, invariant=_keys_match_dataset_id
+    )
+    removed_nonmanifest_datasets = pset_field(unicode)
+
+    def apply(self, deployment_state):
+        """
+        Apply this diff.
+
+        :param DeploymentState deployment_state: The ``DeploymentState``
+            this diff was created from.
+
+        :return DeploymentState: The ``DeploymentState`` this diff was
+            created to.
+        """
+        datasets = deployment_state.nonmanifest_datasets
+        for dataset_id in self.removed_nonmanifest_datasets:
+            datasets = datasets.discard(dataset_id)
+        return deployment_state.set(
+            nodes=_apply_node_diff(
+                deployment_state.nodes, self.changed_nodes,
+                self.removed_nodes),
+            nonmanifest_datasets=datasets.update(
+                self.changed_nonmanifest_datasets),
+        )
+
+
+def diff_deployments(old, new):
+    """
+    Calculate the changes between two ``Deployment`` instances.
+
+    :param Deployment old: The earlier configuration.
+    :param Deployment new: The later configuration.
+
+    :return DeploymentDiff: A diff which turns ``old`` into ``new`` when
+        applied.
+    """
+    changed, removed = _diff_nodes(old.nodes, new.nodes)
+    return DeploymentDiff(changed_nodes=changed, removed_nodes=removed)
+
+
+def diff_deployment_states(old, new):
+    """
+    Calculate the changes between two ``DeploymentState`` instances.
+
+    :param DeploymentState old: The earlier cluster state.
+    :param DeploymentState new: The later cluster state.
+
+    :return DeploymentStateDiff: A diff which turns ``old`` into ``new``
+        when applied.
+    """
+    changed, removed = _diff_nodes(old.nodes, new.nodes)
+    old_datasets = old.nonmanifest_datasets
+    new_datasets = new.nonmanifest_datasets
+    return DeploymentStateDiff(
+        changed_nodes=changed,
+        removed_nodes=removed,
+        changed_nonmanifest_datasets={
+            dataset_id: dataset
+            for dataset_id, dataset in new_datasets.items()
+            if old_datasets.get(dataset_id) != dataset
+        },
+        removed_nonmanifest_datasets=[
+            dataset_id for dataset_id in old_datasets
+            if dataset_id not in new_datasets
+        ],
+    )
+
+
 # Classes that can be serialized to disk or sent over the network:
 SERIALIZABLE_CLASSES = [
     Deployment, Node, DockerImage, Port, Link, RestartNever, RestartAlways,
     RestartOnFailure, Application, Dataset, Manifestation, AttachedVolume,
-    NodeState, DeploymentState, NonManifestDatasets,
+    NodeState, DeploymentState, NonManifestDatasets, DeploymentDiff,
+    DeploymentStateDiff,
 ]
@@ -4,44 +4,161 @@
 Persistence of cluster configuration.
 """
 
-from json import dumps, loads, JSONEncoder
-from uuid import UUID
+from functools import partial
+from hashlib import sha1
+from json import dumps, loads
+from os import O_RDONLY, close, fsync, open as os_open
+from uuid import UUID, uuid4
 
-from eliot import Logger, write_traceback, MessageType, Field, ActionType
+from eliot import Logger, write_traceback, MessageType, ActionType
+from eliot.twisted import DeferredContext
 
-from pyrsistent import PRecord, PVector, PMap, PSet, pmap
+from pyrsistent import (
+    PRecord, PVector, PMap, PSet, pmap, CheckedPSet, CheckedPMap,
+    CheckedPVector,
+)
 
+from twisted.python.failure import Failure
 from twisted.python.filepath import FilePath
 from twisted.application.service import Service
-from twisted.internet.defer import succeed
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.threadpool import ThreadPool
 
-from ._model import SERIALIZABLE_CLASSES, Deployment
+from ._model import (
+    SERIALIZABLE_CLASSES, Deployment, diff_deployments, Dataset, Manifestation,
+    Application, DockerImage, Port, Node, NodeState, DeploymentState,
+)
+from ._logging import state_field
 
 
 # Serialization marker storing the class name:
 _CLASS_MARKER = u"$__class__$"
 
+# Types which JSON can encode as they are:
+_JSON_TYPES = frozenset([unicode, bytes, int, long, float, bool, type(None)])
 
-class _ConfigurationEncoder(JSONEncoder):
+# Mapping from types to functions converting instances into objects JSON can
+# encode; filled in as types are encountered:
+_ENCODERS = {}
+
+
+def _to_json(obj):
+    """
+    Convert an object from the configuration model into an object which
+    JSON can encode.
+
+    :param obj: An object from the configuration model.
+
+    :return: An object made of ``dict``, ``list`` and JSON scalars.
+    """
+    try:
+        encoder = _ENCODERS[type(obj)]
+    except KeyError:
+        encoder = _ENCODERS[type(obj)] = _encoder_for_type(type(obj))
+    return encoder(obj)
+
+
+def _identity(obj):
+    return obj
+
+
+def _encode_sequence(obj):
+    return [_to_json(item) for item in obj]
+
+
+def _encode_pmap(obj):
+    return {_CLASS_MARKER: u"PMap",
+            u"values": [[_to_json(key), _to_json(value)]
+                        for key, value in obj.iteritems()]}
+
+
+def _encode_dict(obj):
+    return {key: _to_json(value) for key, value in obj.iteritems()}
+
+
+def _encode_filepath(obj):
+    return {_CLASS_MARKER: u"FilePath", u"path": obj.path.decode("utf-8")}
+
+
+def _encode_uuid(obj):
+    return {_CLASS_MARKER: u"UUID", u"hex": unicode(obj)}
+
+
+def _field_encoder(field):
+    """
+    Choose how to encode the values of a ``PRecord`` field.
+
+    :param field: A ``PRecord`` field.
+
+    :return: A one-argument callable which converts values of the field
+        into objects JSON can encode.
+    """
+    if field.type and field.type <= _JSON_TYPES:
+        return _identity
+    [checked] = [t for t in field.type if issubclass(t, CheckedPSet)] or [None]
+    if checked is not None and checked.__type__ in _JSON_TYPES:
+        return list
+    return _to_json
+
+
+def _record_encoder(record_class):
+    """
+    Create a function which encodes instances of a ``PRecord`` subclass.
+
+    :param record_class: A ``PRecord`` subclass.
+
+    :return: A one-argument callable which converts instances into ``dict``
+        which JSON can encode.
+    """
+    class_name = record_class.__name__
+    encoders = {name: _field_encoder(field)
+                for name, field in record_class._precord_fields.items()}
+
+    def encode_record(obj):
+        result = {_CLASS_MARKER: class_name}
+        for key, value in obj.iteritems():
+            if value is not None:
+                value = encoders[key](value)
+            result[key] = value
+        return result
+    return encode_record
+
+
+def _encoder_for_type(obj_type):
     """
-    JSON encoder that can encode the configuration model.
+    Choose how to encode instances of a type.
+
+    :param type obj_type: The type of an object to encode.
+
+    :return: A one-argument callable which converts instances into objects
+        JSON can encode.
+
+    :raise TypeError: If instances of the type can't be encoded.
     """
-    def default(self, obj):
-        if isinstance(obj, PRecord):
-            result = dict(obj)
-            result[_CLASS_MARKER] = obj.__class__.__name__
-            return result
-        elif isinstance(obj, PMap):
-            return {_CLASS_MARKER: u"PMap", u"values": dict(obj).items()}
-        elif isinstance(obj, (PSet, PVector, set)):
-            return list(obj)
-        elif isinstance(obj, FilePath):
-            return {_CLASS_MARKER: u"FilePath",
-                    u"path": obj.path.decode("utf-8")}
-        elif isinstance(obj, UUID):
-            return {_CLASS_MARKER: u"UUID",
-                    "hex": unicode(obj)}
-        return JSONEncoder.default(self, obj)
+    if obj_type in _JSON_TYPES:
+        return _identity
+    elif issubclass(obj_type, PRecord):
+        return _record_encoder(obj_type)
+    elif issubclass(obj_type, PMap):
+        return _encode_pmap
+    elif issubclass(obj_type, (PSet, PVector, set, list, tuple)):
+        return _encode_sequence
+    elif issubclass(obj_type, dict):
+        return _encode_dict
+    elif issubclass(obj_type, FilePath):
+        return _encode_filepath
+    elif issubclass(obj_type, UUID):
+        return _encode_uuid
+
+    def unencodable(obj):
+        raise TypeError(repr(obj) + " is not JSON serializable")
+    return unencodable
+
+
+for _class in SERIALIZABLE_CLASSES:
+    _ENCODERS[_class] = _record_encoder(_class)
+del _class
 
 
 def wire_encode(obj):
@@ -51,36 +168,459 @@ def wire_encode(obj):
     :param obj: An object from the configuration model, e.g. ``Deployment``.
     :return bytes: Encoded object.
     """
-    return dumps(obj, cls=_ConfigurationEncoder)
+    return dumps(_to_json(obj))
+
+
+def _trusted_checked_pset(set_type, items):
+    """
+    Convert a decoded list into a ``CheckedPSet`` without checking the types
+    of its items.
 
+    :param set_type: The ``CheckedPSet`` subclass to create.
+    :param list items: The decoded items.
 
-def wire_decode(data):
+    :return: An instance of ``set_type``.
+    """
+    # A CheckedPSet created from a PMap just wraps it:
+    return set_type(pmap(dict.fromkeys(items, True)))
+
+
+def _trusted_checked_pmap(map_type, items):
+    """
+    Convert a decoded ``PMap`` into a ``CheckedPMap`` without checking the
+    types of its items.
+
+    :param map_type: The ``CheckedPMap`` subclass to create.
+    :param PMap items: The decoded map.
+
+    :return: An instance of ``map_type``.
+    """
+    if type(items) is not PMap:
+        return map_type.create(items)
+    return map_type(items._buckets, size=items._size)
+
+
+def _trusted_field_decoder(field):
+    """
+    Choose how to convert decoded JSON into the value of a ``PRecord`` field,
+    without checking the types of the items in collections.
+
+    :param field: A ``PRecord`` field.
+
+    :return: A one-argument callable which converts a decoded value.
+    """
+    for field_type in field.type:
+        if issubclass(field_type, CheckedPSet):
+            return partial(_trusted_checked_pset, field_type)
+        elif issubclass(field_type, CheckedPMap):
+            return partial(_trusted_checked_pmap, field_type)
+        elif issubclass(field_type, CheckedPVector):
+            return field_type
+    return _identity
+
+
+def _trusted_record_decoder(record_class):
+    """
+    Create a function which creates instances of a ``PRecord`` subclass from
+    decoded JSON, skipping the checks done by ``PRecord.create``.
+
+    Input which doesn't match the current fields of the class, e.g. data
+    written by an older version, is passed to ``PRecord.create`` instead so
+    it can be upgraded.
+
+    :param record_class: A ``PRecord`` subclass.
+
+    :return: A one-argument callable which converts a ``dict`` of decoded
+        JSON, without the class marker, into an instance.
+    """
+    decoders = {name: _trusted_field_decoder(field)
+                for name, field in record_class._precord_fields.items()}
+    initial_values = record_class._precord_initial_values
+    mandatory_fields = record_class._precord_mandatory_fields
+
+    def decode_record(dictionary):
+        values = initial_values.copy()
+        for key, value in dictionary.iteritems():
+            decoder = decoders.get(key)
+            if decoder is None:
+                return record_class.create(dictionary)
+            if value is not None:
+                value = decoder(value)
+            values[key] = value
+        if not mandatory_fields <= values.viewkeys():
+            return record_class.create(dictionary)
+        values = pmap(values)
+        return record_class(_precord_size=values._size,
+                            _precord_buckets=values._buckets)
+    return decode_record
+
+
+_CLASSES = {cls.__name__: cls for cls in SERIALIZABLE_CLASSES}
+
+_TRUSTED_DECODERS = {name: _trusted_record_decoder(cls)
+                     for name, cls in _CLASSES.items()}
+
+
+def _trusted_decoding_works():
+    """
+    Check that objects created by trusted decoding are the same as those
+    created normally.
+
+    Trusted decoding relies on internals of ``pyrsistent`` which may change
+    in other versions than the one we depend on.
+
+    :return bool: Whether trusted decoding can be used.
+    """
+    dataset = Dataset(dataset_id=u"x", metadata={u"name": u"x"})
+    manifestations = {dataset.dataset_id: Manifestation(dataset=dataset,
+                                                        primary=True)}
+    application = Application(name=u"x",
+                              image=DockerImage.from_string(u"x"),
+                              ports=[Port(internal_port=1, external_port=2)])
+    samples = [
+        Deployment(nodes=[Node(uuid=UUID(int=1),
+                               applications=[application],
+                               manifestations=manifestations)]),
+        DeploymentState(
+            nodes=[NodeState(uuid=UUID(int=1), hostname=u"x",
+                             manifestations=manifestations,
+                             devices={UUID(int=2): FilePath(b"/x")})],
+            nonmanifest_datasets={dataset.dataset_id: dataset}),
+    ]
+
+    def types(record):
+        return {key: type(value) for key, value in record.items()}
+
+    try:
+        for sample in samples:
+            decoded = wire_decode(wire_encode(sample), trusted=True)
+            [decoded_node] = decoded.nodes
+            [node] = sample.nodes
+            if (decoded != sample or types(decoded) != types(sample) or
+                    types(decoded_node) != types(node)):
+                return False
+    except Exception:
+        return False
+    return True
+
+
+def _decode_object(dictionary, trusted):
+    """
+    Convert a decoded JSON object into an object from the configuration
+    model, if it has a class marker.
+
+    :param dict dictionary: A decoded JSON object.
+    :param bool trusted: Whether to skip validation of the objects created.
+
+    :return: The object from the configuration model, or ``dictionary``.
+    """
+    class_name = dictionary.pop(_CLASS_MARKER, None)
+    if class_name is None:
+        return dictionary
+    elif class_name == u"FilePath":
+        return FilePath(dictionary[u"path"].encode("utf-8"))
+    elif class_name == u"PMap":
+        return pmap(dictionary[u"values"])
+    elif class_name == u"UUID":
+        return UUID(dictionary[u"hex"])
+    elif class_name in _CLASSES:
+        if trusted:
+            return _TRUSTED_DECODERS[class_name](dictionary)
+        return _CLASSES[class_name].create(dictionary)
+    else:
+        dictionary[_CLASS_MARKER] = class_name
+        return dictionary
+
+
+def _decode_untrusted_object(dictionary):
+    return _decode_object(dictionary, False)
+
+
+def _decode_trusted_object(dictionary):
+    return _decode_object(dictionary, True)
+
+
+def wire_decode(data, trusted=False):
     """
     Decode the given configuration object from bytes.
 
     :param bytes data: Encoded object.
+    :param bool trusted: If true, the data is known to have been encoded from
+        valid objects by this version of the code, so types and invariants
+        are not checked when creating objects.  Never use this for data
+        which could have been modified, such as files on disk.
+    :return: An object from the configuration model, e.g. ``Deployment``.
+    """
+    if trusted:
+        object_hook = _decode_trusted_object
+    else:
+        object_hook = _decode_untrusted_object
+    return loads(data, object_hook=object_hook)
+
+
+# Fall back to validating everything if trusted decoding doesn't work with
+# the installed version of pyrsistent:
+if not _trusted_decoding_works():
+    _TRUSTED_DECODERS = {name: cls.create for name, cls in _CLASSES.items()}
+
+
+# The compact encoding is JSON in which every value that isn't a JSON scalar
+# is an array whose first item is a tag saying what it is.  Records are
+# arrays of their field values in a fixed order, so neither class names nor
+# field names are sent.  Encoder and decoder must therefore agree on the
+# tag and fields of every class, which they can check by comparing
+# ``COMPACT_SCHEMA_VERSION``.
+_COMPACT_SEQUENCE = 0
+_COMPACT_PMAP = 1
+_COMPACT_DICT = 2
+_COMPACT_FILEPATH = 3
+_COMPACT_UUID = 4
+# Tag of the first class in SERIALIZABLE_CLASSES:
+_COMPACT_FIRST_CLASS = 16
+# Value of a field which isn't set:
+_COMPACT_ABSENT = []
+
+# Mapping from types to functions converting instances into the compact
+# encoding; filled in as types are encountered:
+_COMPACT_ENCODERS = {}
+
+
+def _to_compact(obj):
+    """
+    Convert an object from the configuration model into the compact
+    encoding.
+
+    :param obj: An object from the configuration model.
+
+    :return: An object made of ``list`` and JSON scalars.
+    """
+    try:
+        encoder = _COMPACT_ENCODERS[type(obj)]
+    except KeyError:
+        encoder = _COMPACT_ENCODERS[type(obj)] = _compact_encoder_for_type(
+            type(obj))
+    return encoder(obj)
+
+
+def _compact_sequence(obj):
+    return [_COMPACT_SEQUENCE] + [_to_compact(item) for item in obj]
+
+
+def _compact_pmap(obj):
+    result = [_COMPACT_PMAP]
+    for key, value in obj.iteritems():
+        result.append(_to_compact(key))
+        result.append(_to_compact(value))
+    return result
+
+
+def _compact_dict(obj):
+    result = [_COMPACT_DICT]
+    for key, value in obj.iteritems():
+        result.append(key)
+        result.append(_to_compact(value))
+    return result
+
+
+def _compact_filepath(obj):
+    return [_COMPACT_FILEPATH, obj.path.decode("utf-8")]
+
+
+def _compact_uuid(obj):
+    return [_COMPACT_UUID, obj.hex]
+
+
+def _compact_field_encoder(field):
+    """
+    Choose how to encode the values of a ``PRecord`` field in the compact
+    encoding.
+
+    :param field: A ``PRecord`` field.
+
+    :return: A one-argument callable which converts values of the field.
+    """
+    if field.type and field.type <= _JSON_TYPES:
+        return _identity
+    [checked] = [t for t in field.type if issubclass(t, CheckedPSet)] or [None]
+    if checked is not None and checked.__type__ in _JSON_TYPES:
+        return lambda value: [_COMPACT_SEQUENCE] + list(value)
+    return _to_compact
+
+
+def _compact_record_encoder(tag, record_class):
+    """
+    Create a function which encodes instances of a ``PRecord`` subclass in
+    the compact encoding.
+
+    :param int tag: The tag identifying the class.
+    :param record_class: A ``PRecord`` subclass.
+
+    :return: A one-argument callable which converts instances into a
+        ``list`` of the tag followed by the field values, in the order given
+        by ``_COMPACT_FIELDS``.
+    """
+    record_fields = record_class._precord_fields
+    fields = [(name, _compact_field_encoder(record_fields[name]))
+              for name in _COMPACT_FIELDS[record_class]]
+
+    def encode_record(obj):
+        # Looking fields up in a dict is much faster than in the record:
+        values = dict(obj.iteritems())
+        result = [tag]
+        for name, encoder in fields:
+            value = values.get(name, _COMPACT_ABSENT)
+            if value is not None and value is not _COMPACT_ABSENT:
+                value = encoder(value)
+            result.append(value)
+        return result
+    return encode_record
+
+
+def _compact_encoder_for_type(obj_type):
+    """
+    Choose how to encode instances of a type in the compact encoding.
+
+    :param type obj_type: The type of an object to encode.
+
+    :return: A one-argument callable which converts instances.
+
+    :raise TypeError: If instances of the type can't be encoded.
+    """
+    if obj_type in _JSON_TYPES:
+        return _identity
+    elif issubclass(obj_type, PMap):
+        return _compact_pmap
+    elif issubclass(obj_type, (PSet, PVector, set, list, tuple)):
+        return _compact_sequence
+    elif issubclass(obj_type, dict):
+        return _compact_dict
+    elif issubclass(obj_type, FilePath):
+        return _compact_filepath
+    elif issubclass(obj_type, UUID):
+        return _compact_uuid
+
+    def unencodable(obj):
+        raise TypeError(repr(obj) + " is not serializable")
+    return unencodable
+
+
+_COMPACT_FIELDS = {cls: sorted(cls._precord_fields)
+                   for cls in SERIALIZABLE_CLASSES}
+
+for _tag, _class in enumerate(SERIALIZABLE_CLASSES, _COMPACT_FIRST_CLASS):
+    _COMPACT_ENCODERS[_class] = _compact_record_encoder(_tag, _class)
+del _tag, _class
+
+# Identifies the tag and fields of every class in the compact encoding:
+COMPACT_SCHEMA_VERSION = sha1(dumps(
+    [[tag, cls.__name__, _COMPACT_FIELDS[cls]]
+     for tag, cls in enumerate(SERIALIZABLE_CLASSES, _COMPACT_FIRST_CLASS)],
+    separators=(",", ":"))).hexdigest()[:16].decode("ascii")
+
+
+def compact_wire_encode(obj):
+    """
+    Encode the given configuration object into bytes using the compact
+    encoding.
+
+    The result is smaller and can be decoded faster than the result of
+    ``wire_encode``, but only ``compact_wire_decode`` with the same
+    ``COMPACT_SCHEMA_VERSION`` can decode it.
+
     :param obj: An object from the configuration model, e.g. ``Deployment``.
+    :return bytes: Encoded object.
     """
-    classes = {cls.__name__: cls for cls in SERIALIZABLE_CLASSES}
-
-    def decode_object(dictionary):
-        class_name = dictionary.get(_CLASS_MARKER, None)
-        if class_name == u"FilePath":
-            return FilePath(dictionary.get(u"path").encode("utf-8"))
-        elif class_name == u"PMap":
-            return pmap(dictionary[u"values"])
-        elif class_name == u"UUID":
-            return UUID(dictionary[u"hex"])
-        elif class_name in classes:
-            dictionary = dictionary.copy()
-            dictionary.pop(_CLASS_MARKER)
-            return classes[class_name].create(dictionary)
-        else:
-            return dictionary
-    return loads(data, object_hook=decode_object)
+    return dumps(_to_compact(obj), separators=(",", ":"))
+
+
+class _CompactDecoder(object):
+    """
+    Convert the compact encoding of an object back into the object.
+
+    :ivar dict _records: Mapping from the tag of each class to a tuple of a
+        function creating the record from a ``dict`` of its fields and the
+        names of the fields.
+    """
+    def __init__(self, trusted):
+        """
+        :param bool trusted: Whether to skip validation of the objects
+            created.
+        """
+        self._records = {}
+        for tag, cls in enumerate(SERIALIZABLE_CLASSES, _COMPACT_FIRST_CLASS):
+            if trusted:
+                create = _TRUSTED_DECODERS[cls.__name__]
+            else:
+                create = cls.create
+            self._records[tag] = (create, _COMPACT_FIELDS[cls])
+
+    def decode(self, value):
+        """
+        Convert a decoded JSON value.
+
+        :param value: A value in the compact encoding.
+
+        :return: The corresponding object.
+
+        :raise ValueError: If the value uses a tag which isn't known.
+        """
+        if type(value) is not list:
+            return value
+        tag = value[0]
+        decode = self.decode
+        if tag == _COMPACT_SEQUENCE:
+            return [decode(item) for item in value[1:]]
+        elif tag == _COMPACT_PMAP:
+            return pmap({decode(value[i]): decode(value[i + 1])
+                         for i in range(1, len(value), 2)})
+        elif tag == _COMPACT_DICT:
+            return {value[i]: decode(value[i + 1])
+                    for i in range(1, len(value), 2)}
+        elif tag == _COMPACT_FILEPATH:
+            return FilePath(value[1].encode("utf-8"))
+        elif tag == _COMPACT_UUID:
+            return UUID(hex=value[1])
+        record = self._records.get(tag)
+        if record is None:
+            raise ValueError("Unknown tag in compact encoding: {}".format(tag))
+        create, field_names = record
+        fields = {}
+        for name, item in zip(field_names, value[1:]):
+            if item != _COMPACT_ABSENT:
+                fields[name] = decode(item)
+        return create(fields)
+
+
+def compact_wire_decode(data, trusted=False):
+    """
+    Decode the given configuration object from bytes created by
+    ``compact_wire_encode``.
+
+    :param bytes data: Encoded object.
+    :param bool trusted: See ``wire_decode``.
+    :return: An object from the configuration model, e.g. ``Deployment``.
+    """
+    return _COMPACT_DECODERS[bool(trusted)].decode(loads(data))
+
+
+_COMPACT_DECODERS = {False: _CompactDecoder(False),
+                     True: _CompactDecoder(True)}
+
+
+def _fsync_directory(path):
+    """
+    Flush changes to the entries of a directory, e.g. renames, to disk.
+
+    :param FilePath path: The directory.
+    """
+    descriptor = os_open(path.path, O_RDONLY)
+    try:
+        fsync(descriptor)
+    finally:
+        close(descriptor)
 
 
-_DEPLOYMENT_FIELD = Field(u"configuration", repr)
+_DEPLOYMENT_FIELD = state_field(u"configuration", u"The configuration.")
 _LOG_STARTUP = MessageType(u"flocker-control:persistence:startup",
                            [_DEPLOYMENT_FIELD])
 _LOG_SAVE = ActionType(u"flocker-control:persistence:save",
@@ -91,55 +631,235 @@ class ConfigurationPersistenceService(Service):
     """
     Persist configuration to disk, and load it back.
 
+    The configuration is stored as a snapshot plus a journal of the
+    ``DeploymentDiff``\ s saved since the snapshot was written, one encoded
+    diff per line, so the cost of saving is proportional to the size of the
+    change rather than the size of the configuration.  Once the journal is
+    larger than the snapshot it is compacted into a new snapshot.
+
+    Saves are encoded and written in a thread, so they don't block the
+    reactor.  Only one write happens at a time; saves made while a write
+    is in progress are committed together by the next write.
+
     :ivar Deployment _deployment: The current desired deployment configuration.
+    :ivar unicode _epoch: Identifies this run of the service, so versions
+        are never reused across restarts.
+    :ivar int _generation: The number of saves made since the service
+        started.
+    :ivar Deployment _persisted: The configuration most recently written to
+        disk.  Only used by the writer thread.
+    :ivar int _snapshot_size: The length in bytes of the snapshot.
+    :ivar int _journal_size: The length in bytes of the journal.
+    :ivar _journal: The journal, open for appending.
+    :ivar _writing: A ``Deferred`` which fires when the write in progress
+        finishes, or ``None`` if nothing is being written.
+    :ivar list _waiting: ``Deferred``\ s for saves which will be committed
+        by the next write.
+    :ivar list _flushing: ``Deferred``\ s to fire once no more writes are
+        pending.
     """
     logger = Logger()
 
-    def __init__(self, reactor, path):
+    def __init__(self, reactor, path, threadpool=None):
         """
         :param reactor: Reactor to use for thread pool.
         :param FilePath path: Directory where desired deployment will be
             persisted.
+        :param threadpool: The ``ThreadPool`` to write in, or ``None`` to
+            write in a dedicated thread started and stopped along with the
+            service.
         """
+        self._reactor = reactor
         self._path = path
         self._change_callbacks = []
+        self._journal = None
+        self._threadpool = threadpool
+        self._own_threadpool = threadpool is None
+        self._writing = None
+        self._waiting = []
+        self._flushing = []
+        self._epoch = uuid4().hex.decode("ascii")
+        self._generation = 0
 
     def startService(self):
         if not self._path.exists():
             self._path.makedirs()
         self._config_path = self._path.child(b"current_configuration.v1.json")
+        self._journal_path = self._path.child(
+            b"current_configuration.v1.journal")
         if self._config_path.exists():
-            self._deployment = wire_decode(
-                self._config_path.getContent())
+            # The files may have been edited or corrupted since we wrote
+            # them, so they are fully validated as they are loaded:
+            self._deployment = self._replay_journal(wire_decode(
+                self._config_path.getContent()))
         else:
             self._deployment = Deployment(nodes=frozenset())
-            self._sync_save(self._deployment)
+        # Start with an empty journal, so a partially written entry left by
+        # a crash is never followed by further entries:
+        self._write_snapshot(self._deployment)
+        self._persisted = self._deployment
+        # Unbuffered, so nothing is left in a buffer if a write fails:
+        self._journal = open(self._journal_path.path, "ab", 0)
+        self._journal_size = 0
+        if self._own_threadpool:
+            self._threadpool = ThreadPool(
+                minthreads=1, maxthreads=1, name="configuration-writer")
+            self._threadpool.start()
+        Service.startService(self)
         _LOG_STARTUP(configuration=self.get()).write(self.logger)
 
-    def register(self, change_callback):
+    def stopService(self):
+        Service.stopService(self)
+        flushed = self._flushed()
+        flushed.addCallback(lambda _: self._stop_writing())
+        return flushed
+
+    def _stop_writing(self):
         """
-        Register a function to be called whenever the configuration changes.
+        Stop the writer thread, if it is ours, and close the journal.
+        """
+        if self._own_threadpool:
+            self._threadpool.stop()
+            self._threadpool = None
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+    def _flushed(self):
+        """
+        :return Deferred: Fires once all saves made so far are on disk.
+        """
+        if self._writing is None:
+            return succeed(None)
+        flushing = Deferred()
+        self._flushing.append(flushing)
+        return flushing
 
-        :param change_callback: Callable that takes no arguments, will be
-            called when configuration changes.
+    def _write(self):
         """
-        self._change_callbacks.append(change_callback)
+        Write the current configuration in the writer thread, committing
+        all the saves waiting for a write.
+        """
+        waiting, self._waiting = self._waiting, []
+        self._writing = deferToThreadPool(
+            self._reactor, self._threadpool, self._sync_save,
+            self._deployment)
+
+        def written(result):
+            self._writing = None
+            for saving in waiting:
+                if isinstance(result, Failure):
+                    saving.errback(result)
+                else:
+                    saving.callback(None)
+            if self._waiting:
+                self._write()
+            else:
+                flushing, self._flushing = self._flushing, []
+                for d in flushing:
+                    d.callback(None)
+        self._writing.addBoth(written)
+
+    def _replay_journal(self, deployment):
+        """
+        Apply the diffs in the journal to the configuration loaded from the
+        snapshot.
+
+        Diffs replace whole nodes, so replaying a journal which was already
+        compacted into the snapshot (if we crashed before truncating it)
+        still results in the configuration in the snapshot.
+
+        :param Deployment deployment: The configuration from the snapshot.
+
+        :return Deployment: The configuration the journal ends with.
+        """
+        if not self._journal_path.exists():
+            return deployment
+        for line in self._journal_path.getContent().splitlines(True):
+            if not line.endswith(b"\n"):
+                # A crash happened while this entry was being written, so
+                # it was never saved:
+                break
+            deployment = wire_decode(line).apply(deployment)
+        return deployment
+
+    def _write_snapshot(self, deployment):
+        """
+        Save the whole of a deployment to disk, and empty the journal.
+
+        The journal is only emptied once the new snapshot is on disk, so a
+        crash at any point leaves either the old snapshot and the journal or
+        the new snapshot.
+
+        :param Deployment deployment: The configuration to save.
+        """
+        data = wire_encode(deployment)
+        # Write a new file and rename it over the old one, so the snapshot
+        # is replaced atomically:
+        temporary = self._config_path.temporarySibling()
+        with temporary.open("w") as snapshot:
+            snapshot.write(data)
+            snapshot.flush()
+            fsync(snapshot.fileno())
+        temporary.moveTo(self._config_path)
+        _fsync_directory(self._path)
+        self._snapshot_size = len(data)
+        if self._journal is not None:
+            self._journal.truncate(0)
+            fsync(self._journal.fileno())
+            self._journal_size = 0
+        elif self._journal_path.exists():
+            self._journal_path.remove()
+            _fsync_directory(self._path)
 
     def _sync_save(self, deployment):
         """
         Save and flush new deployment to disk synchronously.
+
+        Only the changes since the previously written deployment are
+        written, unless the journal has grown large enough to be compacted.
         """
-        self._config_path.setContent(wire_encode(deployment))
+        entry = wire_encode(
+            diff_deployments(self._persisted, deployment)) + b"\n"
+        if self._journal_size + len(entry) > self._snapshot_size:
+            self._write_snapshot(deployment)
+        else:
+            try:
+                self._journal.write(entry)
+                fsync(self._journal.fileno())
+            except:
+                # Remove whatever was written, so the next entry doesn't
+                # continue a partial line:
+                self._journal.truncate(self._journal_size)
+                raise
+            self._journal_size += len(entry)
+        self._persisted = deployment
+
+    def register(self, change_callback):
+        """
+        Register a function to be called whenever the configuration changes.
+
+        :param change_callback: Callable that takes no arguments, will be
+            called when configuration changes.
+        """
+        self._change_callbacks.append(change_callback)
 
     def save(self, deployment):
         """
         Save and flush new deployment to disk.
 
+        The new deployment is returned by ``get`` immediately.
+
         :return Deferred: Fires when write is finished.
         """
-        with _LOG_SAVE(self.logger, configuration=deployment):
-            self._sync_save(deployment)
+        action = _LOG_SAVE(self.logger, configuration=deployment)
+        with action.context():
             self._deployment = deployment
+            self._generation += 1
+            saving = Deferred()
+            self._waiting.append(saving)
+            if self._writing is None:
+                self._write()
             # At some future point this will likely involve talking to a
             # distributed system (e.g. ZooKeeper or etcd), so the API doesn't
             # guarantee immediate saving of the data.
@@ -150,7 +870,9 @@ class ConfigurationPersistenceService(Service):
                     # Second argument will be ignored in next Eliot release, so
                     # not bothering with particular value.
                     write_traceback(self.logger, u"")
-            return succeed(None)
+            saving = DeferredContext(saving)
+            saving.addActionFinish()
+            return saving.result
 
     def get(self):
         """
@@ -161,3 +883,15 @@ class ConfigurationPersistenceService(Service):
         :return Deployment: The current desired configuration.
         """
         return self._deployment
+
+    def get_version(self):
+        """
+        Retrieve an identifier for the current configuration.
+
+        Every save changes the version, and versions are never reused, so
+        clients can use them to find out whether the configuration changed.
+
+        :return unicode: The version of the configuration returned by
+            ``get``.
+        """
+        return u"{}-{}".format(self._epoch, self._generation)
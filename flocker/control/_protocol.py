@@ -12,6 +12,12 @@ Interactions:
 * The control service knows the desired configuration for the cluster.
   Every time it changes it notifies the convergence agents using the
   ClusterStatusCommand.
+* Each combination of configuration and state sent to agents is numbered
+  with an increasing generation.  Once an agent has acknowledged a
+  generation the control service only sends it the changes since the
+  last generation it was sent, using the ClusterStatusDiffCommand.  Agents
+  which are missing the generation a diff starts from reply with an error
+  and are sent a full ClusterStatusCommand instead.
 * The convergence agents know the state of nodes. Whenever node state
   changes they notify the control service with a NodeStateCommand.
 * The control service caches the current state of all nodes. Whenever the
@@ -19,13 +25,33 @@ Interactions:
   NodeStateCommand, the control service then aggregates that update with
   the rest of the nodes' state and sends a ClusterStatusCommand to all
   convergence agents.
+* Changes to configuration and state which arrive close together are
+  coalesced into a single broadcast of the latest configuration and state.
+* On connecting, convergence agents send the control service the optional
+  protocol features they support using the VersionCommand, and learn which
+  ones the control service supports from the response.  Each side only
+  uses features the other side supports, so older agents and control
+  services keep working.  Such features are a more compact encoding of
+  configuration and state, zlib compression of large values, and values
+  too large for AMP.  Compact values are only accepted on connections that
+  negotiated them, and the control service checks those sent by agents
+  like any other.
+* If both sides support it, configuration and state too large for a single
+  AMP value are split across several values.
 
 Eliot contexts are transferred along with AMP commands, allowing tracing
 of logged actions across processes (see
 http://eliot.readthedocs.org/en/0.6.0/threads.html).
 """
 
-from eliot import Logger, ActionType, Action, Field
+from collections import OrderedDict
+from contextlib import contextmanager
+from struct import calcsize, pack, unpack_from
+from zlib import compress, decompress
+
+from eliot import (
+    Logger, ActionType, Action, Field, MessageType, writeFailure,
+)
 from eliot.twisted import DeferredContext
 
 from characteristic import with_cmp
@@ -35,18 +61,257 @@ from zope.interface import Interface, Attribute
 from twisted.application.service import Service
 from twisted.protocols.amp import (
     Argument, Command, Integer, CommandLocator, AMP, Unicode, ListOf,
+    MAX_VALUE_LENGTH, TooLong,
 )
+from twisted.internet.defer import maybeDeferred
 from twisted.internet.protocol import ServerFactory
 from twisted.application.internet import StreamServerEndpointService
 
-from ._persistence import wire_encode, wire_decode
-from ._model import Deployment, NodeState, DeploymentState, NonManifestDatasets
+from ._persistence import (
+    wire_encode, wire_decode, compact_wire_encode, compact_wire_decode,
+    COMPACT_SCHEMA_VERSION,
+)
+from ._model import (
+    Deployment, NodeState, DeploymentState, NonManifestDatasets,
+    DeploymentDiff, DeploymentStateDiff, diff_deployments,
+    diff_deployment_states,
+)
+from ._logging import state_field
+
+
+# Optional protocol feature: configuration and state may be sent using
+# ``compact_wire_encode``.  Only versions with the same model classes can
+# decode each other's compact encoding, so the schema is part of the name:
+COMPACT_ENCODING = u"compact-encoding-" + COMPACT_SCHEMA_VERSION
+
+# Optional protocol feature: large serialized values may be compressed
+# with zlib:
+ZLIB_COMPRESSION = u"zlib-compression"
+
+# Optional protocol feature: values too long for AMP may be split across
+# several keys, and items of lists may be longer than 64KiB:
+LARGE_VALUES = u"large-values"
+
+# The optional protocol features this version supports:
+CAPABILITIES = frozenset([COMPACT_ENCODING, ZLIB_COMPRESSION, LARGE_VALUES])
+
+# Prefix distinguishing values encoded with ``compact_wire_encode``; JSON
+# never starts with it:
+_COMPACT_PREFIX = b"C"
+
+# Prefix distinguishing values compressed with zlib:
+_COMPRESSED_PREFIX = b"Z"
+
+# Serialized values shorter than this many bytes aren't worth compressing:
+_COMPRESSION_THRESHOLD = 4096
+
+# Prefix distinguishing lists whose items have 32-bit lengths.  Lists with
+# 16-bit lengths never start with it, since no serialized item is empty:
+_WIDE_LIST_PREFIX = b"\x00\x00"
+
+
+def _peer_supports(proto, capability):
+    """
+    Determine whether the other side of a connection supports an optional
+    protocol feature.
+
+    :param proto: The protocol a command is being sent on.  This need not be
+        an ``AMP`` instance, e.g. when sending commands in memory.
+    :param unicode capability: The feature.
+
+    :return bool: Whether the feature can be used.
+    """
+    return capability in getattr(proto, "peer_capabilities", ())
+
+
+def _peer_trusted(proto):
+    """
+    Determine whether values received on a connection can be decoded without
+    checking them.
+
+    :param proto: The protocol or command locator a command was received
+        on.
+
+    :return bool: Whether the other side is the control service, which only
+        sends objects it created and validated itself.
+    """
+    return getattr(proto, "peer_trusted", False)
+
+
+class _CachingEncoder(object):
+    """
+    Encode objects using ``wire_encode`` or ``compact_wire_encode``,
+    optionally caching the results.
+
+    The same configuration and state are sent to every connected agent, so
+    while a cache is active each object is only encoded once per encoding no
+    matter how many agents it is sent to.
+
+    :ivar _cache: ``None`` if caching is disabled, otherwise a ``dict``
+        mapping ``id`` of encoded objects and whether the compact encoding
+        was used to a tuple of the object (keeping it alive, so the ``id`` is
+        not reused) and its encoded form.
+    """
+    def __init__(self):
+        self._cache = None
+
+    def encode(self, obj, compact=False):
+        """
+        Encode an object.
+
+        :param obj: An object from the configuration model.
+        :param bool compact: Whether to use ``compact_wire_encode``.
+
+        :return bytes: The encoded object.
+        """
+        if compact:
+            encode = _compact_encode
+        else:
+            encode = wire_encode
+        if self._cache is None:
+            return encode(obj)
+        key = (id(obj), compact)
+        cached = self._cache.get(key)
+        if cached is None:
+            cached = self._cache[key] = (obj, encode(obj))
+        return cached[1]
+
+    def compress(self, data):
+        """
+        Compress an encoded object.
+
+        :param bytes data: The result of ``encode``.
+
+        :return bytes: The compressed data, marked with
+            ``_COMPRESSED_PREFIX``.
+        """
+        if self._cache is None:
+            return _COMPRESSED_PREFIX + compress(data)
+        key = (_COMPRESSED_PREFIX, id(data))
+        cached = self._cache.get(key)
+        if cached is None:
+            cached = self._cache[key] = (
+                data, _COMPRESSED_PREFIX + compress(data))
+        return cached[1]
+
+    @contextmanager
+    def cache(self):
+        """
+        Cache encoded objects for the duration of the context.
+
+        The objects are immutable, so the cache is only limited in time in
+        order to bound its memory usage.  Nested uses share the outermost
+        cache.
+        """
+        if self._cache is not None:
+            yield
+            return
+        self._cache = {}
+        try:
+            yield
+        finally:
+            self._cache = None
+
+
+def _compact_encode(obj):
+    """
+    Encode an object using ``compact_wire_encode``, marked with
+    ``_COMPACT_PREFIX``.
+
+    :param obj: An object from the configuration model.
+
+    :return bytes: The encoded object.
+    """
+    return _COMPACT_PREFIX + compact_wire_encode(obj)
+
+
+_caching_encoder = _CachingEncoder()
+
+
+class PayloadStatistics(object):
+    """
+    Count the bytes of serialized configuration and state sent, before and
+    after compression.
+
+    :ivar int raw_bytes: The total length of the values before compression.
+    :ivar int sent_bytes: The total length of the values actually sent.
+    :ivar int compressed: The number of values which were compressed.
+    """
+    def __init__(self, parent=None):
+        """
+        :param parent: A ``PayloadStatistics`` which also counts everything
+            counted by this one, or ``None``.
+        """
+        self._parent = parent
+        self.raw_bytes = 0
+        self.sent_bytes = 0
+        self.compressed = 0
+
+    def record(self, raw_length, sent_length):
+        """
+        Count a value which was sent.
+
+        :param int raw_length: The length of the value before compression.
+        :param int sent_length: The length of the value as sent.
+        """
+        self.raw_bytes += raw_length
+        self.sent_bytes += sent_length
+        if sent_length != raw_length:
+            self.compressed += 1
+        if self._parent is not None:
+            self._parent.record(raw_length, sent_length)
+
+
+def _split_value(name, strings):
+    """
+    Split a value in an AMP box which is too long to be sent into chunks
+    stored under the keys ``name``, ``name.2``, ``name.3`` and so on.
+
+    :param bytes name: The key of the value.
+    :param dict strings: The AMP box.
+    """
+    value = strings.get(name)
+    if value is None or len(value) <= MAX_VALUE_LENGTH:
+        return
+    strings[name] = value[:MAX_VALUE_LENGTH]
+    for number, start in enumerate(
+            range(MAX_VALUE_LENGTH, len(value), MAX_VALUE_LENGTH), 2):
+        strings[b"%s.%d" % (name, number)] = value[
+            start:start + MAX_VALUE_LENGTH]
+
+
+def _join_value(name, strings):
+    """
+    Reassemble a value split by ``_split_value``.
+
+    :param bytes name: The key of the value.
+    :param dict strings: The AMP box, which is modified to have the whole
+        value under ``name``.
+    """
+    chunks = []
+    number = 2
+    while b"%s.%d" % (name, number) in strings:
+        chunks.append(strings.pop(b"%s.%d" % (name, number)))
+        number += 1
+    if chunks:
+        strings[name] = b"".join([strings[name]] + chunks)
 
 
 class SerializableArgument(Argument):
     """
     AMP argument that takes an object that can be serialized by the
     configuration persistence layer.
+
+    Encoding goes through ``_caching_encoder`` so objects sent to many
+    connections at once are only encoded once.  The compact encoding and
+    compression of large values are used if the other side of the
+    connection supports them, and if it supports ``LARGE_VALUES`` values too
+    long for AMP are split across several keys.  Sent values are counted by
+    the ``payload_statistics`` of the protocol, if it has one.
+
+    Values in the compact encoding are only accepted from connections which
+    negotiated it, and are only decoded without checks if they come from the
+    control service.
     """
     def __init__(self, *classes):
         """
@@ -56,8 +321,30 @@ class SerializableArgument(Argument):
         Argument.__init__(self)
         self._expected_classes = classes
 
+    def fromBox(self, name, strings, objects, proto):
+        _join_value(name, strings)
+        Argument.fromBox(self, name, strings, objects, proto)
+
+    def toBox(self, name, strings, objects, proto):
+        Argument.toBox(self, name, strings, objects, proto)
+        if _peer_supports(proto, LARGE_VALUES):
+            _split_value(name, strings)
+
     def fromString(self, in_bytes):
-        obj = wire_decode(in_bytes)
+        return self.fromStringProto(in_bytes, None)
+
+    def fromStringProto(self, in_bytes, proto):
+        if in_bytes.startswith(_COMPRESSED_PREFIX):
+            in_bytes = decompress(in_bytes[len(_COMPRESSED_PREFIX):])
+        if in_bytes.startswith(_COMPACT_PREFIX):
+            if not _peer_supports(proto, COMPACT_ENCODING):
+                raise ValueError(
+                    "The compact encoding wasn't negotiated on this "
+                    "connection")
+            obj = compact_wire_decode(
+                in_bytes[len(_COMPACT_PREFIX):], trusted=_peer_trusted(proto))
+        else:
+            obj = wire_decode(in_bytes)
         if not isinstance(obj, self._expected_classes):
             raise TypeError(
                 "{} is none of {}".format(obj, self._expected_classes)
@@ -65,11 +352,83 @@ class SerializableArgument(Argument):
         return obj
 
     def toString(self, obj):
+        return self.toStringProto(obj, None)
+
+    def toStringProto(self, obj, proto):
         if not isinstance(obj, self._expected_classes):
             raise TypeError(
                 "{} is none of {}".format(obj, self._expected_classes)
             )
-        return wire_encode(obj)
+        data = _caching_encoder.encode(
+            obj, compact=_peer_supports(proto, COMPACT_ENCODING))
+        raw_length = len(data)
+        if (raw_length >= _COMPRESSION_THRESHOLD and
+                _peer_supports(proto, ZLIB_COMPRESSION)):
+            data = _caching_encoder.compress(data)
+        statistics = getattr(proto, "payload_statistics", None)
+        if statistics is not None:
+            statistics.record(raw_length, len(data))
+        return data
+
+
+class _SerializableListArgument(ListOf):
+    """
+    AMP argument that takes a list of objects that can be serialized by the
+    configuration persistence layer.
+
+    Unlike ``ListOf`` the compact encoding and compression are used if the
+    other side of the connection supports them.  If it supports
+    ``LARGE_VALUES`` items are prefixed with 32-bit rather than 16-bit
+    lengths, and lists too long for AMP are split across several keys.
+    """
+    def __init__(self, *classes):
+        """
+        :param *classes: The type or types of the objects we expect to
+            (de)serialize.
+        """
+        ListOf.__init__(self, SerializableArgument(*classes))
+
+    def fromBox(self, name, strings, objects, proto):
+        _join_value(name, strings)
+        ListOf.fromBox(self, name, strings, objects, proto)
+
+    def toBox(self, name, strings, objects, proto):
+        ListOf.toBox(self, name, strings, objects, proto)
+        if _peer_supports(proto, LARGE_VALUES):
+            _split_value(name, strings)
+
+    def fromString(self, in_bytes):
+        return self.fromStringProto(in_bytes, None)
+
+    def fromStringProto(self, in_bytes, proto):
+        if in_bytes.startswith(_WIDE_LIST_PREFIX):
+            position = len(_WIDE_LIST_PREFIX)
+            length_format = "!I"
+        else:
+            position = 0
+            length_format = "!H"
+        length_size = calcsize(length_format)
+        result = []
+        while position < len(in_bytes):
+            [length] = unpack_from(length_format, in_bytes, position)
+            position += length_size
+            result.append(self.elementType.fromStringProto(
+                in_bytes[position:position + length], proto))
+            position += length
+        return result
+
+    def toStringProto(self, objs, proto):
+        if _peer_supports(proto, LARGE_VALUES):
+            strings = [_WIDE_LIST_PREFIX]
+            length_format = "!I"
+        else:
+            strings = []
+            length_format = "!H"
+        for obj in objs:
+            serialized = self.elementType.toStringProto(obj, proto)
+            strings.append(pack(length_format, len(serialized)))
+            strings.append(serialized)
+        return b"".join(strings)
 
 
 class _EliotActionArgument(Unicode):
@@ -90,9 +449,15 @@ class VersionCommand(Command):
     Return configuration protocol version of the control service.
 
     Semantic versioning: Major version changes implies incompatibility.
+
+    Agents pass the optional protocol features they support as
+    ``capabilities``, and the control service responds with the ones it
+    supports.  Versions which predate this ignore the argument and omit it
+    from the response.
     """
-    arguments = []
-    response = [('major', Integer())]
+    arguments = [('capabilities', ListOf(Unicode(), optional=True))]
+    response = [('major', Integer()),
+                ('capabilities', ListOf(Unicode(), optional=True))]
 
 
 class ClusterStatusCommand(Command):
@@ -105,8 +470,36 @@ class ClusterStatusCommand(Command):
     """
     arguments = [('configuration', SerializableArgument(Deployment)),
                  ('state', SerializableArgument(DeploymentState)),
+                 ('generation', Integer(optional=True)),
+                 ('eliot_context', _EliotActionArgument())]
+    # Agents that understand ``ClusterStatusDiffCommand`` respond with the
+    # generation they were sent:
+    response = [('generation', Integer(optional=True))]
+
+
+class GenerationMismatch(Exception):
+    """
+    A convergence agent was sent a diff starting from a generation other
+    than the one it last received.
+    """
+
+
+class ClusterStatusDiffCommand(Command):
+    """
+    Used by the control service to inform a convergence agent of the changes
+    to cluster state and desired configuration since the generation it was
+    last sent.
+
+    An agent which does not have ``start_generation`` fails the command
+    with ``GenerationMismatch``.
+    """
+    arguments = [('start_generation', Integer()),
+                 ('end_generation', Integer()),
+                 ('configuration_diff', SerializableArgument(DeploymentDiff)),
+                 ('state_diff', SerializableArgument(DeploymentStateDiff)),
                  ('eliot_context', _EliotActionArgument())]
     response = []
+    errors = {GenerationMismatch: b"GENERATION_MISMATCH"}
 
 
 class NodeStateCommand(Command):
@@ -115,8 +508,8 @@ class NodeStateCommand(Command):
     status of a particular node.
     """
     arguments = [
-        ('state_changes', ListOf(
-            SerializableArgument(NodeState, NonManifestDatasets))),
+        ('state_changes', _SerializableListArgument(
+            NodeState, NonManifestDatasets)),
         ('eliot_context', _EliotActionArgument())]
     response = []
 
@@ -125,21 +518,38 @@ class ControlServiceLocator(CommandLocator):
     """
     Control service side of the protocol.
     """
-    def __init__(self, control_amp_service):
+    def __init__(self, control_amp_service, connection=None):
         """
         :param ControlAMPService control_amp_service: The service managing AMP
              connections to the control service.
+        :param ControlAMP connection: The connection commands are received
+            on, or ``None`` if unknown.
         """
         CommandLocator.__init__(self)
         self.control_amp_service = control_amp_service
+        self.connection = connection
 
     @property
     def logger(self):
         return self.control_amp_service.logger
 
+    @property
+    def peer_capabilities(self):
+        """
+        The optional protocol features negotiated on the connection, used
+        when decoding the arguments of commands received on it.
+        """
+        if self.connection is None:
+            return frozenset()
+        return self.connection.peer_capabilities
+
     @VersionCommand.responder
-    def version(self):
-        return {"major": 1}
+    def version(self, capabilities):
+        if self.connection is not None and capabilities is not None:
+            self.connection.peer_capabilities = CAPABILITIES.intersection(
+                capabilities)
+            self.control_amp_service.negotiated(self.connection)
+        return {"major": 1, "capabilities": sorted(CAPABILITIES)}
 
     @NodeStateCommand.responder
     def node_changed(self, eliot_context, state_changes):
@@ -151,14 +561,23 @@ class ControlServiceLocator(CommandLocator):
 class ControlAMP(AMP):
     """
     AMP protocol for control service server.
+
+    :ivar frozenset peer_capabilities: The optional protocol features
+        supported by the agent, as sent using ``VersionCommand``.
+    :ivar PayloadStatistics payload_statistics: Counts the serialized
+        configuration and state sent to the agent.
     """
     def __init__(self, control_amp_service):
         """
         :param ControlAMPService control_amp_service: The service managing AMP
              connections to the control service.
         """
-        AMP.__init__(self, locator=ControlServiceLocator(control_amp_service))
+        AMP.__init__(self, locator=ControlServiceLocator(
+            control_amp_service, self))
         self.control_amp_service = control_amp_service
+        self.peer_capabilities = frozenset()
+        self.payload_statistics = PayloadStatistics(
+            control_amp_service.payload_statistics)
 
     def connectionMade(self):
         AMP.connectionMade(self)
@@ -169,10 +588,9 @@ class ControlAMP(AMP):
         self.control_amp_service.disconnected(self)
 
 
-DEPLOYMENT_CONFIG = Field(u"configuration", repr,
-                          u"The cluster configuration")
-CLUSTER_STATE = Field(u"state", repr,
-                      u"The cluster state")
+DEPLOYMENT_CONFIG = state_field(u"configuration",
+                                u"The cluster configuration")
+CLUSTER_STATE = state_field(u"state", u"The cluster state")
 
 LOG_SEND_CLUSTER_STATE = ActionType(
     "flocker:controlservice:send_cluster_state",
@@ -188,62 +606,292 @@ LOG_SEND_TO_AGENT = ActionType(
     [],
     "Send the configuration and state of the cluster to a specific agent.")
 
+LOG_COALESCED_BROADCAST = MessageType(
+    "flocker:controlservice:coalesced_broadcast",
+    [Field.for_types(u"coalesced", [int],
+                     u"The number of broadcast requests which were merged "
+                     u"into this broadcast.")],
+    "Changes to the configuration or state of the cluster are being "
+    "broadcast to all agents.")
+
+LOG_PAYLOAD_STATISTICS = MessageType(
+    "flocker:controlservice:payload_statistics",
+    [Field.for_types(u"raw_bytes", [int, long],
+                     u"The length of the serialized configuration and state "
+                     u"sent by this broadcast, before compression."),
+     Field.for_types(u"sent_bytes", [int, long],
+                     u"The length of what this broadcast actually sent."),
+     Field.for_types(u"total_raw_bytes", [int, long],
+                     u"The length before compression of everything sent "
+                     u"since the control service started."),
+     Field.for_types(u"total_sent_bytes", [int, long],
+                     u"The length of everything actually sent since the "
+                     u"control service started.")],
+    "The amount of serialized configuration and state sent to agents, so "
+    "the bandwidth saved by compression can be seen.")
+
+
+class _BroadcastScheduler(object):
+    """
+    Coalesce requests to broadcast the cluster configuration and state.
+
+    A broadcast happens once no further requests have arrived for ``window``
+    seconds, or ``max_latency`` seconds after the first request it
+    includes, whichever is sooner.  Since the broadcast sends whatever is
+    current when it happens, a burst of changes results in a single
+    broadcast of the latest configuration and state.
+
+    :ivar int requests: The total number of broadcasts requested.
+    :ivar int broadcasts: The total number of broadcasts made.
+    :ivar int coalesced: The total number of requests which were merged
+        into a broadcast already scheduled by an earlier request.
+    """
+    logger = Logger()
+
+    def __init__(self, reactor, broadcast, window, max_latency):
+        """
+        :param reactor: An ``IReactorTime`` provider.
+        :param broadcast: A callable taking no arguments which does the
+            broadcast.
+        :param float window: Seconds to wait for further requests before
+            broadcasting.
+        :param float max_latency: The longest time, in seconds, a request
+            can be delayed by subsequent requests.
+        """
+        self._reactor = reactor
+        self._broadcast = broadcast
+        self._window = window
+        self._max_latency = max_latency
+        self._call = None
+        self._deadline = None
+        self._pending = 0
+        self.requests = 0
+        self.broadcasts = 0
+        self.coalesced = 0
+
+    def schedule(self):
+        """
+        Request a broadcast.
+        """
+        self.requests += 1
+        now = self._reactor.seconds()
+        if self._call is None:
+            self._deadline = now + self._max_latency
+            self._call = self._reactor.callLater(
+                min(self._window, self._max_latency), self._fire)
+        else:
+            self.coalesced += 1
+            self._pending += 1
+            self._call.reset(max(0, min(now + self._window,
+                                        self._deadline) - now))
+
+    def cancel(self):
+        """
+        Discard any scheduled broadcast.
+        """
+        if self._call is not None:
+            self._call.cancel()
+            self._call = None
+            self._pending = 0
+
+    def _fire(self):
+        """
+        Do a scheduled broadcast.
+        """
+        self._call = None
+        coalesced, self._pending = self._pending, 0
+        self.broadcasts += 1
+        LOG_COALESCED_BROADCAST(coalesced=coalesced).write(self.logger)
+        self._broadcast()
+
 
 class ControlAMPService(Service):
     """
     Control Service AMP server.
 
     Convergence agents connect to this server.
+
+    :ivar int generation_history: The number of past generations of
+        configuration and state to remember so that agents can be sent
+        diffs rather than full snapshots.
+    :ivar _BroadcastScheduler broadcast_scheduler: Coalesces changes to
+        the configuration and state into broadcasts to all agents.
+    :ivar PayloadStatistics payload_statistics: Counts the serialized
+        configuration and state sent to all agents.
     """
     logger = Logger()
 
-    def __init__(self, cluster_state, configuration_service, endpoint):
+    generation_history = 20
+
+    def __init__(self, reactor, cluster_state, configuration_service,
+                 endpoint, broadcast_window=0.1, broadcast_max_latency=1.0):
         """
+        :param reactor: See ``ConfigurationPersistenceService.__init__``.
         :param ClusterStateService cluster_state: Object that records known
             cluster state.
         :param ConfigurationPersistenceService configuration_service:
             Persistence service for desired cluster configuration.
         :param endpoint: Endpoint to listen on.
+        :param float broadcast_window: Seconds to wait for further changes
+            before broadcasting a change to all agents.
+        :param float broadcast_max_latency: The longest time, in seconds,
+            a change can wait before being broadcast.
         """
+        self._reactor = reactor
         self.connections = set()
+        self.payload_statistics = PayloadStatistics()
         self.cluster_state = cluster_state
         self.configuration_service = configuration_service
         self.endpoint_service = StreamServerEndpointService(
             endpoint, ServerFactory.forProtocol(lambda: ControlAMP(self)))
+        # The latest generation, and a mapping from recent generations to
+        # the configuration and state they correspond to:
+        self._generation = 0
+        self._generations = OrderedDict()
+        # Connections whose agents understand ClusterStatusDiffCommand:
+        self._diff_capable = set()
+        # The generation most recently sent to each connection:
+        self._sent_generations = {}
+        # Connections which couldn't be sent the configuration and state
+        # because they were too long for AMP:
+        self._too_long = set()
+        self.broadcast_scheduler = _BroadcastScheduler(
+            reactor, lambda: self._send_state_to_connections(self.connections),
+            broadcast_window, broadcast_max_latency)
         # When configuration changes, notify all connected clients:
         self.configuration_service.register(
-            lambda: self._send_state_to_connections(self.connections))
+            self.broadcast_scheduler.schedule)
 
     def startService(self):
         self.endpoint_service.startService()
 
     def stopService(self):
+        self.broadcast_scheduler.cancel()
         self.endpoint_service.stopService()
         for connection in self.connections:
             connection.transport.loseConnection()
 
+    def _current_generation(self):
+        """
+        Number the current configuration and cluster state, if they differ
+        from the latest generation.
+
+        :return: Tuple of the generation as an ``int``, the ``Deployment``
+            and the ``DeploymentState``.
+        """
+        configuration = self.configuration_service.get()
+        state = self.cluster_state.as_deployment()
+        latest = self._generations.get(self._generation)
+        if (latest is None or latest[0] is not configuration or
+                latest[1] is not state):
+            self._generation += 1
+            self._generations[self._generation] = (configuration, state)
+            while len(self._generations) > self.generation_history:
+                self._generations.popitem(last=False)
+        return self._generation, configuration, state
+
     def _send_state_to_connections(self, connections):
         """
         Send desired configuration and cluster state to all given connections.
 
+        Connections which have been sent a recent generation are only sent
+        the changes since then.  Connections which are already up to date
+        are sent nothing.
+
         :param connections: A collection of ``AMP`` instances.
         """
-        configuration = self.configuration_service.get()
-        state = self.cluster_state.as_deployment()
+        generation, configuration, state = self._current_generation()
+        # Diffs keyed by the generation they start from, since many agents
+        # will typically be at the same generation:
+        diffs = {}
+        statistics = self.payload_statistics
+        raw_bytes, sent_bytes = statistics.raw_bytes, statistics.sent_bytes
         with LOG_SEND_CLUSTER_STATE(self.logger,
                                     configuration=configuration,
-                                    state=state):
+                                    state=state), _caching_encoder.cache():
             for connection in connections:
+                start_generation = self._sent_generations.get(connection)
+                if start_generation == generation:
+                    continue
                 action = LOG_SEND_TO_AGENT(self.logger, agent=connection)
                 with action.context():
-                    d = DeferredContext(connection.callRemote(
-                        ClusterStatusCommand,
-                        configuration=configuration,
-                        state=state,
-                        eliot_context=action
-                    ))
+                    if start_generation in self._generations:
+                        if start_generation not in diffs:
+                            old_configuration, old_state = self._generations[
+                                start_generation]
+                            diffs[start_generation] = (
+                                diff_deployments(
+                                    old_configuration, configuration),
+                                diff_deployment_states(old_state, state),
+                            )
+                        configuration_diff, state_diff = diffs[
+                            start_generation]
+                        sending = maybeDeferred(
+                            connection.callRemote,
+                            ClusterStatusDiffCommand,
+                            start_generation=start_generation,
+                            end_generation=generation,
+                            configuration_diff=configuration_diff,
+                            state_diff=state_diff,
+                            eliot_context=action
+                        )
+                    else:
+                        sending = maybeDeferred(
+                            connection.callRemote,
+                            ClusterStatusCommand,
+                            configuration=configuration,
+                            state=state,
+                            generation=generation,
+                            eliot_context=action
+                        )
+                        sending.addCallback(self._snapshot_sent, connection)
+                    if connection in self._diff_capable:
+                        self._sent_generations[connection] = generation
+                    d = DeferredContext(sending)
                     d.addActionFinish()
-                    d.result.addErrback(lambda _: None)
+                    d.result.addErrback(self._send_failed, connection)
+            if statistics.raw_bytes != raw_bytes:
+                LOG_PAYLOAD_STATISTICS(
+                    raw_bytes=statistics.raw_bytes - raw_bytes,
+                    sent_bytes=statistics.sent_bytes - sent_bytes,
+                    total_raw_bytes=statistics.raw_bytes,
+                    total_sent_bytes=statistics.sent_bytes,
+                ).write(self.logger)
+
+    def _snapshot_sent(self, response, connection):
+        """
+        A ``ClusterStatusCommand`` was acknowledged by an agent.
+
+        :param response: The response to the command.
+        :param ControlAMP connection: The connection the command was sent on.
+        """
+        if connection not in self.connections:
+            return response
+        generation = (response or {}).get("generation")
+        if generation is not None:
+            self._diff_capable.add(connection)
+            if self._sent_generations.get(connection, 0) < generation:
+                self._sent_generations[connection] = generation
+        return response
+
+    def _send_failed(self, reason, connection):
+        """
+        Sending cluster status to an agent failed.
+
+        We no longer know what the agent was sent, so the next update it
+        gets will be a full snapshot.  If it had simply missed the
+        generation a diff was based on, that snapshot is sent immediately.
+        If it was too long to send, it is sent again once the agent has
+        negotiated support for long values.
+
+        :param Failure reason: Why sending failed.
+        :param ControlAMP connection: The connection the command was sent on.
+        """
+        self._sent_generations.pop(connection, None)
+        if reason.check(TooLong):
+            self._too_long.add(connection)
+        if reason.check(GenerationMismatch) and connection in self.connections:
+            self._send_state_to_connections([connection])
 
     def connected(self, connection):
         """
@@ -254,6 +902,34 @@ class ControlAMPService(Service):
         self.connections.add(connection)
         self._send_state_to_connections([connection])
 
+    def negotiated(self, connection):
+        """
+        The optional protocol features to use on a connection have been
+        negotiated.
+
+        Agents are sent the configuration and state as soon as they
+        connect, before this happens, so if that failed because they were
+        too long they are sent again.  This is called while the agent is
+        still waiting for the response to ``VersionCommand``, and the agent
+        only accepts the negotiated features once it has the response, so
+        they are sent again on a later turn of the reactor.
+
+        :param ControlAMP connection: The connection.
+        """
+        if connection in self._too_long:
+            self._reactor.callLater(0, self._resend, connection)
+
+    def _resend(self, connection):
+        """
+        Send the configuration and state to a connection again, if it is
+        still waiting for them.
+
+        :param ControlAMP connection: The connection.
+        """
+        if connection in self._too_long and connection in self.connections:
+            self._too_long.discard(connection)
+            self._send_state_to_connections([connection])
+
     def disconnected(self, connection):
         """
         An existing connection has been disconnected.
@@ -261,6 +937,9 @@ class ControlAMPService(Service):
         :param ControlAMP connection: The lost connection.
         """
         self.connections.remove(connection)
+        self._diff_capable.discard(connection)
+        self._sent_generations.pop(connection, None)
+        self._too_long.discard(connection)
 
     def node_changed(self, state_changes):
         """
@@ -270,8 +949,10 @@ class ControlAMPService(Service):
         :param list state_changes: One or more ``IClusterStateChange``
             providers representing the state change which has taken place.
         """
-        self.cluster_state.apply_changes(state_changes)
-        self._send_state_to_connections(self.connections)
+        # Agents report their full state regularly, and most reports don't
+        # change anything, so only broadcast actual changes:
+        if self.cluster_state.apply_changes(state_changes):
+            self.broadcast_scheduler.schedule()
 
 
 class IConvergenceAgent(Interface):
@@ -310,13 +991,30 @@ class IConvergenceAgent(Interface):
 class _AgentLocator(CommandLocator):
     """
     Command locator for convergence agent.
+
+    :ivar peer_trusted: Values received from the control service are decoded
+        without checking them.
+    :ivar _configuration: The ``Deployment`` most recently received from the
+        control service, or ``None``.
+    :ivar _state: The ``DeploymentState`` most recently received from the
+        control service, or ``None``.
+    :ivar _generation: The generation of ``_configuration`` and ``_state``,
+        or ``None`` if unknown.
     """
-    def __init__(self, agent):
+    peer_trusted = True
+
+    def __init__(self, agent, connection=None):
         """
         :param IConvergenceAgent agent: Convergence agent to notify of changes.
+        :param AgentAMP connection: The connection commands are received
+            on, or ``None`` if unknown.
         """
         CommandLocator.__init__(self)
         self.agent = agent
+        self.connection = connection
+        self._configuration = None
+        self._state = None
+        self._generation = None
 
     @property
     def logger(self):
@@ -325,10 +1023,40 @@ class _AgentLocator(CommandLocator):
         """
         return self.agent.logger
 
+    @property
+    def peer_capabilities(self):
+        """
+        The optional protocol features negotiated on the connection, used
+        when decoding the arguments of commands received on it.
+        """
+        if self.connection is None:
+            return frozenset()
+        return self.connection.peer_capabilities
+
     @ClusterStatusCommand.responder
-    def cluster_updated(self, eliot_context, configuration, state):
+    def cluster_updated(self, eliot_context, configuration, state,
+                        generation):
         with eliot_context:
+            self._configuration = configuration
+            self._state = state
+            self._generation = generation
             self.agent.cluster_updated(configuration, state)
+            return {"generation": generation}
+
+    @ClusterStatusDiffCommand.responder
+    def cluster_updated_diff(self, eliot_context, start_generation,
+                             end_generation, configuration_diff, state_diff):
+        with eliot_context:
+            if self._generation is None or (
+                    self._generation != start_generation):
+                raise GenerationMismatch(
+                    "Have generation {}, diff starts from {}".format(
+                        self._generation, start_generation))
+            self._configuration = configuration_diff.apply(
+                self._configuration)
+            self._state = state_diff.apply(self._state)
+            self._generation = end_generation
+            self.agent.cluster_updated(self._configuration, self._state)
             return {}
 
 
@@ -337,19 +1065,41 @@ class AgentAMP(AMP):
     AMP protocol for convergence agent side of the protocol.
 
     This is the client protocol that will connect to the control service.
+
+    :ivar frozenset peer_capabilities: The optional protocol features
+        supported by both the control service and this agent.
+    :ivar PayloadStatistics payload_statistics: Counts the serialized state
+        sent to the control service.
     """
     def __init__(self, agent):
         """
         :param IConvergenceAgent agent: Convergence agent to notify of changes.
         """
-        locator = _AgentLocator(agent)
+        locator = _AgentLocator(agent, self)
         AMP.__init__(self, locator=locator)
         self.agent = agent
+        self.peer_capabilities = frozenset()
+        self.payload_statistics = PayloadStatistics()
 
     def connectionMade(self):
         AMP.connectionMade(self)
+        negotiating = self.callRemote(
+            VersionCommand, capabilities=sorted(CAPABILITIES))
+        negotiating.addCallback(self._negotiated)
+        negotiating.addErrback(
+            writeFailure, self.agent.logger, u"flocker:agent:version")
         self.agent.connected(self)
 
+    def _negotiated(self, response):
+        """
+        The control service has told us which optional protocol features it
+        supports.
+
+        :param dict response: The response to ``VersionCommand``.
+        """
+        self.peer_capabilities = CAPABILITIES.intersection(
+            response["capabilities"] or ())
+
     def connectionLost(self, reason):
         AMP.connectionLost(self, reason)
         self.agent.disconnected()
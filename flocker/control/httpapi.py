@@ -4,14 +4,19 @@ A HTTP REST API for controlling the Dataset Manager.
 """
 
 import yaml
+from time import time
 from uuid import uuid4, UUID
 
 from pyrsistent import pmap, thaw
 
+from eliot import ActionType, Field, Logger
+
 from twisted.python.filepath import FilePath
+from twisted.internet.defer import Deferred, succeed, CancelledError
+from twisted.internet.threads import deferToThreadPool
 from twisted.web.http import (
     CONFLICT, CREATED, NOT_FOUND, OK, NOT_ALLOWED as METHOD_NOT_ALLOWED,
-    BAD_REQUEST
+    BAD_REQUEST, SERVICE_UNAVAILABLE, PRECONDITION_FAILED
 )
 from twisted.web.server import Site
 from twisted.web.resource import Resource
@@ -22,12 +27,14 @@ from klein import Klein
 from pyrsistent import discard
 
 from ..restapi import (
-    EndpointResponse, structured, user_documentation, make_bad_request
+    EndpointResponse, structured, user_documentation, make_bad_request,
+    versioned, BadRequest,
 )
 from . import (
     Dataset, Manifestation, Application, DockerImage, Port,
     AttachedVolume, Link
 )
+from ._index import DeploymentIndex
 from ._config import (
     ApplicationMarshaller, FLOCKER_RESTART_POLICY_NAME_TO_POLICY,
     model_from_configuration, FigConfiguration, FlockerConfiguration,
@@ -77,10 +84,185 @@ DATASET_ON_DIFFERENT_NODE = make_bad_request(
 DATASET_IN_USE = make_bad_request(
     code=CONFLICT,
     description=u"The dataset is being used by another container.")
+CONFIGURATION_TIMED_OUT = make_bad_request(
+    code=SERVICE_UNAVAILABLE,
+    description=u"The configuration took too long to process.")
+CONFIGURATION_CHANGED = make_bad_request(
+    code=PRECONDITION_FAILED,
+    description=u"The configuration changed while it was being processed.")
 
 
 _UNDEFINED_MAXIMUM_SIZE = object()
 
+# The largest configuration accepted from flocker-deploy, in bytes of JSON:
+_MAXIMUM_COMPOSE_SIZE = 10 * 1024 * 1024
+
+# The longest time, in seconds, turning a configuration from flocker-deploy
+# into a ``Deployment`` may take:
+_COMPOSE_TIMEOUT = 60
+
+_LOG_PARSE_CONFIGURATION = ActionType(
+    u"flocker-control:api:parse_configuration",
+    [],
+    [Field.forTypes(u"parse_time", [float],
+                    u"The time taken to parse, in seconds, not including "
+                    u"waiting for a thread.")],
+    u"A configuration from flocker-deploy was parsed in a thread.")
+
+# Listings can be large enough that validating them costs more than building
+# them, so when output validation is sampled only this fraction of them is
+# checked:
+_LISTING_VALIDATION_RATE = 0.1
+
+
+class _ChangeWatcher(object):
+    """
+    Let requests wait for a service to report a change.
+
+    :ivar list _waiting: ``Deferred``\ s to fire at the next change.
+    """
+    def __init__(self, reactor, service):
+        """
+        :param reactor: An ``IReactorTime`` provider.
+        :param service: A ``ConfigurationPersistenceService`` or
+            ``ClusterStateService`` whose changes to watch.
+        """
+        self._reactor = reactor
+        self._waiting = []
+        service.register(self._changed)
+
+    def _changed(self):
+        """
+        The service has changed, so stop waiting.
+        """
+        waiting, self._waiting = self._waiting, []
+        for d in waiting:
+            d.callback(None)
+
+    def wait(self, timeout):
+        """
+        Wait for the next change.
+
+        :param timeout: The longest time to wait, in seconds.
+
+        :return Deferred: Fires with ``None`` at the next change or once the
+            timeout has passed, whichever is sooner.
+        """
+        waiting = Deferred(canceller=self._waiting.remove)
+        self._waiting.append(waiting)
+        timing_out = self._reactor.callLater(
+            timeout, self._timed_out, waiting)
+
+        def finished(result):
+            if timing_out.active():
+                timing_out.cancel()
+            return result
+        waiting.addBoth(finished)
+        return waiting
+
+    def _timed_out(self, waiting):
+        """
+        Stop waiting because the timeout has passed.
+
+        :param Deferred waiting: The result of ``wait``.
+        """
+        self._waiting.remove(waiting)
+        waiting.callback(None)
+
+
+def _query_uuid(value):
+    """
+    Parse an optional UUID query argument.
+
+    :param unicode value: The argument, or ``None`` if it wasn't given.
+
+    :return: A ``UUID``, or ``None``.
+    """
+    if value is None:
+        return None
+    return UUID(value)
+
+
+def _query_integer(value):
+    """
+    Parse an optional integer query argument.
+
+    :param unicode value: The argument, or ``None`` if it wasn't given.
+
+    :return: An ``int``, or ``None``.
+    """
+    if value is None:
+        return None
+    return int(value)
+
+
+def _query_boolean(value):
+    """
+    Parse an optional boolean query argument.
+
+    :param unicode value: The argument (``u"true"`` or ``u"false"``), or
+        ``None`` if it wasn't given.
+
+    :return: A ``bool``, or ``None``.
+    """
+    if value is None:
+        return None
+    return value == u"true"
+
+
+def _configuration_version(api):
+    """
+    Get the version of the cluster configuration, used to tag responses
+    from the ``/configuration`` endpoints.
+
+    :param ConfigurationAPIUserV1 api: The API.
+
+    :return unicode: The version.
+    """
+    return api.persistence_service.get_version()
+
+
+def _wait_for_configuration_change(api, timeout):
+    """
+    Wait for the cluster configuration to change.
+
+    :param ConfigurationAPIUserV1 api: The API.
+    :param timeout: The longest time to wait, in seconds.
+
+    :return Deferred: See ``_ChangeWatcher.wait``.
+    """
+    if api._configuration_watcher is None:
+        api._configuration_watcher = _ChangeWatcher(
+            api._reactor, api.persistence_service)
+    return api._configuration_watcher.wait(timeout)
+
+
+def _state_version(api):
+    """
+    Get the version of the cluster state, used to tag responses from the
+    ``/state`` endpoints.
+
+    :param ConfigurationAPIUserV1 api: The API.
+
+    :return unicode: The version.
+    """
+    return api.cluster_state_service.get_version()
+
+
+def _wait_for_state_change(api, timeout):
+    """
+    Wait for the cluster state to change.
+
+    :param ConfigurationAPIUserV1 api: The API.
+    :param timeout: The longest time to wait, in seconds.
+
+    :return Deferred: See ``_ChangeWatcher.wait``.
+    """
+    if api._state_watcher is None:
+        api._state_watcher = _ChangeWatcher(
+            api._reactor, api.cluster_state_service)
+    return api._state_watcher.wait(timeout)
+
 
 class ConfigurationAPIUserV1(object):
     """
@@ -91,17 +273,51 @@ class ConfigurationAPIUserV1(object):
     durable but has not yet been deployed onto the cluster.
     """
     app = Klein()
+    logger = Logger()
 
-    def __init__(self, persistence_service, cluster_state_service):
+    def __init__(self, persistence_service, cluster_state_service,
+                 reactor=None, threadpool=None):
         """
         :param ConfigurationPersistenceService persistence_service: Service
             for retrieving and setting desired configuration.
 
         :param ClusterStateService cluster_state_service: Service that
             knows about the current state of the cluster.
+
+        :param reactor: The ``IReactorTime`` provider used to time out
+            requests waiting for changes, or ``None`` to use the global
+            reactor.
+
+        :param threadpool: The ``ThreadPool`` in which configurations from
+            flocker-deploy are parsed, or ``None`` to use the reactor's.
         """
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self._threadpool = threadpool
         self.persistence_service = persistence_service
         self.cluster_state_service = cluster_state_service
+        # Created when first needed:
+        self._configuration_watcher = None
+        self._state_watcher = None
+        # Mapping from u"configuration" or u"state" to the DeploymentIndex
+        # of the latest deployment listed:
+        self._indexes = {}
+
+    def _index(self, kind, deployment):
+        """
+        Get an index of a deployment, reusing the one built for the previous
+        listing if the deployment hasn't changed since.
+
+        :param unicode kind: ``u"configuration"`` or ``u"state"``.
+        :param deployment: A ``Deployment`` or ``DeploymentState``.
+
+        :return DeploymentIndex: An index of ``deployment``.
+        """
+        index = self._indexes.get(kind)
+        if index is None or index.deployment is not deployment:
+            index = self._indexes[kind] = DeploymentIndex(deployment)
+        return index
 
     @app.route("/version", methods=['GET'])
     @user_documentation("""
@@ -119,30 +335,62 @@ class ConfigurationAPIUserV1(object):
         return {u"flocker":  __version__}
 
     @app.route("/configuration/datasets", methods=['GET'])
+    @versioned(_configuration_version, _wait_for_configuration_change,
+               cache_responses=True)
     @user_documentation(
         """
         Get the cluster's dataset configuration.
+
+        Datasets are listed in order of their identifiers.  The query
+        arguments can select some of them, or one page of them.
         """,
         examples=[u"get configured datasets"],
     )
     @structured(
-        inputSchema={},
+        inputSchema={
+            '$ref':
+            '/v1/endpoints.json#/definitions/configuration_datasets_query',
+        },
         outputSchema={
             '$ref':
             '/v1/endpoints.json#/definitions/configuration_datasets_list',
         },
         schema_store=SCHEMAS,
+        output_validation_rate=_LISTING_VALIDATION_RATE,
+        query_arguments=True,
+        stream_output=True,
     )
-    def get_dataset_configuration(self):
+    def get_dataset_configuration(self, primary=None, metadata_key=None,
+                                  metadata_value=None, deleted=None,
+                                  after=None, limit=None):
         """
         Get the configured datasets.
 
-        :return: A ``list`` of ``dict`` representing each of dataset
+        :param unicode primary: If given, the UUID of the node whose primary
+            datasets to list.
+        :param unicode metadata_key: If given, only list datasets with this
+            metadata key.
+        :param unicode metadata_value: If given, only list datasets with this
+            value for ``metadata_key``.
+        :param unicode deleted: If given, ``u"true"`` to only list deleted
+            datasets or ``u"false"`` to only list datasets which aren't.
+        :param unicode after: If given, only list datasets whose identifiers
+            sort after this one.
+        :param unicode limit: If given, the number of datasets to list.
+
+        :return: An iterable of ``dict`` representing each of dataset
             that is configured to exist anywhere on the cluster.
         """
-        return list(datasets_from_deployment(self.persistence_service.get()))
+        index = self._index(u"configuration", self.persistence_service.get())
+        datasets = index.datasets(
+            primary=_query_uuid(primary), metadata_key=metadata_key,
+            metadata_value=metadata_value, deleted=_query_boolean(deleted),
+            after=after, limit=_query_integer(limit))
+        return (api_dataset_from_dataset_and_node(dataset, node.uuid)
+                for dataset, node in datasets)
 
     @app.route("/configuration/datasets", methods=['POST'])
+    @versioned(_configuration_version, _wait_for_configuration_change)
     @user_documentation(
         """
         Create a new dataset.
@@ -194,48 +442,20 @@ class ConfigurationAPIUserV1(object):
             cluster configuration or giving error information if this is not
             possible.
         """
-        if dataset_id is None:
-            dataset_id = unicode(uuid4())
-        dataset_id = dataset_id.lower()
-
-        if metadata is None:
-            metadata = {}
-
-        primary = UUID(hex=primary)
-
         # Use persistence_service to get a Deployment for the cluster
         # configuration.
-        deployment = self.persistence_service.get()
-        for node in deployment.nodes:
-            for manifestation in node.manifestations.values():
-                if manifestation.dataset.dataset_id == dataset_id:
-                    raise DATASET_ID_COLLISION
-
-        # XXX Check cluster state to determine if the given primary node
-        # actually exists.  If not, raise PRIMARY_NODE_NOT_FOUND.
-        # See FLOC-1278
-
-        dataset = Dataset(
-            dataset_id=dataset_id,
-            maximum_size=maximum_size,
-            metadata=pmap(metadata)
-        )
-        manifestation = Manifestation(dataset=dataset, primary=True)
-
-        primary_node = deployment.get_node(primary)
-
-        new_node_config = primary_node.transform(
-            ("manifestations", manifestation.dataset_id), manifestation)
-        new_deployment = deployment.update_node(new_node_config)
+        new_deployment, result = _create_dataset(
+            self.persistence_service.get(), primary, dataset_id,
+            maximum_size, metadata)
         saving = self.persistence_service.save(new_deployment)
 
         def saved(ignored):
-            result = api_dataset_from_dataset_and_node(dataset, primary)
             return EndpointResponse(CREATED, result)
         saving.addCallback(saved)
         return saving
 
     @app.route("/configuration/datasets/<dataset_id>", methods=['DELETE'])
+    @versioned(_configuration_version, _wait_for_configuration_change)
     @user_documentation(
         """
         Delete an existing dataset.
@@ -267,28 +487,18 @@ class ConfigurationAPIUserV1(object):
             information if this is not possible.
         """
         # Get the current configuration.
-        deployment = self.persistence_service.get()
-
-        # XXX this doesn't handle replicas
-        # https://clusterhq.atlassian.net/browse/FLOC-1240
-        old_manifestation, origin_node = _find_manifestation_and_node(
-            deployment, dataset_id)
-
-        new_node = origin_node.transform(
-            ("manifestations", dataset_id, "dataset", "deleted"), True)
-        deployment = deployment.update_node(new_node)
+        deployment, result = _delete_dataset(
+            self.persistence_service.get(), dataset_id)
 
         saving = self.persistence_service.save(deployment)
 
         def saved(ignored):
-            result = api_dataset_from_dataset_and_node(
-                new_node.manifestations[dataset_id].dataset, new_node.uuid,
-            )
             return EndpointResponse(OK, result)
         saving.addCallback(saved)
         return saving
 
     @app.route("/configuration/datasets/<dataset_id>", methods=['POST'])
+    @versioned(_configuration_version, _wait_for_configuration_change)
     @user_documentation(
         """
         Update an existing dataset.
@@ -329,97 +539,181 @@ class ConfigurationAPIUserV1(object):
             possible.
         """
         # Get the current configuration.
-        deployment = self.persistence_service.get()
-
-        # Raises DATASET_NOT_FOUND if the ``dataset_id`` is not found.
-        primary_manifestation, current_node = _find_manifestation_and_node(
-            deployment, dataset_id
-        )
-
-        if primary_manifestation.dataset.deleted:
-            raise DATASET_DELETED
-
-        if primary is not None:
-            deployment = _update_dataset_primary(
-                deployment, dataset_id, UUID(hex=primary)
-            )
+        deployment, result = _update_dataset(
+            self.persistence_service.get(), dataset_id, primary)
 
         saving = self.persistence_service.save(deployment)
 
-        primary_manifestation, current_node = _find_manifestation_and_node(
-            deployment, dataset_id
-        )
-
         # Return an API response dictionary containing the dataset with updated
         # primary address.
         def saved(ignored):
-            result = api_dataset_from_dataset_and_node(
-                primary_manifestation.dataset,
-                current_node.uuid,
-            )
             return EndpointResponse(OK, result)
         saving.addCallback(saved)
         return saving
 
+    @app.route("/configuration/datasets/batch", methods=['POST'])
+    @versioned(_configuration_version, _wait_for_configuration_change)
+    @user_documentation(
+        """
+        Create, update and delete many datasets at once.
+
+        The operations are applied in order, and the changes made by all the
+        successful ones are saved together.  Each operation gets a result
+        with the response code and body the equivalent individual request
+        would have had.  A failed operation doesn't prevent later ones.
+        """,
+        examples=[u"batch dataset operations"],
+    )
+    @structured(
+        inputSchema={
+            '$ref':
+            '/v1/endpoints.json#/definitions/configuration_datasets_batch'
+        },
+        outputSchema={
+            '$ref':
+            '/v1/endpoints.json#/definitions/'
+            'configuration_datasets_batch_results'
+        },
+        schema_store=SCHEMAS
+    )
+    def batch_datasets(self, operations):
+        """
+        Apply many dataset operations to the cluster configuration with one
+        save.
+
+        :param list operations: ``dict``\ s each giving an ``action`` of
+            ``u"create"``, ``u"update"`` or ``u"delete"`` and the arguments
+            of ``create_dataset_configuration``, ``update_dataset`` or
+            ``delete_dataset`` respectively.
+
+        :return: A ``dict`` whose ``results`` are ``dict``\ s giving the
+            ``code`` and ``result`` of each operation.
+        """
+        original = deployment = self.persistence_service.get()
+        results = []
+        for operation in operations:
+            arguments = operation.copy()
+            change, code = _DATASET_OPERATIONS[arguments.pop(u"action")]
+            try:
+                deployment, result = change(deployment, **arguments)
+            except BadRequest as e:
+                code, result = e.code, e.result
+            results.append({u"code": code, u"result": result})
+
+        if deployment is original:
+            saving = succeed(None)
+        else:
+            saving = self.persistence_service.save(deployment)
+        saving.addCallback(lambda ignored: {u"results": results})
+        return saving
+
     @app.route("/state/datasets", methods=['GET'])
+    @versioned(_state_version, _wait_for_state_change,
+               cache_responses=True)
     @user_documentation("""
         Get current cluster datasets.
 
         The result reflects the control service's knowledge, which may be
         out of date or incomplete. E.g. a dataset agent has not connected
         or updated the control service yet.
+
+        Datasets are listed in order of their identifiers.  The query
+        arguments can select some of them, or one page of them.
         """, examples=[u"get state datasets"])
     @structured(
-        inputSchema={},
+        inputSchema={
+            '$ref': '/v1/endpoints.json#/definitions/state_datasets_query'
+            },
         outputSchema={
             '$ref': '/v1/endpoints.json#/definitions/state_datasets_array'
             },
-        schema_store=SCHEMAS
+        schema_store=SCHEMAS,
+        output_validation_rate=_LISTING_VALIDATION_RATE,
+        query_arguments=True,
+        stream_output=True,
     )
-    def state_datasets(self):
+    def state_datasets(self, primary=None, after=None, limit=None):
         """
         Return the current primary datasets in the cluster.
 
-        :return: A ``list`` containing all datasets in the cluster.
+        :param unicode primary: If given, the UUID of the node whose primary
+            datasets to list.
+        :param unicode after: If given, only list datasets whose identifiers
+            sort after this one.
+        :param unicode limit: If given, the number of datasets to list.
+
+        :return: An iterable containing all datasets in the cluster.
         """
-        deployment_state = self.cluster_state_service.as_deployment()
-        datasets = list(datasets_from_deployment(deployment_state))
-        for dataset in datasets:
-            node_uuid = UUID(hex=dataset[u"primary"])
-            dataset[u"path"] = self.cluster_state_service.manifestation_path(
-                node_uuid, dataset[u"dataset_id"]).path.decode(
-                    "utf-8")
-            del dataset[u"metadata"]
-            del dataset[u"deleted"]
-        return datasets
+        index = self._index(
+            u"state", self.cluster_state_service.as_deployment())
+        datasets = index.datasets(
+            primary=_query_uuid(primary), after=after,
+            limit=_query_integer(limit))
+
+        # Streaming spans several turns of the reactor, so paths come from
+        # the same state as the datasets rather than the latest state:
+        def state_dataset(dataset, node):
+            result = api_dataset_from_dataset_and_node(dataset, node.uuid)
+            result[u"path"] = node.paths[dataset.dataset_id].path.decode(
+                "utf-8")
+            del result[u"metadata"]
+            del result[u"deleted"]
+            return result
+        return (state_dataset(dataset, node) for dataset, node in datasets)
 
     @app.route("/configuration/containers", methods=['GET'])
+    @versioned(_configuration_version, _wait_for_configuration_change,
+               cache_responses=True)
     @user_documentation(
         """
         Get the cluster's container configuration.
         These containers may or may not actually exist on the
         cluster.
+
+        Containers are listed in order of their names.  The query arguments
+        can select some of them, or one page of them.
         """,
         examples=[u"get configured containers"],
     )
     @structured(
-        inputSchema={},
+        inputSchema={
+            '$ref': '/v1/endpoints.json#/definitions/containers_query',
+        },
         outputSchema={
             '$ref':
             '/v1/endpoints.json#/definitions/configuration_containers_array',
         },
         schema_store=SCHEMAS,
+        output_validation_rate=_LISTING_VALIDATION_RATE,
+        query_arguments=True,
+        stream_output=True,
     )
-    def get_containers_configuration(self):
+    def get_containers_configuration(self, node_uuid=None, name_prefix=u"",
+                                     after=None, limit=None):
         """
         Get the configured containers.
 
-        :return: A ``list`` of ``dict`` representing each of the containers
-            that are configured to exist anywhere on the cluster.
+        :param unicode node_uuid: If given, the UUID of the node whose
+            containers to list.
+        :param unicode name_prefix: Only list containers whose names start
+            with this.
+        :param unicode after: If given, only list containers whose names
+            sort after this one.
+        :param unicode limit: If given, the number of containers to list.
+
+        :return: An iterable of ``dict`` representing each of the
+            containers that are configured to exist anywhere on the cluster.
         """
-        return list(containers_from_deployment(self.persistence_service.get()))
+        index = self._index(u"configuration", self.persistence_service.get())
+        containers = index.containers(
+            node_uuid=_query_uuid(node_uuid), prefix=name_prefix,
+            after=after, limit=_query_integer(limit))
+        return (container_configuration_response(application, node.uuid)
+                for application, node in containers)
 
     @app.route("/state/containers", methods=['GET'])
+    @versioned(_state_version, _wait_for_state_change,
+               cache_responses=True)
     @user_documentation(
         """
         Get the cluster's actual containers.
@@ -427,36 +721,55 @@ class ConfigurationAPIUserV1(object):
         This reflects the control service's knowledge of the cluster,
         which may be out of date or incomplete, e.g. if a container agent
         has not connected or updated the control service yet.
+
+        Containers are listed in order of their names.  The query arguments
+        can select some of them, or one page of them.
         """,
         examples=[u"get actual containers"],
     )
     @structured(
-        inputSchema={},
+        inputSchema={
+            '$ref': '/v1/endpoints.json#/definitions/containers_query',
+        },
         outputSchema={
             '$ref':
             '/v1/endpoints.json#/definitions/state_containers_array',
         },
         schema_store=SCHEMAS,
+        output_validation_rate=_LISTING_VALIDATION_RATE,
+        query_arguments=True,
+        stream_output=True,
     )
-    def get_containers_state(self):
+    def get_containers_state(self, node_uuid=None, name_prefix=u"",
+                             after=None, limit=None):
         """
         Get the containers present in the cluster.
 
-        :return: A ``list`` of ``dict`` representing each of the containers
-            that are configured to exist anywhere on the cluster.
+        :param unicode node_uuid: If given, the UUID of the node whose
+            containers to list.
+        :param unicode name_prefix: Only list containers whose names start
+            with this.
+        :param unicode after: If given, only list containers whose names
+            sort after this one.
+        :param unicode limit: If given, the number of containers to list.
+
+        :return: An iterable of ``dict`` representing each of the
+            containers that are configured to exist anywhere on the cluster.
         """
-        result = []
-        deployment_state = self.cluster_state_service.as_deployment()
-        for node in deployment_state.nodes:
-            if node.applications is None:
-                continue
-            for application in node.applications:
-                container = container_configuration_response(
-                    application, node.uuid)
-                container[u"host"] = node.hostname
-                container[u"running"] = application.running
-                result.append(container)
-        return result
+        index = self._index(
+            u"state", self.cluster_state_service.as_deployment())
+        containers = index.containers(
+            node_uuid=_query_uuid(node_uuid), prefix=name_prefix,
+            after=after, limit=_query_integer(limit))
+
+        def state_container(application, node):
+            container = container_configuration_response(
+                application, node.uuid)
+            container[u"host"] = node.hostname
+            container[u"running"] = application.running
+            return container
+        return (state_container(application, node)
+                for application, node in containers)
 
     def _get_attached_volume(self, node_uuid, volume):
         """
@@ -488,6 +801,7 @@ class ConfigurationAPIUserV1(object):
             mountpoint=FilePath(volume[u"mountpoint"].encode("utf-8")))
 
     @app.route("/configuration/containers", methods=['POST'])
+    @versioned(_configuration_version, _wait_for_configuration_change)
     @user_documentation(
         """
         Add a new container to the configuration.
@@ -663,6 +977,7 @@ class ConfigurationAPIUserV1(object):
         return saving
 
     @app.route("/configuration/containers/<name>", methods=['POST'])
+    @versioned(_configuration_version, _wait_for_configuration_change)
     @user_documentation(
         """
         Update a named container's configuration.
@@ -721,6 +1036,7 @@ class ConfigurationAPIUserV1(object):
         raise CONTAINER_NOT_FOUND
 
     @app.route("/configuration/containers/<name>", methods=['DELETE'])
+    @versioned(_configuration_version, _wait_for_configuration_change)
     @user_documentation(
         """
         Remove a container from the configuration.
@@ -764,6 +1080,8 @@ class ConfigurationAPIUserV1(object):
         raise CONTAINER_NOT_FOUND
 
     @app.route("/state/nodes", methods=['GET'])
+    @versioned(_state_version, _wait_for_state_change,
+               cache_responses=True)
     @user_documentation(
         """
         List known nodes in the cluster.
@@ -780,7 +1098,8 @@ class ConfigurationAPIUserV1(object):
         inputSchema={},
         outputSchema={"$ref":
                       '/v1/endpoints.json#/definitions/nodes_array'},
-        schema_store=SCHEMAS
+        schema_store=SCHEMAS,
+        output_validation_rate=_LISTING_VALIDATION_RATE,
     )
     def list_current_nodes(self):
         return [{u"host": node.hostname, u"uuid": unicode(node.uuid)}
@@ -788,6 +1107,7 @@ class ConfigurationAPIUserV1(object):
                 self.cluster_state_service.as_deployment().nodes]
 
     @app.route("/configuration/_compose", methods=['POST'])
+    @versioned(_configuration_version, _wait_for_configuration_change)
     @user_documentation(
         """
         Private API endpoint used by flocker-deploy.
@@ -802,29 +1122,87 @@ class ConfigurationAPIUserV1(object):
             '/v1/endpoints.json#/definitions/configuration_compose'
         },
         outputSchema={},
-        schema_store=SCHEMAS
+        schema_store=SCHEMAS,
+        maximum_body_size=_MAXIMUM_COMPOSE_SIZE,
     )
     def replace_configuration(self, applications, deployment):
         """
         Replace the existing configuration with one given by flocker-deploy
         command line tool.
 
+        The configuration is parsed in a thread, so that large ones don't
+        stop other requests being served.  If that takes longer than
+        ``_COMPOSE_TIMEOUT``, or the configuration is changed by another
+        request in the meantime, the configuration is discarded.  So
+        ``If-Match``, which is checked before parsing starts, still protects
+        against overwriting other changes.
+
         :param applications: Configuration in Flocker-native or
             Fig/Compose format.
 
         :param deployment: Configuration of which applications run on
             which nodes.
         """
-        try:
-            configuration = FigConfiguration(applications)
-            if not configuration.is_valid_format():
-                configuration = FlockerConfiguration(applications)
-            return self.persistence_service.save(model_from_configuration(
-                deployment_state=self.cluster_state_service.as_deployment(),
-                applications=configuration.applications(),
-                deployment_configuration=deployment))
-        except ConfigurationError as e:
-            raise make_bad_request(code=BAD_REQUEST, description=unicode(e))
+        threadpool = self._threadpool
+        if threadpool is None:
+            threadpool = self._reactor.getThreadPool()
+        deployment_state = self.cluster_state_service.as_deployment()
+        version = self.persistence_service.get_version()
+        action = _LOG_PARSE_CONFIGURATION(self.logger)
+
+        def parse():
+            with action:
+                started = time()
+                result = _parse_configuration(
+                    deployment_state, applications, deployment)
+                action.add_success_fields(parse_time=time() - started)
+                return result
+        parsing = deferToThreadPool(self._reactor, threadpool, parse)
+        timing_out = self._reactor.callLater(_COMPOSE_TIMEOUT, parsing.cancel)
+
+        def parsed(result):
+            if timing_out.active():
+                timing_out.cancel()
+            return result
+        parsing.addBoth(parsed)
+
+        def save(configuration):
+            if self.persistence_service.get_version() != version:
+                raise CONFIGURATION_CHANGED
+            return self.persistence_service.save(configuration)
+
+        def cancelled(reason):
+            reason.trap(CancelledError)
+            raise CONFIGURATION_TIMED_OUT
+        parsing.addCallbacks(save, cancelled)
+        return parsing
+
+
+def _parse_configuration(deployment_state, applications, deployment):
+    """
+    Turn a configuration given by flocker-deploy into a ``Deployment``.
+
+    :param DeploymentState deployment_state: The current state of the
+        cluster.
+    :param applications: Configuration in Flocker-native or Fig/Compose
+        format.
+    :param deployment: Configuration of which applications run on which
+        nodes.
+
+    :raise BadRequest: If the configuration is invalid.
+
+    :return Deployment: The new desired configuration.
+    """
+    try:
+        configuration = FigConfiguration(applications)
+        if not configuration.is_valid_format():
+            configuration = FlockerConfiguration(applications)
+        return model_from_configuration(
+            deployment_state=deployment_state,
+            applications=configuration.applications(),
+            deployment_configuration=deployment)
+    except ConfigurationError as e:
+        raise make_bad_request(code=BAD_REQUEST, description=unicode(e))
 
 
 def _find_manifestation_and_node(deployment, dataset_id):
@@ -861,6 +1239,119 @@ def _find_manifestation_and_node(deployment, dataset_id):
     return primary_manifestation, origin_node
 
 
+def _create_dataset(deployment, primary, dataset_id=None, maximum_size=None,
+                    metadata=None):
+    """
+    Add a dataset to the cluster configuration.
+
+    See ``ConfigurationAPIUserV1.create_dataset_configuration`` for the
+    meaning of the arguments.
+
+    :param Deployment deployment: The cluster configuration.
+
+    :raise BadRequest: If the dataset can't be created.
+
+    :return: ``tuple`` of the updated ``Deployment`` and a ``dict``
+        describing the new dataset.
+    """
+    if dataset_id is None:
+        dataset_id = unicode(uuid4())
+    dataset_id = dataset_id.lower()
+
+    if metadata is None:
+        metadata = {}
+
+    primary = UUID(hex=primary)
+
+    if deployment.dataset_manifestations(dataset_id):
+        raise DATASET_ID_COLLISION
+
+    # XXX Check cluster state to determine if the given primary node
+    # actually exists.  If not, raise PRIMARY_NODE_NOT_FOUND.
+    # See FLOC-1278
+
+    dataset = Dataset(
+        dataset_id=dataset_id,
+        maximum_size=maximum_size,
+        metadata=pmap(metadata)
+    )
+    manifestation = Manifestation(dataset=dataset, primary=True)
+
+    primary_node = deployment.get_node(primary)
+
+    new_node_config = primary_node.transform(
+        ("manifestations", manifestation.dataset_id), manifestation)
+    return (deployment.update_node(new_node_config),
+            api_dataset_from_dataset_and_node(dataset, primary))
+
+
+def _delete_dataset(deployment, dataset_id):
+    """
+    Mark a dataset in the cluster configuration as deleted.
+
+    :param Deployment deployment: The cluster configuration.
+    :param unicode dataset_id: The unique identifier of the dataset.
+
+    :raise BadRequest: If the dataset doesn't exist.
+
+    :return: ``tuple`` of the updated ``Deployment`` and a ``dict``
+        describing the deleted dataset.
+    """
+    # XXX this doesn't handle replicas
+    # https://clusterhq.atlassian.net/browse/FLOC-1240
+    old_manifestation, origin_node = _find_manifestation_and_node(
+        deployment, dataset_id)
+
+    new_node = origin_node.transform(
+        ("manifestations", dataset_id, "dataset", "deleted"), True)
+    return (deployment.update_node(new_node),
+            api_dataset_from_dataset_and_node(
+                new_node.manifestations[dataset_id].dataset, new_node.uuid))
+
+
+def _update_dataset(deployment, dataset_id, primary=None):
+    """
+    Update a dataset in the cluster configuration.
+
+    :param Deployment deployment: The cluster configuration.
+    :param unicode dataset_id: The unique identifier of the dataset.
+    :param unicode primary: The UUID of the node to which the dataset will
+        be moved, or ``None`` indicating no change.
+
+    :raise BadRequest: If the dataset doesn't exist or is deleted.
+
+    :return: ``tuple`` of the updated ``Deployment`` and a ``dict``
+        describing the updated dataset.
+    """
+    # Raises DATASET_NOT_FOUND if the ``dataset_id`` is not found.
+    primary_manifestation, current_node = _find_manifestation_and_node(
+        deployment, dataset_id
+    )
+
+    if primary_manifestation.dataset.deleted:
+        raise DATASET_DELETED
+
+    if primary is not None:
+        deployment = _update_dataset_primary(
+            deployment, dataset_id, UUID(hex=primary)
+        )
+
+    primary_manifestation, current_node = _find_manifestation_and_node(
+        deployment, dataset_id
+    )
+    return deployment, api_dataset_from_dataset_and_node(
+        primary_manifestation.dataset, current_node.uuid)
+
+
+# Mapping from the ``action`` of a batch dataset operation to the function
+# applying it and the response code of the equivalent individual request:
+_DATASET_OPERATIONS = {
+    u"create": (_create_dataset, CREATED),
+    u"update": (_update_dataset, OK),
+    u"delete": (_delete_dataset, OK),
+}
+
+
 def _update_dataset_primary(deployment, dataset_id, primary):
     """
     Update the ``deployment`` so that the ``Dataset`` with the supplied
@@ -905,12 +1396,11 @@ def _update_dataset_maximum_size(deployment, dataset_id, maximum_size):
     :returns: An updated ``Deployment``.
     """
     manifestation, node = _find_manifestation_and_node(deployment, dataset_id)
-    deployment = deployment.set(nodes=deployment.nodes.discard(node))
     node = node.transform(
         ['manifestations', dataset_id, 'dataset', 'maximum_size'],
         maximum_size
     )
-    return deployment.set(nodes=deployment.nodes.add(node))
+    return deployment.update_node(node)
 
 
 def manifestations_from_deployment(deployment, dataset_id):
@@ -925,9 +1415,7 @@ def manifestations_from_deployment(deployment, dataset_id):
     :return: Iterable returning all manifestations of the supplied
         ``dataset_id``.
     """
-    for node in deployment.nodes:
-        if dataset_id in node.manifestations:
-            yield node.manifestations[dataset_id], node
+    return deployment.dataset_manifestations(dataset_id)
 
 
 def datasets_from_deployment(deployment):
@@ -10,6 +10,7 @@ from twisted.internet.endpoints import serverFromString
 from twisted.python.filepath import FilePath
 from twisted.application.service import MultiService
 
+from ..restapi import OutputValidation, set_output_validation
 from .httpapi import create_api_service, REST_API_PORT
 from ._persistence import ConfigurationPersistenceService
 from ._clusterstate import ClusterStateService
@@ -18,6 +19,17 @@ from ..common.script import (
 from ._protocol import ControlAMPService
 
 
+def _output_validation(value):
+    """
+    Parse the ``--output-validation`` option.
+
+    :param bytes value: The name of a policy, e.g. ``b"sampled"``.
+
+    :return: The corresponding ``OutputValidation`` constant.
+    """
+    return OutputValidation.lookupByName(value.upper())
+
+
 @flocker_standard_options
 class ControlOptions(Options):
     """
@@ -30,6 +42,9 @@ class ControlOptions(Options):
          "The external API port to listen on."],
         ["agent-port", "a", 'tcp:4524',
          "The port convergence agents will connect to."],
+        ["output-validation", None, OutputValidation.ALWAYS,
+         "Which REST API responses to validate against their schemas: "
+         "always, sampled or never.", _output_validation],
     ]
 
 
@@ -39,6 +54,7 @@ class ControlScript(object):
     cluster.
     """
     def main(self, reactor, options):
+        set_output_validation(options["output-validation"])
         top_service = MultiService()
         persistence = ConfigurationPersistenceService(
             reactor, options["data-path"])
@@ -48,7 +64,7 @@ class ControlScript(object):
         create_api_service(persistence, cluster_state, serverFromString(
             reactor, options["port"])).setServiceParent(top_service)
         amp_service = ControlAMPService(
-            cluster_state, persistence, serverFromString(
+            reactor, cluster_state, persistence, serverFromString(
                 reactor, options["agent-port"]))
         amp_service.setServiceParent(top_service)
         return main_for_service(reactor, top_service)
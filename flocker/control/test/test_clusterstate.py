@@ -118,6 +118,72 @@ class ClusterStateServiceTests(SynchronousTestCase):
                                  applications=frozenset([APP2])),
                          ]))
 
+    def test_changed(self):
+        """
+        ``ClusterStateService.apply_changes`` returns ``True`` if the changes
+        alter the cluster state.
+        """
+        service = self.service()
+        service.apply_changes([self.WITH_APPS])
+        self.assertTrue(service.apply_changes([self.WITH_MANIFESTATION]))
+
+    def test_unchanged(self):
+        """
+        ``ClusterStateService.apply_changes`` returns ``False`` if the changes
+        match the existing cluster state.
+        """
+        service = self.service()
+        service.apply_changes([self.WITH_APPS, self.WITH_MANIFESTATION])
+        original = service.as_deployment()
+        self.assertEqual(
+            (service.apply_changes([self.WITH_APPS,
+                                    self.WITH_MANIFESTATION]),
+             service.as_deployment()),
+            (False, original))
+
+    def test_changes_cancel_out(self):
+        """
+        ``ClusterStateService.apply_changes`` returns ``False`` if the changes
+        end up leaving the cluster state as it was.
+        """
+        service = self.service()
+        service.apply_changes([self.WITH_APPS])
+        self.assertFalse(service.apply_changes([
+            self.WITH_APPS.set(applications=[APP1]), self.WITH_APPS]))
+
+    def test_version_changed(self):
+        """
+        ``ClusterStateService.get_version`` returns a different version after
+        changes which alter the cluster state.
+        """
+        service = self.service()
+        version = service.get_version()
+        service.apply_changes([self.WITH_APPS])
+        self.assertNotEqual(service.get_version(), version)
+
+    def test_version_unchanged(self):
+        """
+        ``ClusterStateService.get_version`` returns the same version after
+        changes which match the existing cluster state.
+        """
+        service = self.service()
+        service.apply_changes([self.WITH_APPS])
+        version = service.get_version()
+        service.apply_changes([self.WITH_APPS])
+        self.assertEqual(service.get_version(), version)
+
+    def test_callbacks(self):
+        """
+        Callbacks registered with ``ClusterStateService.register`` are called
+        when changes alter the cluster state, but not otherwise.
+        """
+        service = self.service()
+        calls = []
+        service.register(lambda: calls.append(1))
+        service.apply_changes([self.WITH_APPS])
+        service.apply_changes([self.WITH_APPS])
+        self.assertEqual(calls, [1])
+
     def test_manifestation_path(self):
         """
         ``manifestation_path`` returns the path on the filesystem where the
@@ -4,7 +4,7 @@ Tests for ``flocker.control.httpapi``.
 """
 
 from io import BytesIO
-from uuid import uuid4
+from uuid import uuid4, UUID
 from copy import deepcopy
 
 from pyrsistent import pmap, thaw
@@ -12,22 +12,28 @@ from pyrsistent import pmap, thaw
 from zope.interface.verify import verifyObject
 
 from twisted.internet import reactor
-from twisted.internet.defer import gatherResults
+from twisted.internet.defer import gatherResults, CancelledError
+from twisted.internet.task import Clock, Cooperator
 from twisted.internet.endpoints import TCP4ServerEndpoint
 from twisted.trial.unittest import SynchronousTestCase
 from twisted.test.proto_helpers import MemoryReactor
 from twisted.web.http import (
     CREATED, OK, CONFLICT, BAD_REQUEST, NOT_FOUND, INTERNAL_SERVER_ERROR,
-    NOT_ALLOWED as METHOD_NOT_ALLOWED
+    NOT_ALLOWED as METHOD_NOT_ALLOWED, NOT_MODIFIED, PRECONDITION_FAILED,
+    SERVICE_UNAVAILABLE,
 )
 from twisted.web.http_headers import Headers
 from twisted.web.server import Site
 from twisted.web.client import FileBodyProducer, readBody
 from twisted.application.service import IService
 from twisted.python.filepath import FilePath
+from twisted.python.failure import Failure
 
+from eliot.testing import validateLogging, assertHasAction
+
+from ...restapi import _infrastructure
 from ...restapi.testtools import (
-    buildIntegrationTests, dumps, loads)
+    buildIntegrationTests, dumps, loads, dummyRequest, render)
 
 from .. import (
     Application, Dataset, Manifestation, Node, NodeState,
@@ -36,7 +42,8 @@ from .. import (
 )
 from ..httpapi import (
     ConfigurationAPIUserV1, create_api_service, datasets_from_deployment,
-    api_dataset_from_dataset_and_node, container_configuration_response
+    api_dataset_from_dataset_and_node, container_configuration_response,
+    _ChangeWatcher, _COMPOSE_TIMEOUT, _LOG_PARSE_CONFIGURATION,
 )
 from .._persistence import ConfigurationPersistenceService
 from .._clusterstate import ClusterStateService
@@ -1124,7 +1131,7 @@ class GetContainerConfigurationTestsMixin(APITestsMixin):
             b"GET", b"/configuration/containers", None, OK, []
         )
 
-    def _containers_test(self, deployment, expected):
+    def _containers_test(self, deployment, expected, query=b""):
         """
         Verify that when the control service has ``deployment``
         persisted as its configuration, the response from the
@@ -1137,6 +1144,8 @@ class GetContainerConfigurationTestsMixin(APITestsMixin):
         :param list expected: The objects expected to be returned by
             the endpoint, disregarding order.
 
+        :param bytes query: The query string of the request, if any.
+
         :return: A ``Deferred`` that fires successfully if the
             expected results are received or which fires with a
             failure if there is a problem.
@@ -1145,7 +1154,8 @@ class GetContainerConfigurationTestsMixin(APITestsMixin):
 
         def saved(ignored):
             return self.assertResultItems(
-                b"GET", b"/configuration/containers", None, OK, expected
+                b"GET", b"/configuration/containers" + query, None, OK,
+                expected
             )
         saving.addCallback(saved)
         return saving
@@ -1325,6 +1335,65 @@ class GetContainerConfigurationTestsMixin(APITestsMixin):
         ]
         return self._containers_test(deployment, expected)
 
+    def _filter_deployment(self):
+        """
+        Create a deployment with containers to list.
+
+        :return: A ``tuple`` of the ``Deployment`` and its ``Application``
+            instances, in order of name.
+        """
+        applications = [
+            Application(name=name, image=DockerImage.from_string(u"busybox"))
+            for name in [u"db", u"web-1", u"web-2"]]
+        deployment = Deployment(
+            nodes={
+                Node(uuid=self.NODE_A_UUID, applications=applications[:2]),
+                Node(uuid=self.NODE_B_UUID, applications=applications[2:]),
+            },
+        )
+        return deployment, applications
+
+    def test_filter_node(self):
+        """
+        With a ``node_uuid`` query argument only containers on that node are
+        returned.
+        """
+        deployment, applications = self._filter_deployment()
+        expected = [
+            container_configuration_response(application, self.NODE_A)
+            for application in applications[:2]]
+        return self._containers_test(
+            deployment, expected, b"?node_uuid=" + self.NODE_A.encode("ascii"))
+
+    def test_filter_name_prefix(self):
+        """
+        With a ``name_prefix`` query argument only containers whose names
+        start with it are returned.
+        """
+        deployment, applications = self._filter_deployment()
+        expected = [
+            container_configuration_response(applications[1], self.NODE_A),
+            container_configuration_response(applications[2], self.NODE_B)]
+        return self._containers_test(deployment, expected, b"?name_prefix=web")
+
+    def test_page(self):
+        """
+        With ``after`` and ``limit`` query arguments the given number of
+        containers following the given name are returned.
+        """
+        deployment, applications = self._filter_deployment()
+        expected = [
+            container_configuration_response(applications[1], self.NODE_A)]
+        return self._containers_test(
+            deployment, expected, b"?after=db&limit=1")
+
+    def test_invalid_query(self):
+        """
+        An unknown query argument results in a ``BAD_REQUEST`` response.
+        """
+        return self.assertResponseCode(
+            b"GET", b"/configuration/containers?junk=1", None, BAD_REQUEST)
+
 
 RealTestsGetContainerConfiguration, MemoryTestsGetContainerConfiguration = (
     buildIntegrationTests(
@@ -2427,6 +2496,151 @@ RealTestsDeleteDataset, MemoryTestsDeleteDataset = (
 )
 
 
+class BatchDatasetsTestsMixin(APITestsMixin):
+    """
+    Tests for the dataset batch endpoint at
+    ``/configuration/datasets/batch``.
+    """
+    def _setup_manifestation(self):
+        """
+        Create and save a configuration with a single node that has a
+        manifestation.
+
+        :return: ``Deferred`` firing with the ``Manifestation``.
+        """
+        manifestation = _manifestation()
+        saving = self.persistence_service.save(Deployment(nodes={
+            Node(uuid=self.NODE_A_UUID,
+                 manifestations={manifestation.dataset_id: manifestation})
+        }))
+        saving.addCallback(lambda ignored: manifestation)
+        return saving
+
+    def _count_saves(self):
+        """
+        Count the changes the persistence service reports.
+
+        :return: A ``list`` which gets an item for each change.
+        """
+        saves = []
+        self.persistence_service.register(lambda: saves.append(None))
+        return saves
+
+    def test_operations(self):
+        """
+        Each operation is applied and gets the result the equivalent
+        individual request would have had, and all the changes are saved
+        together.
+        """
+        created_id = unicode(uuid4())
+        unknown_id = unicode(uuid4())
+        setting_up = self._setup_manifestation()
+
+        def batch(manifestation):
+            saves = self._count_saves()
+            dataset_id = manifestation.dataset_id
+            requesting = self.assertResult(
+                b"POST", b"/configuration/datasets/batch",
+                {u"operations": [
+                    {u"action": u"create", u"primary": self.NODE_A,
+                     u"dataset_id": created_id},
+                    {u"action": u"update", u"dataset_id": dataset_id,
+                     u"primary": self.NODE_B},
+                    {u"action": u"delete", u"dataset_id": unknown_id},
+                ]},
+                OK,
+                {u"results": [
+                    {u"code": CREATED,
+                     u"result": {u"dataset_id": created_id,
+                                 u"primary": self.NODE_A,
+                                 u"metadata": {}, u"deleted": False}},
+                    {u"code": OK,
+                     u"result": {u"dataset_id": dataset_id,
+                                 u"primary": self.NODE_B,
+                                 u"metadata": {}, u"deleted": False}},
+                    {u"code": NOT_FOUND,
+                     u"result": {u"description": u"Dataset not found."}},
+                ]})
+
+            def got_result(ignored):
+                deployment = self.persistence_service.get()
+                self.assertEqual(
+                    ([m.primary for m, node in
+                      deployment.dataset_manifestations(created_id)],
+                     [node.uuid for m, node in
+                      deployment.dataset_manifestations(dataset_id)],
+                     len(saves)),
+                    ([True], [self.NODE_B_UUID], 1))
+            requesting.addCallback(got_result)
+            return requesting
+        setting_up.addCallback(batch)
+        return setting_up
+
+    def test_later_operations_see_earlier(self):
+        """
+        Each operation applies to the configuration as changed by the
+        operations before it.
+        """
+        dataset_id = unicode(uuid4())
+        return self.assertResult(
+            b"POST", b"/configuration/datasets/batch",
+            {u"operations": [
+                {u"action": u"create", u"primary": self.NODE_A,
+                 u"dataset_id": dataset_id},
+                {u"action": u"create", u"primary": self.NODE_B,
+                 u"dataset_id": dataset_id},
+                {u"action": u"delete", u"dataset_id": dataset_id},
+            ]},
+            OK,
+            {u"results": [
+                {u"code": CREATED,
+                 u"result": {u"dataset_id": dataset_id,
+                             u"primary": self.NODE_A,
+                             u"metadata": {}, u"deleted": False}},
+                {u"code": CONFLICT,
+                 u"result": {u"description":
+                             u"The provided dataset_id is already in use."}},
+                {u"code": OK,
+                 u"result": {u"dataset_id": dataset_id,
+                             u"primary": self.NODE_A,
+                             u"metadata": {}, u"deleted": True}},
+            ]})
+
+    def test_no_changes(self):
+        """
+        If no operation succeeds the configuration is not saved.
+        """
+        saves = self._count_saves()
+        requesting = self.assertResponseCode(
+            b"POST", b"/configuration/datasets/batch",
+            {u"operations": [
+                {u"action": u"delete", u"dataset_id": unicode(uuid4())}]},
+            OK)
+        requesting.addCallback(lambda ignored: self.assertEqual(saves, []))
+        return requesting
+
+    def test_unknown_action(self):
+        """
+        An operation with an unknown action results in a ``BAD_REQUEST``
+        response, and nothing is applied.
+        """
+        saves = self._count_saves()
+        requesting = self.assertResponseCode(
+            b"POST", b"/configuration/datasets/batch",
+            {u"operations": [
+                {u"action": u"create", u"primary": self.NODE_A},
+                {u"action": u"explode", u"dataset_id": unicode(uuid4())}]},
+            BAD_REQUEST)
+        requesting.addCallback(lambda ignored: self.assertEqual(saves, []))
+        return requesting
+
+
+RealTestsBatchDatasets, MemoryTestsBatchDatasets = (
+    buildIntegrationTests(
+        BatchDatasetsTestsMixin, "BatchDatasets", _build_app)
+)
+
+
 def get_dataset_ids(deployment):
     """
     Get an iterator of all of the ``dataset_id`` values on all nodes in the
@@ -2478,7 +2692,7 @@ class GetDatasetConfigurationTestsMixin(APITestsMixin):
             b"GET", b"/configuration/datasets", None, OK, []
         )
 
-    def _dataset_test(self, deployment, expected):
+    def _dataset_test(self, deployment, expected, query=b""):
         """
         Verify that when the control service has ``deployment``
         persisted as its configuration, the response from the
@@ -2491,6 +2705,8 @@ class GetDatasetConfigurationTestsMixin(APITestsMixin):
         :param list expected: The objects expected to be returned by
             the endpoint, disregarding order.
 
+        :param bytes query: The query string of the request, if any.
+
         :return: A ``Deferred`` that fires successfully if the
             expected results are received or which fires with a
             failure if there is a problem.
@@ -2499,7 +2715,8 @@ class GetDatasetConfigurationTestsMixin(APITestsMixin):
 
         def saved(ignored):
             return self.assertResultItems(
-                b"GET", b"/configuration/datasets", None, OK, expected
+                b"GET", b"/configuration/datasets" + query, None, OK,
+                expected
             )
         saving.addCallback(saved)
         return saving
@@ -2609,6 +2826,106 @@ class GetDatasetConfigurationTestsMixin(APITestsMixin):
         ]
         return self._dataset_test(deployment, expected)
 
+    def _filter_deployment(self):
+        """
+        Create a deployment with datasets to list.
+
+        :return: A ``tuple`` of the ``Deployment`` and its ``Dataset``
+            instances, in order of identifier.
+        """
+        datasets = [
+            Dataset(dataset_id=unicode(UUID(int=1)),
+                    metadata={u"name": u"db"}),
+            Dataset(dataset_id=unicode(UUID(int=2)), deleted=True),
+            Dataset(dataset_id=unicode(UUID(int=3))),
+        ]
+        manifestations = [
+            Manifestation(dataset=dataset, primary=True)
+            for dataset in datasets]
+        deployment = Deployment(
+            nodes={
+                Node(
+                    uuid=self.NODE_A_UUID,
+                    manifestations={
+                        manifestation.dataset_id: manifestation
+                        for manifestation in manifestations[:2]},
+                ),
+                Node(
+                    uuid=self.NODE_B_UUID,
+                    manifestations={
+                        manifestations[2].dataset_id: manifestations[2]},
+                ),
+            },
+        )
+        return deployment, datasets
+
+    def test_filter_primary(self):
+        """
+        With a ``primary`` query argument only datasets whose primary
+        manifestation is on that node are returned.
+        """
+        deployment, datasets = self._filter_deployment()
+        expected = [
+            api_dataset_from_dataset_and_node(datasets[2], self.NODE_B)]
+        return self._dataset_test(
+            deployment, expected, b"?primary=" + self.NODE_B.encode("ascii"))
+
+    def test_filter_metadata(self):
+        """
+        With ``metadata_key`` and ``metadata_value`` query arguments only
+        datasets with that metadata are returned.
+        """
+        deployment, datasets = self._filter_deployment()
+        expected = [
+            api_dataset_from_dataset_and_node(datasets[0], self.NODE_A)]
+        return self._dataset_test(
+            deployment, expected, b"?metadata_key=name&metadata_value=db")
+
+    def test_filter_deleted(self):
+        """
+        With a ``deleted`` query argument only datasets which are or aren't
+        deleted are returned.
+        """
+        deployment, datasets = self._filter_deployment()
+        expected = [
+            api_dataset_from_dataset_and_node(datasets[1], self.NODE_A)]
+        return self._dataset_test(deployment, expected, b"?deleted=true")
+
+    def test_page(self):
+        """
+        With ``after`` and ``limit`` query arguments the given number of
+        datasets following the given identifier are returned.
+        """
+        deployment, datasets = self._filter_deployment()
+        expected = [
+            api_dataset_from_dataset_and_node(datasets[1], self.NODE_A)]
+        return self._dataset_test(
+            deployment, expected,
+            b"?limit=1&after=" + datasets[0].dataset_id.encode("ascii"))
+
+    def test_invalid_query(self):
+        """
+        A query argument which doesn't match the schema results in a
+        ``BAD_REQUEST`` response.
+        """
+        return self.assertResponseCode(
+            b"GET", b"/configuration/datasets?limit=0", None, BAD_REQUEST)
+
+    def test_streamed(self):
+        """
+        Listings too long to encode at once are streamed, with the same
+        result.
+        """
+        self.patch(_infrastructure, "_STREAM_THRESHOLD", 1)
+        self.patch(_infrastructure, "_STREAM_CHUNK_SIZE", 1)
+        deployment, datasets = self._filter_deployment()
+        expected = [
+            api_dataset_from_dataset_and_node(dataset, node)
+            for dataset, node in [(datasets[0], self.NODE_A),
+                                  (datasets[1], self.NODE_A),
+                                  (datasets[2], self.NODE_B)]]
+        return self._dataset_test(deployment, expected)
+
 
 RealTestsGetDatasetConfiguration, MemoryTestsGetDatasetConfiguration = (
     buildIntegrationTests(
@@ -2752,6 +3069,70 @@ RealTestsDatasetsStateAPI, MemoryTestsDatasetsStateAPI = buildIntegrationTests(
     DatasetsStateTestsMixin, "DatasetsStateAPI", _build_app)
 
 
+class DatasetsStateStreamingTests(SynchronousTestCase):
+    """
+    Tests for streaming ``/state/datasets`` responses.
+    """
+    def setUp(self):
+        # One chunk of one dataset per step, with the steps run by hand:
+        self.scheduled = []
+        cooperator = Cooperator(
+            terminationPredicateFactory=lambda: lambda: True,
+            scheduler=self.scheduled.append)
+        self.patch(_infrastructure, "_cooperate", cooperator.cooperate)
+        self.patch(_infrastructure, "_STREAM_THRESHOLD", 1)
+        self.patch(_infrastructure, "_STREAM_CHUNK_SIZE", 1)
+        persistence_service = ConfigurationPersistenceService(
+            _ThreadedClock(), FilePath(self.mktemp()), _PendingThreadPool())
+        persistence_service.startService()
+        self.addCleanup(persistence_service.stopService)
+        self.cluster_state_service = ClusterStateService()
+        self.cluster_state_service.startService()
+        self.addCleanup(self.cluster_state_service.stopService)
+        self.api = ConfigurationAPIUserV1(
+            persistence_service, self.cluster_state_service)
+
+    def step(self):
+        """
+        Run the work scheduled by the cooperator so far.
+        """
+        scheduled = self.scheduled[:]
+        del self.scheduled[:]
+        for work in scheduled:
+            work()
+
+    def test_state_changed(self):
+        """
+        If the cluster state changes while a listing is streamed, the whole
+        listing still reflects the state when the request was made.
+        """
+        node_uuid = uuid4()
+        datasets = [Dataset(dataset_id=unicode(UUID(int=i)))
+                    for i in range(1, 4)]
+        self.cluster_state_service.apply_changes([NodeState(
+            uuid=node_uuid, hostname=u"192.0.2.101",
+            manifestations={
+                dataset.dataset_id: Manifestation(dataset=dataset,
+                                                  primary=True)
+                for dataset in datasets},
+            paths={dataset.dataset_id: FilePath(b"/" + bytes(i))
+                   for i, dataset in enumerate(datasets)})])
+        request = dummyRequest(b"GET", b"/state/datasets", Headers())
+        render(self.api.app.resource(), request)
+        self.step()
+        self.cluster_state_service.apply_changes([NodeState(
+            uuid=node_uuid, hostname=u"192.0.2.101",
+            manifestations={}, paths={})])
+        while self.scheduled:
+            self.step()
+        self.assertEqual(
+            (request.transport.aborted, loads(request._responseBody)),
+            (False, [{u"dataset_id": dataset.dataset_id,
+                      u"primary": unicode(node_uuid),
+                      u"path": u"/" + unicode(i)}
+                     for i, dataset in enumerate(datasets)]))
+
+
 class DatasetsFromDeploymentTests(SynchronousTestCase):
     """
     Tests for ``datasets_from_deployment``.
@@ -3372,3 +3753,309 @@ class ConfigurationComposeTestsMixin(APITestsMixin):
 RealTestsConfigurationAPI, MemoryTestsConfigurationAPI = (
     buildIntegrationTests(ConfigurationComposeTestsMixin, "ConfigurationAPI",
                           _build_app))
+
+
+class _ThreadedClock(Clock):
+    """
+    A ``Clock`` which immediately runs functions called from threads.
+    """
+    def callFromThread(self, f, *args, **kwargs):
+        f(*args, **kwargs)
+
+
+class _PendingThreadPool(object):
+    """
+    A stand-in for ``ThreadPool`` which only runs work when told to.
+
+    :ivar list pending: Functions which run the work given so far.
+    """
+    def __init__(self):
+        self.pending = []
+
+    def callInThreadWithCallback(self, onResult, func, *args, **kw):
+        def run():
+            try:
+                result = func(*args, **kw)
+            except:
+                onResult(False, Failure())
+            else:
+                onResult(True, result)
+        self.pending.append(run)
+
+    def run(self):
+        """
+        Run the pending work, including any work it gives.
+        """
+        while self.pending:
+            self.pending.pop(0)()
+
+
+class ConfigurationComposeThreadTests(SynchronousTestCase):
+    """
+    Tests for the parsing of ``/configuration/_compose`` requests in a
+    thread.
+    """
+    def setUp(self):
+        self.reactor = _ThreadedClock()
+        self.threadpool = _PendingThreadPool()
+        self.persistence_service = ConfigurationPersistenceService(
+            self.reactor, FilePath(self.mktemp()), self.threadpool)
+        self.persistence_service.startService()
+        self.addCleanup(self.persistence_service.stopService)
+        self.cluster_state_service = ClusterStateService()
+        self.cluster_state_service.apply_changes(
+            ConfigurationComposeTestsMixin.DEPLOYMENT_STATE.nodes)
+        self.api = ConfigurationAPIUserV1(
+            self.persistence_service, self.cluster_state_service,
+            reactor=self.reactor, threadpool=self.threadpool)
+
+    def request(self):
+        """
+        Start rendering a ``/configuration/_compose`` request.
+
+        :return: The request.
+        """
+        request = dummyRequest(
+            b"POST", b"/configuration/_compose",
+            Headers({b"content-type": [b"application/json"]}),
+            dumps({u"applications": COMPLEX_APPLICATION_YAML,
+                   u"deployment": COMPLEX_DEPLOYMENT_YAML}))
+        render(self.api.app.resource(), request)
+        return request
+
+    def test_parsed_in_thread(self):
+        """
+        The configuration is parsed in the thread pool, and saved once that
+        is done.
+        """
+        request = self.request()
+        waiting = (request._finished, len(self.threadpool.pending),
+                   len(self.persistence_service.get().nodes))
+        self.threadpool.run()
+        saved = len(self.persistence_service.get().nodes)
+        self.assertEqual(
+            (waiting, request._code, saved), ((False, 1, 0), OK, 2))
+
+    @validateLogging(None)
+    def test_parse_time_logged(self, logger):
+        """
+        Parsing the configuration is logged along with the time it took.
+        """
+        self.api.logger = logger
+        self.request()
+        self.threadpool.run()
+        action = assertHasAction(
+            self, logger, _LOG_PARSE_CONFIGURATION, True)
+        self.assertIsInstance(action.endMessage[u"parse_time"], float)
+
+    def test_timeout(self):
+        """
+        If parsing takes longer than ``_COMPOSE_TIMEOUT`` the request gets a
+        ``SERVICE_UNAVAILABLE`` response and the configuration isn't saved.
+        """
+        request = self.request()
+        self.reactor.advance(_COMPOSE_TIMEOUT)
+        self.threadpool.run()
+        self.assertEqual(
+            (request._code, len(self.persistence_service.get().nodes)),
+            (SERVICE_UNAVAILABLE, 0))
+
+    def test_changed_while_parsing(self):
+        """
+        If the configuration is changed while parsing, the request gets a
+        ``PRECONDITION_FAILED`` response and the other change is kept.
+        """
+        request = self.request()
+        changed = Deployment(nodes={Node(uuid=uuid4())})
+        self.persistence_service.save(changed)
+        self.threadpool.run()
+        self.assertEqual(
+            (request._code, self.persistence_service.get()),
+            (PRECONDITION_FAILED, changed))
+
+
+class ConfigurationVersionTestsMixin(APITestsMixin):
+    """
+    Tests for the versioning of responses from the ``/configuration``
+    endpoints.
+    """
+    def request(self, method, path, headers, request_body=None):
+        """
+        Issue an HTTP request.
+
+        :param bytes method: The HTTP method to use in the request.
+        :param bytes path: The resource path to use in the request.
+        :param dict headers: Mapping of header names to a single value.
+        :param dict request_body: A JSON-encodable object to encode (as JSON)
+            into the request body.  Or ``None`` for no request body.
+
+        :return: A ``Deferred`` that fires with a tuple of the response code
+            and the values of its ``ETag`` header.
+        """
+        headers = Headers({name: [value] for name, value in headers.items()})
+        body_producer = None
+        if request_body is not None:
+            headers.setRawHeaders(b"content-type", [b"application/json"])
+            body_producer = FileBodyProducer(BytesIO(dumps(request_body)))
+        requesting = self.agent.request(method, path, headers, body_producer)
+        requesting.addCallback(lambda response: (
+            response.code, response.headers.getRawHeaders(b"etag")))
+        return requesting
+
+    def etag(self):
+        """
+        :return bytes: The entity tag for the current configuration.
+        """
+        return b'"%s"' % (
+            self.persistence_service.get_version().encode("ascii"),)
+
+    def state_etag(self):
+        """
+        :return bytes: The entity tag for the current cluster state.
+        """
+        return b'"%s"' % (
+            self.cluster_state_service.get_version().encode("ascii"),)
+
+    def test_etag(self):
+        """
+        Responses include an ``ETag`` header identifying the version of the
+        configuration.
+        """
+        etag = self.etag()
+        requesting = self.request(b"GET", b"/configuration/datasets", {})
+        requesting.addCallback(self.assertEqual, (OK, [etag]))
+        return requesting
+
+    def test_not_modified(self):
+        """
+        A ``GET`` with an ``If-None-Match`` header giving the current version
+        gets a I{NOT MODIFIED} response.
+        """
+        etag = self.etag()
+        requesting = self.request(b"GET", b"/configuration/containers",
+                                  {b"if-none-match": etag})
+        requesting.addCallback(self.assertEqual, (NOT_MODIFIED, [etag]))
+        return requesting
+
+    def test_modified(self):
+        """
+        A ``GET`` with an ``If-None-Match`` header giving an old version gets
+        the current configuration.
+        """
+        etag = self.etag()
+        saving = self.persistence_service.save(
+            Deployment(nodes=[Node(uuid=self.NODE_A_UUID)]))
+        saving.addCallback(lambda _: self.request(
+            b"GET", b"/configuration/datasets", {b"if-none-match": etag}))
+        saving.addCallback(lambda result: self.assertEqual(
+            result, (OK, [self.etag()])))
+        return saving
+
+    def test_write_etag(self):
+        """
+        The ``ETag`` header in the response to a change identifies the
+        version of the configuration including the change.
+        """
+        requesting = self.request(b"POST", b"/configuration/datasets",
+                                  {b"if-match": self.etag()},
+                                  {u"primary": self.NODE_A})
+        requesting.addCallback(lambda result: self.assertEqual(
+            (result, len(self.persistence_service.get().nodes)),
+            ((CREATED, [self.etag()]), 1)))
+        return requesting
+
+    def test_long_poll(self):
+        """
+        A ``GET`` with an ``If-None-Match`` header giving the current version
+        and a ``Prefer: wait`` header gets the new configuration once it
+        changes.
+        """
+        requesting = self.request(
+            b"GET", b"/configuration/datasets",
+            {b"if-none-match": self.etag(), b"prefer": b"wait=30"})
+        self.persistence_service.save(
+            Deployment(nodes=[Node(uuid=self.NODE_A_UUID)]))
+        requesting.addCallback(lambda result: self.assertEqual(
+            result, (OK, [self.etag()])))
+        return requesting
+
+    def test_state_long_poll(self):
+        """
+        A ``GET`` of cluster state with an ``If-None-Match`` header giving
+        the current version and a ``Prefer: wait`` header gets the new state
+        once it changes.
+        """
+        requesting = self.request(
+            b"GET", b"/state/nodes",
+            {b"if-none-match": self.state_etag(), b"prefer": b"wait=30"})
+        self.cluster_state_service.apply_changes([
+            NodeState(uuid=self.NODE_A_UUID, hostname=self.NODE_A_IP)])
+        requesting.addCallback(lambda result: self.assertEqual(
+            result, (OK, [self.state_etag()])))
+        return requesting
+
+    def test_if_match_failed(self):
+        """
+        A change with an ``If-Match`` header giving an old version gets a
+        I{PRECONDITION FAILED} response and the configuration is not changed.
+        """
+        etag = self.etag()
+        deployment = Deployment(nodes=[Node(uuid=self.NODE_B_UUID)])
+        saving = self.persistence_service.save(deployment)
+        saving.addCallback(lambda _: self.request(
+            b"POST", b"/configuration/datasets", {b"if-match": etag},
+            {u"primary": self.NODE_A}))
+        saving.addCallback(lambda result: self.assertEqual(
+            (result, self.persistence_service.get()),
+            ((PRECONDITION_FAILED, [self.etag()]), deployment)))
+        return saving
+
+
+RealTestsConfigurationVersion, MemoryTestsConfigurationVersion = (
+    buildIntegrationTests(ConfigurationVersionTestsMixin,
+                          "ConfigurationVersion", _build_app))
+
+
+class ChangeWatcherTests(SynchronousTestCase):
+    """
+    Tests for ``_ChangeWatcher``.
+    """
+    def setUp(self):
+        self.clock = Clock()
+        self.service = ClusterStateService()
+        self.watcher = _ChangeWatcher(self.clock, self.service)
+
+    def test_change(self):
+        """
+        ``_ChangeWatcher.wait`` returns a ``Deferred`` which fires at the next
+        change.
+        """
+        waiting = self.watcher.wait(10)
+        not_yet = waiting.called
+        self.service.apply_changes([NodeState(hostname=u"192.0.2.1")])
+        self.assertEqual(
+            [not_yet, self.successResultOf(waiting), self.clock.calls],
+            [False, None, []])
+
+    def test_timeout(self):
+        """
+        ``_ChangeWatcher.wait`` returns a ``Deferred`` which fires once the
+        timeout has passed if there were no changes.
+        """
+        waiting = self.watcher.wait(10)
+        self.clock.advance(9)
+        not_yet = waiting.called
+        self.clock.advance(1)
+        self.assertEqual([not_yet, self.successResultOf(waiting)],
+                         [False, None])
+
+    def test_cancel(self):
+        """
+        Cancelling the ``Deferred`` returned by ``_ChangeWatcher.wait`` stops
+        waiting.
+        """
+        waiting = self.watcher.wait(10)
+        waiting.cancel()
+        self.failureResultOf(waiting, CancelledError)
+        self.service.apply_changes([NodeState(hostname=u"192.0.2.1")])
+        self.assertEqual(self.clock.calls, [])
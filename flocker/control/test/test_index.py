@@ -0,0 +1,260 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+
+"""
+Tests for ``flocker.control._index``.
+"""
+
+from uuid import UUID
+
+from pyrsistent import pmap
+
+from twisted.trial.unittest import SynchronousTestCase
+
+from .._index import DeploymentIndex
+from .._model import (
+    Application, DockerImage, Deployment, Node, Manifestation, Dataset,
+    DeploymentState, NodeState,
+)
+
+NODE_A = UUID(int=1)
+NODE_B = UUID(int=2)
+
+
+def _dataset(number, **kwargs):
+    """
+    Create a ``Dataset`` whose identifiers sort in order of ``number``.
+
+    :param int number: Distinguishes the dataset.
+    :param kwargs: Additional arguments for ``Dataset``.
+
+    :return Dataset: The dataset.
+    """
+    return Dataset(dataset_id=unicode(UUID(int=number)), **kwargs)
+
+
+def _application(name):
+    """
+    Create an ``Application``.
+
+    :param unicode name: The name of the application.
+
+    :return Application: The application.
+    """
+    return Application(name=name, image=DockerImage.from_string(u"busybox"))
+
+
+def _manifestations(datasets, primary=True):
+    """
+    Create manifestations of datasets.
+
+    :param list datasets: ``Dataset`` instances.
+    :param bool primary: Whether the manifestations are primary.
+
+    :return: ``dict`` mapping dataset identifiers to ``Manifestation``.
+    """
+    return {dataset.dataset_id: Manifestation(dataset=dataset, primary=primary)
+            for dataset in datasets}
+
+
+DATASET_1 = _dataset(1, metadata=pmap({u"name": u"db"}))
+DATASET_2 = _dataset(2, metadata=pmap({u"name": u"web"}))
+DATASET_3 = _dataset(3, deleted=True)
+DATASET_4 = _dataset(4)
+
+DEPLOYMENT = Deployment(nodes={
+    Node(uuid=NODE_A,
+         manifestations=_manifestations([DATASET_1, DATASET_3]),
+         applications={_application(u"web-1"), _application(u"db")}),
+    Node(uuid=NODE_B,
+         manifestations=_manifestations([DATASET_2, DATASET_4]),
+         applications={_application(u"web-2")}),
+})
+
+
+def _nodes(deployment):
+    """
+    Get the nodes of a deployment by UUID.
+
+    :param deployment: A ``Deployment``.
+
+    :return: ``dict`` mapping ``UUID`` to ``Node``.
+    """
+    return {node.uuid: node for node in deployment.nodes}
+
+
+class DatasetsTests(SynchronousTestCase):
+    """
+    Tests for ``DeploymentIndex.datasets``.
+    """
+    def setUp(self):
+        self.index = DeploymentIndex(DEPLOYMENT)
+        nodes = _nodes(DEPLOYMENT)
+        self.a = nodes[NODE_A]
+        self.b = nodes[NODE_B]
+
+    def test_all(self):
+        """
+        With no arguments all primary datasets are found, with their nodes,
+        in order of identifier.
+        """
+        self.assertEqual(
+            self.index.datasets(),
+            [(DATASET_1, self.a), (DATASET_2, self.b), (DATASET_3, self.a),
+             (DATASET_4, self.b)])
+
+    def test_replicas(self):
+        """
+        Datasets which only have replicas on a node are not found.
+        """
+        index = DeploymentIndex(Deployment(nodes={
+            Node(uuid=NODE_A,
+                 manifestations=_manifestations([DATASET_1], primary=False))
+        }))
+        self.assertEqual(index.datasets(), [])
+
+    def test_primary(self):
+        """
+        With ``primary`` only datasets whose primary manifestation is on the
+        given node are found.
+        """
+        self.assertEqual(
+            self.index.datasets(primary=NODE_B),
+            [(DATASET_2, self.b), (DATASET_4, self.b)])
+
+    def test_unknown_primary(self):
+        """
+        No datasets are found on a node not in the deployment.
+        """
+        self.assertEqual(self.index.datasets(primary=UUID(int=3)), [])
+
+    def test_metadata_key(self):
+        """
+        With ``metadata_key`` only datasets with that metadata key are found.
+        """
+        self.assertEqual(
+            self.index.datasets(metadata_key=u"name"),
+            [(DATASET_1, self.a), (DATASET_2, self.b)])
+
+    def test_metadata_value(self):
+        """
+        With ``metadata_key`` and ``metadata_value`` only datasets with that
+        metadata are found.
+        """
+        self.assertEqual(
+            self.index.datasets(metadata_key=u"name", metadata_value=u"web"),
+            [(DATASET_2, self.b)])
+
+    def test_deleted(self):
+        """
+        With ``deleted`` only datasets which are or aren't deleted are
+        found.
+        """
+        self.assertEqual(
+            (self.index.datasets(deleted=True),
+             self.index.datasets(deleted=False)),
+            ([(DATASET_3, self.a)],
+             [(DATASET_1, self.a), (DATASET_2, self.b),
+              (DATASET_4, self.b)]))
+
+    def test_combined(self):
+        """
+        Datasets matching all the given filters are found.
+        """
+        self.assertEqual(
+            self.index.datasets(primary=NODE_A, deleted=False),
+            [(DATASET_1, self.a)])
+
+    def test_pages(self):
+        """
+        ``limit`` and ``after`` find successive pages of datasets.
+        """
+        first = self.index.datasets(limit=3)
+        second = self.index.datasets(
+            after=first[-1][0].dataset_id, limit=3)
+        self.assertEqual(
+            (first, second),
+            ([(DATASET_1, self.a), (DATASET_2, self.b), (DATASET_3, self.a)],
+             [(DATASET_4, self.b)]))
+
+    def test_filtered_pages(self):
+        """
+        ``limit`` and ``after`` apply to the filtered datasets.
+        """
+        self.assertEqual(
+            self.index.datasets(
+                deleted=False, after=DATASET_1.dataset_id, limit=1),
+            [(DATASET_2, self.b)])
+
+    def test_duplicates_not_split(self):
+        """
+        If several nodes claim to be primary for a dataset they are all
+        found on the same page.
+        """
+        state = DeploymentState(nodes={
+            NodeState(uuid=uuid, hostname=hostname,
+                      manifestations=_manifestations([DATASET_1]))
+            for uuid, hostname in [(NODE_A, u"a"), (NODE_B, u"b")]
+        })
+        found = DeploymentIndex(state).datasets(limit=1)
+        self.assertEqual(
+            sorted(node.uuid for dataset, node in found), [NODE_A, NODE_B])
+
+
+class ContainersTests(SynchronousTestCase):
+    """
+    Tests for ``DeploymentIndex.containers``.
+    """
+    def setUp(self):
+        self.index = DeploymentIndex(DEPLOYMENT)
+
+    def names(self, found):
+        """
+        Get the names of found containers.
+
+        :param list found: ``(Application, Node)`` tuples.
+
+        :return: ``list`` of ``(name, node UUID)`` tuples.
+        """
+        return [(application.name, node.uuid) for application, node in found]
+
+    def test_all(self):
+        """
+        With no arguments all containers are found, with their nodes, in
+        order of name.
+        """
+        self.assertEqual(
+            self.names(self.index.containers()),
+            [(u"db", NODE_A), (u"web-1", NODE_A), (u"web-2", NODE_B)])
+
+    def test_node(self):
+        """
+        With ``node_uuid`` only containers on that node are found.
+        """
+        self.assertEqual(
+            self.names(self.index.containers(node_uuid=NODE_A)),
+            [(u"db", NODE_A), (u"web-1", NODE_A)])
+
+    def test_prefix(self):
+        """
+        With ``prefix`` only containers whose names start with it are found.
+        """
+        self.assertEqual(
+            self.names(self.index.containers(prefix=u"web-")),
+            [(u"web-1", NODE_A), (u"web-2", NODE_B)])
+
+    def test_prefix_pages(self):
+        """
+        ``prefix``, ``after`` and ``limit`` can be combined.
+        """
+        self.assertEqual(
+            self.names(self.index.containers(
+                prefix=u"web-", after=u"web-1", limit=1)),
+            [(u"web-2", NODE_B)])
+
+    def test_no_applications(self):
+        """
+        Nodes whose applications are unknown have no containers.
+        """
+        index = DeploymentIndex(DeploymentState(nodes={
+            NodeState(uuid=NODE_A, hostname=u"a", applications=None)}))
+        self.assertEqual(index.containers(), [])
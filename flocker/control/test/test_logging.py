@@ -0,0 +1,129 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+
+"""
+Tests for ``flocker.control._logging``.
+"""
+
+from uuid import UUID
+
+from twisted.trial.unittest import SynchronousTestCase
+
+from .._logging import (
+    summarize, serialize_state, state_field, full_state_logging,
+    set_full_state_logging,
+)
+from .._model import (
+    Application, DockerImage, Deployment, DeploymentState, Node, NodeState,
+    Manifestation, Dataset, NonManifestDatasets,
+)
+
+DATASET = Dataset(dataset_id=unicode(UUID(int=1)))
+MANIFESTATIONS = {DATASET.dataset_id: Manifestation(dataset=DATASET,
+                                                    primary=True)}
+APPLICATION = Application(name=u"web",
+                          image=DockerImage.from_string(u"busybox"))
+NODE = Node(uuid=UUID(int=2), manifestations=MANIFESTATIONS,
+            applications={APPLICATION})
+NODE_STATE = NodeState(uuid=UUID(int=2), hostname=u"192.0.2.1",
+                       manifestations=MANIFESTATIONS,
+                       applications={APPLICATION})
+
+
+class SummarizeTests(SynchronousTestCase):
+    """
+    Tests for ``summarize``.
+    """
+    def test_deployment(self):
+        """
+        A ``Deployment`` is summarized by its numbers of nodes, datasets and
+        applications, and its hash.
+        """
+        deployment = Deployment(nodes={NODE, Node(uuid=UUID(int=3))})
+        self.assertEqual(
+            summarize(deployment),
+            {u"type": u"Deployment", u"nodes": 2, u"datasets": 1,
+             u"applications": 1, u"hash": hash(deployment)})
+
+    def test_deployment_state(self):
+        """
+        The datasets of a ``DeploymentState`` include those which aren't
+        manifest anywhere.  Nodes whose datasets and applications are unknown
+        have none.
+        """
+        other = Dataset(dataset_id=unicode(UUID(int=4)))
+        state = DeploymentState(
+            nodes={NODE_STATE,
+                   NodeState(uuid=UUID(int=3), hostname=u"192.0.2.2")},
+            nonmanifest_datasets={other.dataset_id: other})
+        self.assertEqual(
+            summarize(state),
+            {u"type": u"DeploymentState", u"nodes": 2, u"datasets": 2,
+             u"applications": 1, u"hash": hash(state)})
+
+    def test_node_state(self):
+        """
+        A ``NodeState`` is summarized like a deployment with one node.
+        """
+        self.assertEqual(
+            summarize(NODE_STATE),
+            {u"type": u"NodeState", u"nodes": 1, u"datasets": 1,
+             u"applications": 1, u"hash": hash(NODE_STATE)})
+
+    def test_non_manifest_datasets(self):
+        """
+        ``NonManifestDatasets`` is summarized by its number of datasets.
+        """
+        datasets = NonManifestDatasets(
+            datasets={DATASET.dataset_id: DATASET})
+        self.assertEqual(
+            summarize(datasets),
+            {u"type": u"NonManifestDatasets", u"datasets": 1,
+             u"hash": hash(datasets)})
+
+    def test_sequence(self):
+        """
+        Lists and tuples are summarized item by item.
+        """
+        self.assertEqual(
+            (summarize([NODE_STATE]), summarize((NODE_STATE,))),
+            ([summarize(NODE_STATE)], [summarize(NODE_STATE)]))
+
+    def test_other(self):
+        """
+        Anything else is summarized by its ``repr``.
+        """
+        self.assertEqual(summarize(DATASET), repr(DATASET))
+
+
+class SerializeStateTests(SynchronousTestCase):
+    """
+    Tests for ``serialize_state`` and ``state_field``.
+    """
+    def setUp(self):
+        self.addCleanup(set_full_state_logging, full_state_logging())
+
+    def test_summary(self):
+        """
+        By default values are summarized.
+        """
+        set_full_state_logging(False)
+        self.assertEqual(serialize_state(NODE_STATE), summarize(NODE_STATE))
+
+    def test_full(self):
+        """
+        With full state logging enabled values are serialized with ``repr``.
+        """
+        set_full_state_logging(True)
+        self.assertEqual(
+            (full_state_logging(), serialize_state(NODE_STATE)),
+            (True, repr(NODE_STATE)))
+
+    def test_field(self):
+        """
+        ``state_field`` creates a field serialized with ``serialize_state``.
+        """
+        set_full_state_logging(False)
+        field = state_field(u"state", u"The state.")
+        self.assertEqual(
+            (field.key, field.serialize(NODE_STATE)),
+            (u"state", summarize(NODE_STATE)))
@@ -8,7 +8,7 @@ from uuid import uuid4, UUID
 
 from pyrsistent import (
     InvariantException, pset, PRecord, PSet, pmap, PMap, thaw, PVector,
-    pvector
+    pvector, discard,
 )
 
 from twisted.trial.unittest import SynchronousTestCase
@@ -17,7 +17,11 @@ from twisted.python.filepath import FilePath
 from zope.interface.verify import verifyObject
 
 from ...testtools import make_with_init_tests
-from .._model import pset_field, pmap_field, pvector_field, ip_to_uuid
+from .._model import (
+    pset_field, pmap_field, pvector_field, ip_to_uuid, DeploymentDiff,
+    DeploymentStateDiff, diff_deployments, diff_deployment_states,
+    _InstanceCache,
+)
 from .. import (
     IClusterStateChange,
     Application, DockerImage, Node, Deployment, AttachedVolume, Dataset,
@@ -397,6 +401,19 @@ class NonManifestDatasetsTests(SynchronousTestCase):
             datasets, thaw(updated.nonmanifest_datasets)
         )
 
+    def test_update_cluster_state_unchanged(self):
+        """
+        ``NonManifestDatasets.update_cluster_state`` returns the given
+        ``DeploymentState`` if its ``nonmanifest_datasets`` already match.
+        """
+        dataset = Dataset(dataset_id=unicode(uuid4()))
+        datasets = {dataset.dataset_id: dataset}
+        deployment = DeploymentState(nonmanifest_datasets=datasets)
+        self.assertIs(
+            NonManifestDatasets(datasets=datasets).update_cluster_state(
+                deployment),
+            deployment)
+
 
 class DeploymentInitTests(make_with_init_tests(
         record_type=Deployment,
@@ -465,6 +482,205 @@ class GetNodeTests(SynchronousTestCase):
             state.get_node(identifier, hostname=u"1.2.3.4"),
         )
 
+    def test_deployment_after_update(self):
+        """
+        ``Deployment.get_node`` returns the new version of a node replaced
+        by ``Deployment.update_node``.
+        """
+        identifier = uuid4()
+        node = Node(uuid=identifier, applications={APP1})
+        trap = Node(uuid=uuid4())
+        config = Deployment(nodes={node, trap})
+        config.get_node(identifier)
+        updated = node.set(applications={APP2})
+        self.assertEqual(
+            config.update_node(updated).get_node(identifier), updated)
+
+    def test_deploymentstate_after_update(self):
+        """
+        ``DeploymentState.get_node`` returns the new version of a node
+        updated by ``DeploymentState.update_node``.
+        """
+        identifier = uuid4()
+        node = NodeState(uuid=identifier, hostname=u"1.2.3.4",
+                         applications={APP1})
+        state = DeploymentState(nodes={node})
+        state.get_node(identifier)
+        updated = node.set(applications={APP2})
+        self.assertEqual(
+            state.update_node(updated).get_node(identifier), updated)
+
+
+class DatasetManifestationsTests(SynchronousTestCase):
+    """
+    Tests for ``Deployment.dataset_manifestations`` and
+    ``DeploymentState.dataset_manifestations``.
+    """
+    NODE = Node(uuid=uuid4(),
+                manifestations={MANIFESTATION.dataset_id: MANIFESTATION})
+    REPLICA = Node(uuid=uuid4(), manifestations={
+        MANIFESTATION.dataset_id: MANIFESTATION.set(primary=False)})
+    OTHER = Node(uuid=uuid4())
+
+    def assertManifestations(self, deployment, dataset_id, expected):
+        """
+        Assert that ``dataset_manifestations`` returns the expected
+        manifestations, and that they match what a fresh ``Deployment`` with
+        the same nodes returns.
+
+        :param deployment: A ``Deployment``.
+        :param unicode dataset_id: A dataset ID.
+        :param set expected: The expected ``(Manifestation, Node)`` pairs.
+        """
+        fresh = Deployment(nodes=list(deployment.nodes))
+        self.assertEqual(
+            (set(deployment.dataset_manifestations(dataset_id)),
+             set(fresh.dataset_manifestations(dataset_id))),
+            (expected, expected))
+
+    def test_manifestations(self):
+        """
+        ``dataset_manifestations`` returns a ``(Manifestation, Node)`` pair
+        for each node with a manifestation of the dataset.
+        """
+        deployment = Deployment(nodes={self.NODE, self.REPLICA, self.OTHER})
+        self.assertManifestations(
+            deployment, MANIFESTATION.dataset_id,
+            {(MANIFESTATION, self.NODE),
+             (self.REPLICA.manifestations[MANIFESTATION.dataset_id],
+              self.REPLICA)})
+
+    def test_unknown_dataset(self):
+        """
+        ``dataset_manifestations`` returns an empty result for a dataset
+        which has no manifestations.
+        """
+        deployment = Deployment(nodes={self.NODE})
+        self.assertEqual(deployment.dataset_manifestations(u"unknown"), ())
+
+    def test_unknown_manifestations(self):
+        """
+        ``DeploymentState.dataset_manifestations`` ignores nodes whose
+        manifestations are unknown.
+        """
+        node = NodeState(uuid=uuid4(), hostname=u"1.2.3.4",
+                         manifestations={
+                             MANIFESTATION.dataset_id: MANIFESTATION})
+        unknown = NodeState(uuid=uuid4(), hostname=u"1.2.3.5",
+                            manifestations=None)
+        state = DeploymentState(nodes={node, unknown})
+        self.assertEqual(state.dataset_manifestations(
+            MANIFESTATION.dataset_id), ((MANIFESTATION, node),))
+
+    def test_moved(self):
+        """
+        ``dataset_manifestations`` reflects a dataset being moved from one
+        node to another by ``update_node``.
+        """
+        deployment = Deployment(nodes={self.NODE, self.OTHER})
+        deployment.dataset_manifestations(MANIFESTATION.dataset_id)
+        deployment = deployment.update_node(
+            self.NODE.transform(
+                ["manifestations", MANIFESTATION.dataset_id], discard))
+        other = self.OTHER.transform(
+            ["manifestations", MANIFESTATION.dataset_id], MANIFESTATION)
+        deployment = deployment.update_node(other)
+        self.assertManifestations(deployment, MANIFESTATION.dataset_id,
+                                  {(MANIFESTATION, other)})
+
+    def test_changed(self):
+        """
+        ``dataset_manifestations`` reflects a manifestation being changed by
+        ``update_node``.
+        """
+        deployment = Deployment(nodes={self.NODE, self.REPLICA})
+        deployment.dataset_manifestations(MANIFESTATION.dataset_id)
+        resized = MANIFESTATION.transform(
+            ["dataset", "maximum_size"], 1024 * 1024 * 1024)
+        node = self.NODE.transform(
+            ["manifestations", MANIFESTATION.dataset_id], resized)
+        deployment = deployment.update_node(node)
+        self.assertManifestations(
+            deployment, MANIFESTATION.dataset_id,
+            {(resized, node),
+             (self.REPLICA.manifestations[MANIFESTATION.dataset_id],
+              self.REPLICA)})
+
+
+class InstanceCacheTests(SynchronousTestCase):
+    """
+    Tests for ``_InstanceCache``.
+    """
+    def setUp(self):
+        self.computed = []
+
+        def compute(obj):
+            self.computed.append(obj)
+            return len(obj)
+        self.cache = _InstanceCache(compute, size=2)
+
+    def test_computed(self):
+        """
+        ``_InstanceCache.get`` returns the value computed for an object.
+        """
+        self.assertEqual(self.cache.get(pset([1, 2])), 2)
+
+    def test_cached(self):
+        """
+        The value for an object is only computed once.
+        """
+        obj = pset([1, 2])
+        self.cache.get(obj)
+        self.cache.get(obj)
+        self.assertEqual(self.computed, [obj])
+
+    def test_identity(self):
+        """
+        Values are cached by identity, not equality.
+        """
+        self.cache.get(pset([1, 2]))
+        self.cache.get(pset([1, 2]))
+        self.assertEqual(len(self.computed), 2)
+
+    def test_least_recently_used(self):
+        """
+        Once the cache is full, adding another object evicts the least
+        recently used one.
+        """
+        first, second, third = pset([1]), pset([2]), pset([3])
+        self.cache.get(first)
+        self.cache.get(second)
+        self.cache.get(first)
+        self.cache.get(third)
+        self.cache.get(first)
+        self.cache.get(second)
+        self.assertEqual(self.computed, [first, second, third, second])
+
+    def test_seed(self):
+        """
+        ``_InstanceCache.seed`` stores a value which ``_InstanceCache.get``
+        then returns without computing it.
+        """
+        obj = pset([1, 2])
+        self.cache.seed(obj, 5)
+        self.assertEqual((self.cache.get(obj), self.computed), (5, []))
+
+    def test_peek(self):
+        """
+        ``_InstanceCache.peek`` returns the cached value for an object.
+        """
+        obj = pset([1, 2])
+        self.cache.get(obj)
+        self.assertEqual(self.cache.peek(obj), 2)
+
+    def test_peek_not_cached(self):
+        """
+        ``_InstanceCache.peek`` returns ``None`` for an object with no cached
+        value, without computing one.
+        """
+        self.assertEqual((self.cache.peek(pset([1, 2])), self.computed),
+                         (None, []))
+
 
 class DeploymentTests(SynchronousTestCase):
     """
@@ -769,6 +985,16 @@ class PSetFieldTests(SynchronousTestCase):
         record = Record(value=[1, 2])
         assert isinstance(record.value, PSet)
 
+    def test_factory_checked(self):
+        """
+        ``pset_field``'s factory reuses an existing set of the field's own
+        type rather than creating a new one.
+        """
+        class Record(PRecord):
+            value = pset_field(int)
+        record = Record(value=[1, 2])
+        assert record.set(value=record.value).value is record.value
+
     def test_checked_set(self):
         """
         ``pset_field`` results in a set that enforces its type.
@@ -987,6 +1213,16 @@ class PMapFieldTests(SynchronousTestCase):
         record = Record(value={1:  1234})
         assert isinstance(record.value, PMap)
 
+    def test_factory_checked(self):
+        """
+        ``pmap_field``'s factory reuses an existing map of the field's own
+        type rather than creating a new one.
+        """
+        class Record(PRecord):
+            value = pmap_field(int, int)
+        record = Record(value={1:  1234})
+        assert record.set(value=record.value).value is record.value
+
     def test_checked_map_key(self):
         """
         ``pmap_field`` results in a map that enforces its key type.
@@ -1142,6 +1378,19 @@ class DeploymentStateTests(SynchronousTestCase):
             update_manifestations)
         self.assertEqual(updated, DeploymentState(nodes=[end_node]))
 
+    def test_update_node_unchanged(self):
+        """
+        When doing ``update_node()``, if the given ``NodeState`` doesn't
+        change the existing ``NodeState`` the original ``DeploymentState`` is
+        returned.
+        """
+        node = NodeState(hostname=u"node1.example.com", used_ports=[1, 2])
+        original = DeploymentState(nodes=[node])
+        self.assertIs(
+            original.update_node(NodeState(hostname=u"node1.example.com",
+                                           used_ports=[1, 2])),
+            original)
+
     def test_nonmanifest_datasets_keys_are_their_ids(self):
         """
         The keys of the ``nonmanifest_datasets`` attribute must match the
@@ -1152,6 +1401,141 @@ class DeploymentStateTests(SynchronousTestCase):
                           nonmanifest_datasets={u"123": MANIFESTATION.dataset})
 
 
+class DiffDeploymentsTests(SynchronousTestCase):
+    """
+    Tests for ``diff_deployments`` and ``DeploymentDiff``.
+    """
+    NODE = Node(uuid=uuid4(), applications={APP1})
+    OTHER_NODE = Node(uuid=uuid4(), applications={APP2})
+
+    def assertRoundTrip(self, old, new):
+        """
+        Assert that the diff between two ``Deployment`` instances turns the
+        first into the second when applied.
+
+        :return DeploymentDiff: The diff.
+        """
+        diff = diff_deployments(old, new)
+        self.assertEqual(diff.apply(old), new)
+        return diff
+
+    def test_unchanged(self):
+        """
+        The diff between equal ``Deployment`` instances is empty.
+        """
+        deployment = Deployment(nodes={self.NODE, self.OTHER_NODE})
+        diff = self.assertRoundTrip(
+            deployment, Deployment(nodes={self.NODE, self.OTHER_NODE}))
+        self.assertEqual(diff, DeploymentDiff())
+
+    def test_added(self):
+        """
+        A node which was added is included in the diff's ``changed_nodes``.
+        """
+        diff = self.assertRoundTrip(
+            Deployment(nodes={self.NODE}),
+            Deployment(nodes={self.NODE, self.OTHER_NODE}))
+        self.assertEqual(diff, DeploymentDiff(changed_nodes={self.OTHER_NODE}))
+
+    def test_changed(self):
+        """
+        A node whose configuration changed is included in the diff's
+        ``changed_nodes``, replacing the old version when applied.
+        """
+        changed = self.NODE.transform(["applications"], {APP2})
+        diff = self.assertRoundTrip(
+            Deployment(nodes={self.NODE, self.OTHER_NODE}),
+            Deployment(nodes={changed, self.OTHER_NODE}))
+        self.assertEqual(diff, DeploymentDiff(changed_nodes={changed}))
+
+    def test_removed(self):
+        """
+        The UUID of a node which was removed is included in the diff's
+        ``removed_nodes``.
+        """
+        diff = self.assertRoundTrip(
+            Deployment(nodes={self.NODE, self.OTHER_NODE}),
+            Deployment(nodes={self.NODE}))
+        self.assertEqual(
+            diff, DeploymentDiff(removed_nodes={self.OTHER_NODE.uuid}))
+
+
+class DiffDeploymentStatesTests(SynchronousTestCase):
+    """
+    Tests for ``diff_deployment_states`` and ``DeploymentStateDiff``.
+    """
+    NODE = NodeState(uuid=uuid4(), hostname=u"192.0.2.1",
+                     applications={APP1}, used_ports={80})
+    OTHER_NODE = NodeState(uuid=uuid4(), hostname=u"192.0.2.2",
+                           applications={APP2})
+
+    def assertRoundTrip(self, old, new):
+        """
+        Assert that the diff between two ``DeploymentState`` instances turns
+        the first into the second when applied.
+
+        :return DeploymentStateDiff: The diff.
+        """
+        diff = diff_deployment_states(old, new)
+        self.assertEqual(diff.apply(old), new)
+        return diff
+
+    def test_unchanged(self):
+        """
+        The diff between equal ``DeploymentState`` instances is empty.
+        """
+        state = DeploymentState(
+            nodes={self.NODE},
+            nonmanifest_datasets={MANIFESTATION.dataset_id:
+                                  MANIFESTATION.dataset})
+        diff = self.assertRoundTrip(state, state.set(nodes={self.NODE}))
+        self.assertEqual(diff, DeploymentStateDiff())
+
+    def test_nodes(self):
+        """
+        Added, changed and removed nodes are included in the diff.
+        """
+        changed = self.NODE.set(applications={APP2})
+        added = NodeState(uuid=uuid4(), hostname=u"192.0.2.3")
+        diff = self.assertRoundTrip(
+            DeploymentState(nodes={self.NODE, self.OTHER_NODE}),
+            DeploymentState(nodes={changed, added}))
+        self.assertEqual(
+            diff, DeploymentStateDiff(changed_nodes={changed, added},
+                                      removed_nodes={self.OTHER_NODE.uuid}))
+
+    def test_nodes_replaced(self):
+        """
+        Changed nodes replace the old ``NodeState`` rather than being merged
+        with it, so information which is no longer known is removed.
+        """
+        self.assertRoundTrip(
+            DeploymentState(nodes={self.NODE}),
+            DeploymentState(nodes={self.NODE.set(used_ports=None)}))
+
+    def test_nonmanifest_datasets(self):
+        """
+        Added, changed and removed non-manifest datasets are included in the
+        diff.
+        """
+        dataset = MANIFESTATION.dataset
+        changed = dataset.set(maximum_size=1024 * 1024 * 1024)
+        added = Dataset(dataset_id=unicode(uuid4()))
+        removed = Dataset(dataset_id=unicode(uuid4()))
+        diff = self.assertRoundTrip(
+            DeploymentState(nonmanifest_datasets={
+                dataset.dataset_id: dataset,
+                removed.dataset_id: removed}),
+            DeploymentState(nonmanifest_datasets={
+                changed.dataset_id: changed,
+                added.dataset_id: added}))
+        self.assertEqual(
+            diff, DeploymentStateDiff(
+                changed_nonmanifest_datasets={
+                    changed.dataset_id: changed, added.dataset_id: added},
+                removed_nonmanifest_datasets={removed.dataset_id}))
+
+
 class SameNodeTests(SynchronousTestCase):
     """
     Tests for ``same_node``.
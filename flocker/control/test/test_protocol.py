@@ -4,6 +4,8 @@
 Tests for ``flocker.control._protocol``.
 """
 
+import zlib
+from json import dumps, loads
 from uuid import uuid4
 
 from zope.interface import implementer
@@ -12,30 +14,45 @@ from zope.interface.verify import verifyObject
 from characteristic import attributes, Attribute
 
 from eliot import ActionType, start_action, MemoryLogger, Logger
-from eliot.testing import validate_logging, assertHasAction, LoggedAction
+from eliot.testing import (
+    validate_logging, assertHasAction, assertHasMessage, LoggedAction,
+    LoggedMessage,
+)
 
 from twisted.trial.unittest import SynchronousTestCase
 from twisted.test.proto_helpers import StringTransport, MemoryReactor
-from twisted.protocols.amp import UnknownRemoteError, RemoteAmpError, AMP
+from twisted.protocols.amp import (
+    UnknownRemoteError, RemoteAmpError, AMP, MAX_VALUE_LENGTH, ListOf,
+)
 from twisted.python.failure import Failure
 from twisted.internet.error import ConnectionLost
 from twisted.internet.endpoints import TCP4ServerEndpoint
 from twisted.internet.defer import succeed, fail
+from twisted.internet.task import Clock
+from twisted.test.iosim import connectedServerAndClient
 from twisted.python.filepath import FilePath
 from twisted.application.internet import StreamServerEndpointService
 
+from .. import _protocol
 from .._protocol import (
-    SerializableArgument,
+    SerializableArgument, _CachingEncoder, _BroadcastScheduler,
     VersionCommand, ClusterStatusCommand, NodeStateCommand, IConvergenceAgent,
     AgentAMP, ControlAMPService, ControlAMP, _AgentLocator,
     ControlServiceLocator, LOG_SEND_CLUSTER_STATE, LOG_SEND_TO_AGENT,
+    LOG_COALESCED_BROADCAST, ClusterStatusDiffCommand, GenerationMismatch,
+    LOG_PAYLOAD_STATISTICS,
+    COMPACT_ENCODING, CAPABILITIES, ZLIB_COMPRESSION, PayloadStatistics,
+    LARGE_VALUES, _SerializableListArgument, _COMPACT_PREFIX,
 )
 from .._clusterstate import ClusterStateService
 from .. import (
     Deployment, Application, DockerImage, Node, NodeState, Manifestation,
     Dataset, DeploymentState, NonManifestDatasets,
 )
-from .._persistence import ConfigurationPersistenceService
+from .._model import DeploymentDiff, DeploymentStateDiff
+from .._persistence import (
+    ConfigurationPersistenceService, wire_encode, _COMPACT_FIELDS)
+from ...common.test.test_thread import NonThreadPool, NonReactor
 
 
 class LoopbackAMPClient(object):
@@ -106,6 +123,63 @@ NONMANIFEST = NonManifestDatasets(
 del dataset
 
 
+def large_deployment():
+    """
+    Create a ``Deployment`` whose encoding is too long to fit in a single AMP
+    value, even using the compact encoding.
+
+    :return Deployment: The configuration.
+    """
+    return Deployment(nodes=[
+        Node(uuid=uuid4(), applications=[
+            Application(name=u"app%d" % (i,),
+                        image=DockerImage.from_string(u"app%d" % (i,)))
+            for i in range(50)])
+        for j in range(50)])
+
+
+def invalid_compact_node_state():
+    """
+    Create the compact encoding of a ``NodeState`` whose UUID is not a
+    ``UUID``.
+
+    :return bytes: A value for ``SerializableArgument(NodeState)``.
+    """
+    as_bytes = SerializableArgument(NodeState).toStringProto(
+        NODE_STATE, CompactPeer())
+    value = loads(as_bytes[len(_COMPACT_PREFIX):])
+    value[_COMPACT_FIELDS[NodeState].index(u"uuid") + 1] = u"not a uuid"
+    return _COMPACT_PREFIX + dumps(value)
+
+
+class CompactPeer(object):
+    """
+    The sending side of a connection whose other side supports the compact
+    encoding.
+    """
+    peer_capabilities = frozenset([COMPACT_ENCODING])
+
+
+class LargeValuesPeer(object):
+    """
+    The sending side of a connection whose other side supports the compact
+    encoding and values too long for AMP.
+    """
+    peer_capabilities = frozenset([COMPACT_ENCODING, LARGE_VALUES])
+
+
+class CompressingPeer(object):
+    """
+    The sending side of a connection whose other side supports compression.
+
+    :ivar PayloadStatistics payload_statistics: Counts the values sent.
+    """
+    peer_capabilities = frozenset([ZLIB_COMPRESSION])
+
+    def __init__(self):
+        self.payload_statistics = PayloadStatistics()
+
+
 class SerializationTests(SynchronousTestCase):
     """
     Tests for argument serialization.
@@ -143,6 +217,31 @@ class SerializationTests(SynchronousTestCase):
             [type(as_bytes), deserialized],
         )
 
+    def test_deploymentdiff(self):
+        """
+        ``SerializableArgument`` can round-trip a ``DeploymentDiff`` instance.
+        """
+        diff = DeploymentDiff(
+            changed_nodes=TEST_DEPLOYMENT.nodes, removed_nodes=[uuid4()])
+        argument = SerializableArgument(DeploymentDiff)
+        as_bytes = argument.toString(diff)
+        deserialized = argument.fromString(as_bytes)
+        self.assertEqual([bytes, diff], [type(as_bytes), deserialized])
+
+    def test_deploymentstatediff(self):
+        """
+        ``SerializableArgument`` can round-trip a ``DeploymentStateDiff``
+        instance.
+        """
+        diff = DeploymentStateDiff(
+            changed_nodes=[NODE_STATE], removed_nodes=[uuid4()],
+            changed_nonmanifest_datasets=NONMANIFEST.datasets,
+            removed_nonmanifest_datasets=[unicode(uuid4())])
+        argument = SerializableArgument(DeploymentStateDiff)
+        as_bytes = argument.toString(diff)
+        deserialized = argument.fromString(as_bytes)
+        self.assertEqual([bytes, diff], [type(as_bytes), deserialized])
+
     def test_multiple_type_serialization(self):
         """
         ``SerializableArgument`` can be given multiple types to allow instances
@@ -181,23 +280,437 @@ class SerializationTests(SynchronousTestCase):
         self.assertRaises(
             TypeError, SerializableArgument(NodeState).fromString, as_bytes)
 
+    def test_plain_encoding(self):
+        """
+        ``SerializableArgument`` uses ``wire_encode`` if the other side of the
+        connection doesn't support the compact encoding.
+        """
+        argument = SerializableArgument(Deployment)
+        self.assertEqual(argument.toStringProto(TEST_DEPLOYMENT, AMP()),
+                         wire_encode(TEST_DEPLOYMENT))
+
+    def test_compact_encoding(self):
+        """
+        ``SerializableArgument`` uses the compact encoding if the other side
+        of the connection supports it, and can decode the result.
+        """
+        argument = SerializableArgument(Deployment)
+        as_bytes = argument.toStringProto(TEST_DEPLOYMENT, CompactPeer())
+        self.assertEqual(
+            [len(as_bytes) < len(wire_encode(TEST_DEPLOYMENT)),
+             argument.fromStringProto(as_bytes, CompactPeer())],
+            [True, TEST_DEPLOYMENT])
+
+    def test_compact_not_negotiated(self):
+        """
+        ``SerializableArgument`` rejects values in the compact encoding
+        received on a connection which didn't negotiate it.
+        """
+        argument = SerializableArgument(Deployment)
+        as_bytes = argument.toStringProto(TEST_DEPLOYMENT, CompactPeer())
+        self.assertRaises(ValueError, argument.fromStringProto, as_bytes,
+                          AMP())
+
+    def test_compact_checked(self):
+        """
+        Values in the compact encoding from a peer which isn't trusted, i.e.
+        an agent, are checked like any other.
+        """
+        argument = SerializableArgument(NodeState)
+        self.assertRaises(TypeError, argument.fromStringProto,
+                          invalid_compact_node_state(), CompactPeer())
+
+    def test_compact_trusted(self):
+        """
+        Values in the compact encoding from a trusted peer, i.e. the control
+        service, are decoded without checking them.
+        """
+        class TrustedPeer(CompactPeer):
+            peer_trusted = True
+
+        argument = SerializableArgument(NodeState)
+        self.assertEqual(
+            argument.fromStringProto(
+                invalid_compact_node_state(), TrustedPeer()).uuid,
+            u"not a uuid")
+
+    def test_not_chunked(self):
+        """
+        ``SerializableArgument`` puts values short enough for AMP in a single
+        key of the box.
+        """
+        strings = {}
+        SerializableArgument(Deployment).toBox(
+            b"configuration", strings, {"configuration": TEST_DEPLOYMENT},
+            AMP())
+        self.assertEqual(strings,
+                         {b"configuration": wire_encode(TEST_DEPLOYMENT)})
+
+    def test_chunked(self):
+        """
+        ``SerializableArgument`` splits values too long for AMP across
+        several keys of the box if the other side of the connection
+        supports it, and joins them back together when decoding.
+        """
+        deployment = large_deployment()
+        argument = SerializableArgument(Deployment)
+        strings = {}
+        argument.toBox(b"configuration", strings,
+                       {"configuration": deployment}, LargeValuesPeer())
+        lengths = [len(value) for value in strings.values()]
+        objects = {}
+        argument.fromBox(b"configuration", strings, objects,
+                         LargeValuesPeer())
+        self.assertEqual(
+            [len(lengths) > 1, max(lengths) <= MAX_VALUE_LENGTH,
+             objects, strings],
+            [True, True, {"configuration": deployment}, {}])
+
+    def test_not_chunked_without_capability(self):
+        """
+        ``SerializableArgument`` doesn't split values if the other side of
+        the connection doesn't support it, so older versions aren't sent
+        keys they don't understand.
+        """
+        strings = {}
+        SerializableArgument(Deployment).toBox(
+            b"configuration", strings, {"configuration": large_deployment()},
+            CompactPeer())
+        self.assertEqual(strings.keys(), [b"configuration"])
+
+    def test_list_chunked(self):
+        """
+        Lists of state changes are sent using the compact encoding if the
+        other side of the connection supports it, and split across several
+        keys of the box if they are too long for AMP.
+        """
+        changes = [NodeState(hostname=u"10.0.0.%d" % (i,), uuid=uuid4(),
+                             applications=node.applications)
+                   for i, node in enumerate(large_deployment().nodes)]
+        box = NodeStateCommand.makeArguments(
+            {"state_changes": changes, "eliot_context": TEST_ACTION},
+            LargeValuesPeer())
+        lengths = [len(value) for value in box.values()]
+        locator = ControlServiceLocator(
+            build_control_amp_service(self), LargeValuesPeer())
+        self.assertEqual(
+            [len(lengths) > 2, max(lengths) <= MAX_VALUE_LENGTH,
+             NodeStateCommand.parseArguments(box, locator)["state_changes"]],
+            [True, True, changes])
+
+    def test_large_list_item(self):
+        """
+        Items of lists of state changes may be longer than 64KiB if the other
+        side of the connection supports it.
+        """
+        change = NodeState(hostname=u"10.0.0.1", uuid=uuid4(), applications=[
+            Application(name=u"app%d" % (i,),
+                        image=DockerImage.from_string(u"app%d" % (i,)))
+            for i in range(2000)])
+        argument = _SerializableListArgument(NodeState)
+        as_bytes = argument.toStringProto([change, NODE_STATE],
+                                          LargeValuesPeer())
+        self.assertEqual(
+            [len(as_bytes) > 2 ** 16,
+             argument.fromStringProto(as_bytes, LargeValuesPeer())],
+            [True, [change, NODE_STATE]])
+
+    def test_list_without_capability(self):
+        """
+        Lists of state changes are encoded like ``ListOf`` does if the other
+        side of the connection doesn't support values too long for AMP.
+        """
+        as_bytes = _SerializableListArgument(NodeState).toStringProto(
+            [NODE_STATE, NODE_STATE], AMP())
+        self.assertEqual(
+            ListOf(SerializableArgument(NodeState)).fromString(as_bytes),
+            [NODE_STATE, NODE_STATE])
+
+    def test_compressed(self):
+        """
+        ``SerializableArgument`` compresses large values if the other side of
+        the connection supports it, and can decode the result.
+        """
+        deployment = large_deployment()
+        argument = SerializableArgument(Deployment)
+        as_bytes = argument.toStringProto(deployment, CompressingPeer())
+        self.assertEqual(
+            [len(as_bytes) < len(wire_encode(deployment)) / 4,
+             argument.fromString(as_bytes)],
+            [True, deployment])
+
+    def test_small_not_compressed(self):
+        """
+        ``SerializableArgument`` doesn't compress small values.
+        """
+        argument = SerializableArgument(Deployment)
+        self.assertEqual(
+            argument.toStringProto(TEST_DEPLOYMENT, CompressingPeer()),
+            wire_encode(TEST_DEPLOYMENT))
+
+    def test_not_compressed_without_capability(self):
+        """
+        ``SerializableArgument`` doesn't compress values if the other side of
+        the connection doesn't support it.
+        """
+        deployment = large_deployment()
+        argument = SerializableArgument(Deployment)
+        self.assertEqual(argument.toStringProto(deployment, AMP()),
+                         wire_encode(deployment))
+
+    def test_compact_compressed(self):
+        """
+        Values can be both compressed and in the compact encoding.
+        """
+        class Peer(CompressingPeer):
+            peer_capabilities = CAPABILITIES
+
+        deployment = large_deployment()
+        argument = SerializableArgument(Deployment)
+        self.assertEqual(
+            argument.fromStringProto(
+                argument.toStringProto(deployment, Peer()), Peer()),
+            deployment)
+
+    def test_statistics(self):
+        """
+        ``SerializableArgument`` counts the bytes it sends before and after
+        compression in the ``payload_statistics`` of the protocol.
+        """
+        deployment = large_deployment()
+        argument = SerializableArgument(Deployment)
+        peer = CompressingPeer()
+        small = argument.toStringProto(TEST_DEPLOYMENT, peer)
+        large = argument.toStringProto(deployment, peer)
+        statistics = peer.payload_statistics
+        self.assertEqual(
+            [statistics.raw_bytes, statistics.sent_bytes,
+             statistics.compressed],
+            [len(small) + len(wire_encode(deployment)),
+             len(small) + len(large), 1])
+
+
+class PayloadStatisticsTests(SynchronousTestCase):
+    """
+    Tests for ``PayloadStatistics``.
+    """
+    def test_parent(self):
+        """
+        Values recorded by a ``PayloadStatistics`` are also recorded by its
+        parent.
+        """
+        parent = PayloadStatistics()
+        first = PayloadStatistics(parent)
+        second = PayloadStatistics(parent)
+        first.record(100, 10)
+        second.record(50, 50)
+        self.assertEqual(
+            [(s.raw_bytes, s.sent_bytes, s.compressed)
+             for s in (first, second, parent)],
+            [(100, 10, 1), (50, 50, 0), (150, 60, 1)])
+
+
+class CachingEncoderTests(SynchronousTestCase):
+    """
+    Tests for ``_CachingEncoder``.
+    """
+    def setUp(self):
+        self.encoded = []
+
+        def encode(obj):
+            self.encoded.append(obj)
+            return wire_encode(obj)
+        self.patch(_protocol, "wire_encode", encode)
+        self.encoder = _CachingEncoder()
+
+    def test_encode(self):
+        """
+        ``_CachingEncoder.encode`` returns the same bytes as ``wire_encode``.
+        """
+        self.assertEqual(self.encoder.encode(TEST_DEPLOYMENT),
+                         wire_encode(TEST_DEPLOYMENT))
+
+    def test_not_cached(self):
+        """
+        Outside of a ``cache`` context every call to
+        ``_CachingEncoder.encode`` encodes the object.
+        """
+        self.encoder.encode(TEST_DEPLOYMENT)
+        self.encoder.encode(TEST_DEPLOYMENT)
+        self.assertEqual(self.encoded, [TEST_DEPLOYMENT] * 2)
+
+    def test_cached(self):
+        """
+        Inside a ``cache`` context an object is only encoded once, and the
+        cached result is returned subsequently.
+        """
+        with self.encoder.cache():
+            first = self.encoder.encode(TEST_DEPLOYMENT)
+            second = self.encoder.encode(TEST_DEPLOYMENT)
+        self.assertEqual((self.encoded, first),
+                         ([TEST_DEPLOYMENT], second))
+
+    def test_cached_by_identity(self):
+        """
+        Equal but distinct objects are cached separately.
+        """
+        with self.encoder.cache():
+            self.encoder.encode(TEST_DEPLOYMENT)
+            self.encoder.encode(TEST_DEPLOYMENT.set(nodes=[]))
+        self.assertEqual(len(self.encoded), 2)
+
+    def test_cache_cleared(self):
+        """
+        The cache is discarded once the ``cache`` context exits.
+        """
+        with self.encoder.cache():
+            self.encoder.encode(TEST_DEPLOYMENT)
+        self.encoder.encode(TEST_DEPLOYMENT)
+        self.assertEqual(self.encoded, [TEST_DEPLOYMENT] * 2)
+
+    def test_nested(self):
+        """
+        A nested ``cache`` context shares the outer cache, which remains
+        active once the nested context exits.
+        """
+        with self.encoder.cache():
+            with self.encoder.cache():
+                self.encoder.encode(TEST_DEPLOYMENT)
+            self.encoder.encode(TEST_DEPLOYMENT)
+        self.assertEqual(self.encoded, [TEST_DEPLOYMENT])
+
+    def test_compress_cached(self):
+        """
+        Inside a ``cache`` context the same encoded data is only compressed
+        once.
+        """
+        compressed = []
+
+        def compress(data):
+            compressed.append(data)
+            return zlib.compress(data)
+        self.patch(_protocol, "compress", compress)
+        with self.encoder.cache():
+            data = self.encoder.encode(TEST_DEPLOYMENT)
+            first = self.encoder.compress(data)
+            second = self.encoder.compress(
+                self.encoder.encode(TEST_DEPLOYMENT))
+        self.assertEqual((compressed, first), ([data], second))
+
+
+class BroadcastSchedulerTests(SynchronousTestCase):
+    """
+    Tests for ``_BroadcastScheduler``.
+    """
+    def setUp(self):
+        self.reactor = Clock()
+        self.broadcasts = []
+        self.scheduler = _BroadcastScheduler(
+            self.reactor, lambda: self.broadcasts.append(
+                self.reactor.seconds()),
+            window=1, max_latency=5)
+
+    def test_delayed(self):
+        """
+        A broadcast happens ``window`` seconds after it is requested.
+        """
+        self.scheduler.schedule()
+        self.reactor.advance(0.5)
+        before = list(self.broadcasts)
+        self.reactor.advance(0.5)
+        self.assertEqual((before, self.broadcasts), ([], [1]))
+
+    def test_coalesced(self):
+        """
+        Requests made before a scheduled broadcast happens are merged into
+        it, postponing it until no request has been made for ``window``
+        seconds.
+        """
+        for i in range(3):
+            self.scheduler.schedule()
+            self.reactor.advance(0.5)
+        self.reactor.pump([0.5] * 10)
+        self.assertEqual(self.broadcasts, [2])
+
+    def test_max_latency(self):
+        """
+        Continuous requests cannot delay a broadcast by more than
+        ``max_latency`` seconds after the first request it includes.
+        """
+        for i in range(20):
+            self.scheduler.schedule()
+            self.reactor.advance(0.5)
+        self.assertEqual(self.broadcasts, [5, 10])
+
+    def test_separate_broadcasts(self):
+        """
+        A request made after a broadcast has happened results in a new
+        broadcast.
+        """
+        self.scheduler.schedule()
+        self.reactor.advance(1)
+        self.scheduler.schedule()
+        self.reactor.advance(1)
+        self.assertEqual(self.broadcasts, [1, 2])
+
+    def test_counters(self):
+        """
+        ``_BroadcastScheduler`` counts requests, broadcasts and the number of
+        requests which were merged into an already scheduled broadcast.
+        """
+        for i in range(3):
+            self.scheduler.schedule()
+        self.reactor.advance(1)
+        self.scheduler.schedule()
+        self.reactor.advance(1)
+        self.assertEqual(
+            (self.scheduler.requests, self.scheduler.broadcasts,
+             self.scheduler.coalesced),
+            (4, 2, 2))
+
+    @validate_logging(None)
+    def test_logging(self, logger):
+        """
+        Each broadcast logs a ``LOG_COALESCED_BROADCAST`` message with the
+        number of requests merged into it.
+        """
+        self.patch(self.scheduler, "logger", logger)
+        for i in range(3):
+            self.scheduler.schedule()
+        self.reactor.advance(1)
+        assertHasMessage(self, logger, LOG_COALESCED_BROADCAST,
+                         dict(coalesced=2))
+
+    def test_cancel(self):
+        """
+        ``_BroadcastScheduler.cancel`` discards a scheduled broadcast.
+        """
+        self.scheduler.schedule()
+        self.scheduler.cancel()
+        self.reactor.advance(5)
+        self.assertEqual((self.broadcasts, self.reactor.getDelayedCalls()),
+                         ([], []))
 
-def build_control_amp_service(test):
+
+def build_control_amp_service(test, reactor=None):
     """
     Create a new ``ControlAMPService``.
 
     :param TestCase test: The test this service is for.
+    :param reactor: The reactor to use, by default a new ``Clock``.
 
     :return ControlAMPService: Not started.
     """
+    if reactor is None:
+        reactor = Clock()
     cluster_state = ClusterStateService()
     cluster_state.startService()
     test.addCleanup(cluster_state.stopService)
     persistence_service = ConfigurationPersistenceService(
-        None, FilePath(test.mktemp()))
+        NonReactor(), FilePath(test.mktemp()), NonThreadPool())
     persistence_service.startService()
     test.addCleanup(persistence_service.stopService)
-    return ControlAMPService(cluster_state, persistence_service,
+    return ControlAMPService(reactor, cluster_state, persistence_service,
                              TCP4ServerEndpoint(MemoryReactor(), 1234))
 
 
@@ -240,7 +753,9 @@ class ControlAMPTests(ControlTestCase):
     Tests for ``ControlAMP`` and ``ControlServiceLocator``.
     """
     def setUp(self):
-        self.control_amp_service = build_control_amp_service(self)
+        self.reactor = Clock()
+        self.control_amp_service = build_control_amp_service(
+            self, self.reactor)
         self.protocol = ControlAMP(self.control_amp_service)
         self.client = LoopbackAMPClient(self.protocol.locator)
 
@@ -271,7 +786,8 @@ class ControlAMPTests(ControlTestCase):
             sent[0],
             (((ClusterStatusCommand,),
               dict(configuration=TEST_DEPLOYMENT,
-                   state=cluster_state))))
+                   state=cluster_state,
+                   generation=1))))
 
     def test_connection_lost(self):
         """
@@ -295,7 +811,36 @@ class ControlAMPTests(ControlTestCase):
         """
         self.assertEqual(
             self.successResultOf(self.client.callRemote(VersionCommand)),
-            {"major": 1})
+            {"major": 1, "capabilities": sorted(CAPABILITIES)})
+
+    def test_version_capabilities(self):
+        """
+        ``VersionCommand`` records the optional protocol features supported
+        by both the agent and the control service on the connection.
+        """
+        self.successResultOf(self.client.callRemote(
+            VersionCommand, capabilities=[COMPACT_ENCODING, u"unknown"]))
+        self.assertEqual(self.protocol.peer_capabilities,
+                         {COMPACT_ENCODING})
+
+    def test_different_compact_schema(self):
+        """
+        The compact encoding isn't used with agents whose model classes
+        differ, since they advertise a different schema.
+        """
+        self.successResultOf(self.client.callRemote(
+            VersionCommand, capabilities=[u"compact-encoding-0123456789abcdef",
+                                          ZLIB_COMPRESSION]))
+        self.assertEqual(self.protocol.peer_capabilities,
+                         {ZLIB_COMPRESSION})
+
+    def test_version_without_capabilities(self):
+        """
+        Agents which don't send their capabilities with ``VersionCommand`` are
+        assumed to support no optional protocol features.
+        """
+        self.successResultOf(self.client.callRemote(VersionCommand))
+        self.assertEqual(self.protocol.peer_capabilities, frozenset())
 
     def test_nodestate_updates_node_state(self):
         """
@@ -334,12 +879,14 @@ class ControlAMPTests(ControlTestCase):
             self.client.callRemote(NodeStateCommand,
                                    state_changes=(NODE_STATE,),
                                    eliot_context=TEST_ACTION))
+        self.reactor.advance(0.1)
         cluster_state = self.control_amp_service.cluster_state.as_deployment()
         self.assertListEqual(
             [sent1[-1], sent2[-1]],
             [(((ClusterStatusCommand,),
               dict(configuration=TEST_DEPLOYMENT,
-                   state=cluster_state)))] * 2)
+                   state=cluster_state,
+                   generation=2)))] * 2)
 
 
 class ControlAMPServiceTests(ControlTestCase):
@@ -387,6 +934,29 @@ class ControlAMPServiceTests(ControlTestCase):
              [c.transport.disconnecting for c in connections]),
             ([False] * 3, [True] * 3))
 
+    @validate_logging(None)
+    def test_payload_statistics_logged(self, logger):
+        """
+        Each broadcast logs how many bytes of serialized configuration and
+        state it sent before and after compression, and the totals so far.
+        """
+        reactor = Clock()
+        service = build_control_amp_service(self, reactor)
+        self.patch(service, "logger", logger)
+        service.startService()
+        protocol = ControlAMP(service)
+        protocol.makeConnection(StringTransport())
+        protocol.peer_capabilities = CAPABILITIES
+        service.configuration_service.save(large_deployment())
+        reactor.advance(0.1)
+        statistics = service.payload_statistics
+        message = LoggedMessage.of_type(
+            logger.messages, LOG_PAYLOAD_STATISTICS)[-1].message
+        self.assertEqual(
+            [message[u"sent_bytes"] < message[u"raw_bytes"],
+             message[u"total_raw_bytes"], message[u"total_sent_bytes"]],
+            [True, statistics.raw_bytes, statistics.sent_bytes])
+
     def assertArgsEqual(self, expected, actual):
         """
         Utility method to assert that two sets of arguments are equal.
@@ -408,7 +978,8 @@ class ControlAMPServiceTests(ControlTestCase):
         A configuration change results in connected protocols being notified
         of new cluster status.
         """
-        service = build_control_amp_service(self)
+        reactor = Clock()
+        service = build_control_amp_service(self, reactor)
         service.startService()
         protocol = ControlAMP(service)
         protocol.makeConnection(StringTransport())
@@ -416,6 +987,7 @@ class ControlAMPServiceTests(ControlTestCase):
         self.patch_call_remote(sent, protocol=protocol)
 
         service.configuration_service.save(TEST_DEPLOYMENT)
+        reactor.advance(0.1)
         # Should only be one callRemote call.
         (sent,) = sent
         self.assertArgsEqual(
@@ -425,10 +997,176 @@ class ControlAMPServiceTests(ControlTestCase):
                 dict(
                     configuration=TEST_DEPLOYMENT,
                     state=DeploymentState(),
+                    generation=2,
                 )
             )
         )
 
+    def test_node_changes_coalesced(self):
+        """
+        Node state changes which arrive close together result in a single
+        broadcast of the latest cluster state.
+        """
+        reactor = Clock()
+        service = build_control_amp_service(self, reactor)
+        protocol = ControlAMP(service)
+        protocol.makeConnection(StringTransport())
+        sent = []
+        self.patch_call_remote(sent, protocol=protocol)
+
+        for i in range(5):
+            service.node_changed([NodeState(hostname=u"10.0.0.%d" % (i,))])
+        reactor.advance(0.1)
+        self.assertEqual(
+            [kwargs["state"] for (args, kwargs) in sent],
+            [service.cluster_state.as_deployment()])
+
+    def test_unchanged_node_state_not_broadcast(self):
+        """
+        A node state update which doesn't change the cluster state doesn't
+        result in a broadcast.
+        """
+        reactor = Clock()
+        service = build_control_amp_service(self, reactor)
+        service.node_changed([NODE_STATE])
+        reactor.advance(0.1)
+        protocol = ControlAMP(service)
+        protocol.makeConnection(StringTransport())
+        sent = []
+        self.patch_call_remote(sent, protocol=protocol)
+
+        service.node_changed([NODE_STATE])
+        reactor.advance(0.1)
+        self.assertEqual((sent, service.broadcast_scheduler.requests),
+                         ([], 1))
+
+    def test_stop_service_cancels_broadcast(self):
+        """
+        Stopping the service discards any scheduled broadcast.
+        """
+        reactor = Clock()
+        service = build_control_amp_service(self, reactor)
+        service.startService()
+        service.node_changed([NODE_STATE])
+        service.stopService()
+        self.assertEqual(reactor.getDelayedCalls(), [])
+
+
+class ClusterStatusDiffTests(ControlTestCase):
+    """
+    Tests for ``ControlAMPService`` sending ``ClusterStatusDiffCommand``.
+    """
+    def setUp(self):
+        self.reactor = Clock()
+        self.service = build_control_amp_service(self, self.reactor)
+        self.service.configuration_service.save(TEST_DEPLOYMENT)
+        self.protocol = ControlAMP(self.service)
+        self.sent = []
+
+    def acknowledge(self, supports_diffs=True):
+        """
+        Patch the protocol so commands are recorded in ``self.sent``, with
+        ``ClusterStatusCommand`` acknowledged the way an agent would.
+
+        :param bool supports_diffs: Whether the fake agent understands
+            ``ClusterStatusDiffCommand``.
+        """
+        def call_remote(command, **kwargs):
+            kwargs.pop('eliot_context')
+            self.sent.append((command, kwargs))
+            if command is ClusterStatusCommand and supports_diffs:
+                return succeed({"generation": kwargs["generation"]})
+            return succeed({})
+        # Patching is bad.
+        # https://clusterhq.atlassian.net/browse/FLOC-1603
+        self.patch(self.protocol, "callRemote", call_remote)
+
+    def test_diff_after_acknowledgement(self):
+        """
+        Once an agent has acknowledged a ``ClusterStatusCommand``, later
+        changes are sent as a ``ClusterStatusDiffCommand`` containing only
+        what changed.
+        """
+        self.acknowledge()
+        self.protocol.makeConnection(StringTransport())
+        self.service.node_changed([NODE_STATE])
+        self.reactor.advance(0.1)
+        self.assertEqual(
+            self.sent[-1],
+            (ClusterStatusDiffCommand,
+             dict(start_generation=1, end_generation=2,
+                  configuration_diff=DeploymentDiff(),
+                  state_diff=DeploymentStateDiff(
+                      changed_nodes=[NODE_STATE]))))
+
+    def test_old_agent(self):
+        """
+        An agent which does not acknowledge the generation of a
+        ``ClusterStatusCommand`` continues to be sent full snapshots.
+        """
+        self.acknowledge(supports_diffs=False)
+        self.protocol.makeConnection(StringTransport())
+        self.service.node_changed([NODE_STATE])
+        self.reactor.advance(0.1)
+        self.assertEqual(
+            [command for (command, _) in self.sent],
+            [ClusterStatusCommand, ClusterStatusCommand])
+
+    def test_up_to_date(self):
+        """
+        Nothing is sent to an agent which already has the latest
+        configuration and state.
+        """
+        self.acknowledge()
+        self.protocol.makeConnection(StringTransport())
+        self.service._send_state_to_connections([self.protocol])
+        self.assertEqual(len(self.sent), 1)
+
+    def test_generation_too_old(self):
+        """
+        An agent whose last generation is no longer remembered by the
+        control service is sent a full ``ClusterStatusCommand``.
+        """
+        self.service.generation_history = 2
+        self.acknowledge()
+        self.protocol.makeConnection(StringTransport())
+        for i in range(2):
+            self.service.cluster_state.apply_changes(
+                [NodeState(hostname=u"10.0.0.%d" % (i,))])
+            self.service._send_state_to_connections([])
+        self.service._send_state_to_connections([self.protocol])
+        self.assertEqual(
+            self.sent[-1],
+            (ClusterStatusCommand,
+             dict(configuration=TEST_DEPLOYMENT,
+                  state=self.service.cluster_state.as_deployment(),
+                  generation=3)))
+
+    def test_generation_mismatch(self):
+        """
+        If an agent fails a ``ClusterStatusDiffCommand`` with
+        ``GenerationMismatch`` it is immediately sent a full
+        ``ClusterStatusCommand``.
+        """
+        self.acknowledge()
+        self.protocol.makeConnection(StringTransport())
+        acknowledging = self.protocol.callRemote
+
+        def call_remote(command, **kwargs):
+            if command is ClusterStatusDiffCommand:
+                kwargs.pop('eliot_context')
+                self.sent.append((command, kwargs))
+                return fail(GenerationMismatch())
+            return acknowledging(command, **kwargs)
+        self.patch(self.protocol, "callRemote", call_remote)
+
+        self.service.node_changed([NODE_STATE])
+        self.reactor.advance(0.1)
+        self.assertEqual(
+            [command for (command, _) in self.sent],
+            [ClusterStatusCommand, ClusterStatusDiffCommand,
+             ClusterStatusCommand])
+
 
 @implementer(IConvergenceAgent)
 @attributes([Attribute("is_connected", default_value=False),
@@ -515,6 +1253,156 @@ class AgentClientTests(SynchronousTestCase):
                                                desired=TEST_DEPLOYMENT,
                                                actual=actual))
 
+    def test_cluster_updated_generation(self):
+        """
+        ``ClusterStatusCommand`` is acknowledged with the generation it
+        carried.
+        """
+        self.client.makeConnection(StringTransport())
+        d = self.server.callRemote(
+            ClusterStatusCommand,
+            configuration=TEST_DEPLOYMENT,
+            state=DeploymentState(),
+            generation=7,
+            eliot_context=TEST_ACTION
+        )
+        self.assertEqual(self.successResultOf(d), {"generation": 7})
+
+    def test_cluster_updated_diff(self):
+        """
+        ``ClusterStatusDiffCommand`` sent to the ``AgentClient`` results in
+        the agent being told about the configuration and state with the diff
+        applied.
+        """
+        self.client.makeConnection(StringTransport())
+        self.successResultOf(self.server.callRemote(
+            ClusterStatusCommand,
+            configuration=TEST_DEPLOYMENT,
+            state=DeploymentState(),
+            generation=1,
+            eliot_context=TEST_ACTION
+        ))
+        d = self.server.callRemote(
+            ClusterStatusDiffCommand,
+            start_generation=1,
+            end_generation=2,
+            configuration_diff=DeploymentDiff(
+                removed_nodes=[node.uuid for node in TEST_DEPLOYMENT.nodes]),
+            state_diff=DeploymentStateDiff(changed_nodes=[NODE_STATE]),
+            eliot_context=TEST_ACTION
+        )
+
+        self.successResultOf(d)
+        self.assertEqual(self.agent, FakeAgent(
+            is_connected=True, client=self.client,
+            desired=Deployment(),
+            actual=DeploymentState(nodes=[NODE_STATE])))
+
+    def test_cluster_updated_diff_mismatch(self):
+        """
+        ``ClusterStatusDiffCommand`` fails with ``GenerationMismatch`` if it
+        does not start from the generation the agent last received, and the
+        agent is not notified.
+        """
+        self.client.makeConnection(StringTransport())
+        self.successResultOf(self.server.callRemote(
+            ClusterStatusCommand,
+            configuration=TEST_DEPLOYMENT,
+            state=DeploymentState(),
+            generation=1,
+            eliot_context=TEST_ACTION
+        ))
+        d = self.server.callRemote(
+            ClusterStatusDiffCommand,
+            start_generation=2,
+            end_generation=3,
+            configuration_diff=DeploymentDiff(),
+            state_diff=DeploymentStateDiff(changed_nodes=[NODE_STATE]),
+            eliot_context=TEST_ACTION
+        )
+
+        self.failureResultOf(d, GenerationMismatch)
+        self.assertEqual(self.agent.actual, DeploymentState())
+
+    def test_connection_made_version(self):
+        """
+        When a connection is made the agent sends the optional protocol
+        features it supports to the control service.
+        """
+        sent = []
+        self.patch(self.client, "callRemote",
+                   lambda *args, **kwargs: sent.append((args, kwargs)) or
+                   succeed({"major": 1, "capabilities": []}))
+        self.client.makeConnection(StringTransport())
+        self.assertEqual(
+            sent, [((VersionCommand,),
+                    {"capabilities": sorted(CAPABILITIES)})])
+
+    def test_capabilities(self):
+        """
+        The agent uses the optional protocol features supported by both it
+        and the control service.
+        """
+        self.patch(self.client, "callRemote",
+                   lambda *args, **kwargs: succeed(
+                       {"major": 1,
+                        "capabilities": [COMPACT_ENCODING, u"unknown"]}))
+        self.client.makeConnection(StringTransport())
+        self.assertEqual(self.client.peer_capabilities, {COMPACT_ENCODING})
+
+    def test_old_control_service(self):
+        """
+        If the control service doesn't send its capabilities the agent uses
+        no optional protocol features.
+        """
+        self.patch(self.client, "callRemote",
+                   lambda *args, **kwargs: succeed(
+                       {"major": 1, "capabilities": None}))
+        self.client.makeConnection(StringTransport())
+        self.assertEqual(self.client.peer_capabilities, frozenset())
+
+
+class ConnectedAMPTests(SynchronousTestCase):
+    """
+    Tests for ``ControlAMP`` and ``AgentAMP`` talking to each other.
+    """
+    def test_large_configuration(self):
+        """
+        Both sides agree to use the compact encoding, and configuration too
+        large for a single AMP value reaches the agent.
+        """
+        reactor = Clock()
+        service = build_control_amp_service(self, reactor)
+        deployment = large_deployment()
+        service.configuration_service.save(deployment)
+        agent = FakeAgent()
+        client, server, pump = connectedServerAndClient(
+            lambda: ControlAMP(service), lambda: AgentAMP(agent))
+        pump.flush()
+        # The configuration is sent again once the agent has the response
+        # to its VersionCommand:
+        reactor.advance(0)
+        pump.flush()
+        self.assertEqual(
+            [client.peer_capabilities, server.peer_capabilities,
+             agent.desired],
+            [CAPABILITIES, CAPABILITIES, deployment])
+
+    def test_large_configuration_old_agent(self):
+        """
+        Configuration too large for a single AMP value isn't sent to agents
+        which don't support splitting it, and the connection is kept.
+        """
+        service = build_control_amp_service(self)
+        service.configuration_service.save(large_deployment())
+        agent = FakeAgent()
+        client, server, pump = connectedServerAndClient(
+            lambda: ControlAMP(service),
+            lambda: AMP(locator=_AgentLocator(agent)))
+        pump.flush()
+        self.assertEqual([service.connections, agent.desired],
+                         [{server}, None])
+
 
 def iconvergence_agent_tests_factory(fixture):
     """
@@ -605,7 +1493,7 @@ class ClusterStatusCommandTests(SynchronousTestCase):
         ClusterStatusCommand requires the following arguments.
         """
         self.assertItemsEqual(
-            ['configuration', 'state', 'eliot_context'],
+            ['configuration', 'state', 'generation', 'eliot_context'],
             (v[0] for v in ClusterStatusCommand.arguments))
 
 
@@ -689,13 +1577,41 @@ class SendStateToConnectionsTests(SynchronousTestCase):
             }
         )
 
+    def test_encoded_once(self):
+        """
+        The configuration and state are each encoded once no matter how many
+        connections they are sent to.
+        """
+        encoded = []
+
+        def encode(obj):
+            encoded.append(obj)
+            return wire_encode(obj)
+        self.patch(_protocol, "wire_encode", encode)
+
+        control_amp_service = build_control_amp_service(self)
+        connections = [ControlAMP(control_amp_service) for i in range(3)]
+        for connection in connections:
+            # Patching is bad.
+            # https://clusterhq.atlassian.net/browse/FLOC-1603
+            connection.callRemote = (
+                lambda command, **kwargs:
+                succeed(command.makeArguments(kwargs, None)))
+
+        control_amp_service._send_state_to_connections(connections)
+        self.assertEqual(
+            encoded,
+            [control_amp_service.configuration_service.get(),
+             control_amp_service.cluster_state.as_deployment()])
+
     @validate_logging(None)
     def test_error_sending(self, logger):
         """
         An error sending to one agent does not prevent others from being
         notified.
         """
-        control_amp_service = build_control_amp_service(self)
+        reactor = Clock()
+        control_amp_service = build_control_amp_service(self, reactor)
         self.patch(control_amp_service, 'logger', logger)
 
         connected_protocol = ControlAMP(control_amp_service)
@@ -714,6 +1630,7 @@ class SendStateToConnectionsTests(SynchronousTestCase):
         control_amp_service.connected(disconnected_protocol)
         control_amp_service.connected(connected_protocol)
         control_amp_service.node_changed((NodeState(hostname=u"1.2.3.4"),))
+        reactor.advance(0.1)
 
         actions = LoggedAction.ofType(logger.messages, LOG_SEND_TO_AGENT)
         self.assertEqual(
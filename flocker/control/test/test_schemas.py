@@ -760,3 +760,98 @@ NodesTests = build_schema_test(
          {'host': '192.168.1.11', 'uuid': unicode(uuid4())}],
     ],
 )
+
+ConfigurationDatasetsQueryTests = build_schema_test(
+    name="ConfigurationDatasetsQueryTests",
+    schema={'$ref':
+            '/v1/endpoints.json#/definitions/configuration_datasets_query'},
+    schema_store=SCHEMAS,
+    failing_instances=[
+        # Unknown argument
+        {u"junk": u"1"},
+        # Not a UUID
+        {u"primary": u"x" * 36},
+        # Not a boolean
+        {u"deleted": u"yes"},
+        # Not a positive integer
+        {u"limit": u"0"},
+        {u"limit": u"ten"},
+        # Value without a key
+        {u"metadata_value": u"db"},
+    ],
+    passing_instances=[
+        {},
+        {u"primary": a_uuid, u"deleted": u"false"},
+        {u"metadata_key": u"name", u"metadata_value": u"db"},
+        {u"after": a_uuid, u"limit": u"100"},
+    ],
+)
+
+StateDatasetsQueryTests = build_schema_test(
+    name="StateDatasetsQueryTests",
+    schema={'$ref':
+            '/v1/endpoints.json#/definitions/state_datasets_query'},
+    schema_store=SCHEMAS,
+    failing_instances=[
+        # Only available for configuration
+        {u"deleted": u"false"},
+        # Not a UUID
+        {u"primary": u"x" * 36},
+    ],
+    passing_instances=[
+        {},
+        {u"primary": a_uuid, u"after": a_uuid, u"limit": u"10"},
+    ],
+)
+
+ContainersQueryTests = build_schema_test(
+    name="ContainersQueryTests",
+    schema={'$ref': '/v1/endpoints.json#/definitions/containers_query'},
+    schema_store=SCHEMAS,
+    failing_instances=[
+        # Unknown argument
+        {u"primary": a_uuid},
+        # Not a UUID
+        {u"node_uuid": u"x" * 36},
+        # Not a positive integer
+        {u"limit": u"-1"},
+    ],
+    passing_instances=[
+        {},
+        {u"node_uuid": a_uuid, u"name_prefix": u"web-"},
+        {u"after": u"web-1", u"limit": u"1"},
+    ],
+)
+
+ConfigurationDatasetsBatchTests = build_schema_test(
+    name="ConfigurationDatasetsBatchTests",
+    schema={'$ref':
+            '/v1/endpoints.json#/definitions/configuration_datasets_batch'},
+    schema_store=SCHEMAS,
+    failing_instances=[
+        # Missing operations
+        {},
+        # No operations
+        {u"operations": []},
+        # Unknown action
+        {u"operations": [{u"action": u"move", u"dataset_id": a_uuid}]},
+        # Create without a primary
+        {u"operations": [{u"action": u"create", u"dataset_id": a_uuid}]},
+        # Delete without a dataset_id
+        {u"operations": [{u"action": u"delete"}]},
+        # Unknown property
+        {u"operations": [{u"action": u"delete", u"dataset_id": a_uuid,
+                          u"primary": a_uuid}]},
+    ],
+    passing_instances=[
+        {u"operations": [{u"action": u"create", u"primary": a_uuid}]},
+        {u"operations": [
+            {u"action": u"create", u"primary": a_uuid,
+             u"dataset_id": a_uuid, u"maximum_size": 1024 * 1024 * 100,
+             u"metadata": {u"name": u"db"}},
+            {u"action": u"update", u"dataset_id": a_uuid,
+             u"primary": unicode(uuid4())},
+            {u"action": u"delete", u"dataset_id": a_uuid},
+        ]},
+    ],
+)
@@ -3,12 +3,15 @@
 from twisted.web.server import Site
 from twisted.trial.unittest import SynchronousTestCase
 from twisted.python.filepath import FilePath
+from twisted.python.usage import UsageError
 
 from ..script import ControlOptions, ControlScript
 from ...testtools import MemoryCoreReactor, StandardOptionsTestsMixin
 from .._clusterstate import ClusterStateService
 from .._protocol import ControlAMP, ControlAMPService
 from ..httpapi import REST_API_PORT
+from ...restapi import OutputValidation, set_output_validation
+from ...restapi import _infrastructure
 
 
 class ControlOptionsTests(StandardOptionsTestsMixin,
@@ -70,11 +73,47 @@ class ControlOptionsTests(StandardOptionsTestsMixin,
         options.parseOptions([b"--agent-port", b"tcp:1234"])
         self.assertEqual(options["agent-port"], b"tcp:1234")
 
+    def test_default_output_validation(self):
+        """
+        By default every REST API response is validated.
+        """
+        options = ControlOptions()
+        options.parseOptions([])
+        self.assertEqual(options["output-validation"],
+                         OutputValidation.ALWAYS)
+
+    def test_output_validation(self):
+        """
+        The ``--output-validation`` command-line option is converted to an
+        ``OutputValidation`` constant.
+        """
+        options = ControlOptions()
+        options.parseOptions([b"--output-validation", b"sampled"])
+        self.assertEqual(options["output-validation"],
+                         OutputValidation.SAMPLED)
+
+    def test_unknown_output_validation(self):
+        """
+        An unknown ``--output-validation`` policy is rejected.
+        """
+        options = ControlOptions()
+        self.assertRaises(UsageError, options.parseOptions,
+                          [b"--output-validation", b"sometimes"])
+
 
 class ControlScriptEffectsTests(SynchronousTestCase):
     """
     Tests for effects ``ControlScript``.
     """
+    def reactor(self):
+        """
+        :return: A ``MemoryCoreReactor`` which is shut down when the test
+            finishes, stopping the services started with it.
+        """
+        reactor = MemoryCoreReactor()
+        self.addCleanup(reactor.fireSystemEvent, "shutdown")
+        return reactor
+
     def test_starts_http_api_server(self):
         """
         ``ControlScript.main`` starts a HTTP server on the given port.
@@ -82,7 +121,7 @@ class ControlScriptEffectsTests(SynchronousTestCase):
         options = ControlOptions()
         options.parseOptions(
             [b"--port", b"tcp:8001", b"--data-path", self.mktemp()])
-        reactor = MemoryCoreReactor()
+        reactor = self.reactor()
         ControlScript().main(reactor, options)
         server = reactor.tcpServers[0]
         port = server[0]
@@ -96,7 +135,7 @@ class ControlScriptEffectsTests(SynchronousTestCase):
         script = ControlScript()
         options = ControlOptions()
         options.parseOptions([b"--data-path", self.mktemp()])
-        self.assertNoResult(script.main(MemoryCoreReactor(), options))
+        self.assertNoResult(script.main(self.reactor(), options))
 
     def test_starts_persistence_service(self):
         """
@@ -105,10 +144,22 @@ class ControlScriptEffectsTests(SynchronousTestCase):
         path = FilePath(self.mktemp())
         options = ControlOptions()
         options.parseOptions([b"--data-path", path.path])
-        reactor = MemoryCoreReactor()
+        reactor = self.reactor()
         ControlScript().main(reactor, options)
         self.assertTrue(path.isdir())
 
+    def test_output_validation(self):
+        """
+        ``ControlScript.main`` applies the ``--output-validation`` policy.
+        """
+        self.addCleanup(set_output_validation, OutputValidation.ALWAYS)
+        options = ControlOptions()
+        options.parseOptions(
+            [b"--output-validation", b"never", b"--data-path", self.mktemp()])
+        ControlScript().main(self.reactor(), options)
+        self.assertIs(_infrastructure._output_validation,
+                      OutputValidation.NEVER)
+
     def test_starts_cluster_state_service(self):
         """
         ``ControlScript.main`` starts a cluster state service.
@@ -116,7 +167,7 @@ class ControlScriptEffectsTests(SynchronousTestCase):
         options = ControlOptions()
         options.parseOptions(
             [b"--port", b"tcp:8001", b"--data-path", self.mktemp()])
-        reactor = MemoryCoreReactor()
+        reactor = self.reactor()
         ControlScript().main(reactor, options)
         server = reactor.tcpServers[0]
         service = server[1].resource._v1_user.cluster_state_service
@@ -130,7 +181,7 @@ class ControlScriptEffectsTests(SynchronousTestCase):
         options = ControlOptions()
         options.parseOptions(
             [b"--agent-port", b"tcp:8001", b"--data-path", self.mktemp()])
-        reactor = MemoryCoreReactor()
+        reactor = self.reactor()
         ControlScript().main(reactor, options)
         server = reactor.tcpServers[1]
         port = server[0]
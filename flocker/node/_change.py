@@ -57,7 +57,7 @@ class IStateChange(Interface):
         """
 
 
-def run_state_change(change, deployer):
+def run_state_change(change, deployer, timer=None):
     """
     Apply the change to local state.
 
@@ -66,12 +66,15 @@ def run_state_change(change, deployer):
     :param IDeployer deployer: The ``IDeployer`` to use.  Specific
         ``IStateChange`` providers may require specific ``IDeployer`` providers
         that provide relevant functionality for applying the change.
+    :param timer: If not ``None``, a one-argument callable which is called
+        with each ``IStateChange`` provider as it starts running and returns
+        a no-argument callable to call when that change finishes.
 
     :return: ``Deferred`` firing when the change is done.
     """
     if isinstance(change, _InParallel):
         return gather_deferreds(list(
-            run_state_change(subchange, deployer)
+            run_state_change(subchange, deployer, timer)
             for subchange in change.changes
         ))
     if isinstance(change, _Sequentially):
@@ -79,13 +82,19 @@ def run_state_change(change, deployer):
         for subchange in change.changes:
             d.addCallback(
                 lambda _, subchange=subchange: run_state_change(
-                    subchange, deployer
+                    subchange, deployer, timer
                 )
             )
         return d
 
+    finished = None if timer is None else timer(change)
     with change.eliot_action.context():
         context = DeferredContext(change.run(deployer))
+        if finished is not None:
+            def record(result):
+                finished()
+                return result
+            context.addBoth(record)
         context.addActionFinish()
         return context.result
 
@@ -143,3 +152,19 @@ def sequentially(changes):
     Failures in earlier changes stop later changes.
     """
     return _Sequentially(changes=changes)
+
+
+def no_changes(change):
+    """
+    Determine whether running a change would do nothing at all.
+
+    :param change: Either an ``IStateChange`` provider or the result of an
+        ``in_parallel`` or ``sequentially`` call.
+
+    :return: ``True`` if ``change`` is made up only of (possibly nested)
+        empty ``in_parallel`` and ``sequentially`` results, otherwise
+        ``False``.
+    """
+    if isinstance(change, (_InParallel, _Sequentially)):
+        return all(no_changes(subchange) for subchange in change.changes)
+    return False
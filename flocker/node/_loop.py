@@ -13,12 +13,14 @@ The ClusterStatus state machine receives inputs from the connection to the
 control service, and sends inputs to the ConvergenceLoop state machine.
 """
 
+import signal
+
 from zope.interface import implementer
 
 from eliot import ActionType, Field, writeFailure, MessageType
 from eliot.twisted import DeferredContext
 
-from characteristic import attributes
+from characteristic import attributes, Attribute
 
 from machinist import (
     trivialInput, TransitionTable, constructFiniteStateMachine,
@@ -30,10 +32,13 @@ from twisted.python.constants import Names, NamedConstant
 from twisted.internet.protocol import ReconnectingClientFactory
 
 from . import run_state_change
+from ._change import no_changes
+from ._stats import ConvergenceStatistics, IterationTimings
 
 from ..control._protocol import (
     NodeStateCommand, IConvergenceAgent, AgentAMP,
     )
+from ..control._logging import state_field
 
 
 class ClusterStatusInputs(Names):
@@ -197,6 +202,8 @@ class ConvergenceLoopInputs(Names):
     # Finished applying necessary changes to local state, a single
     # iteration of the convergence loop:
     ITERATION_DONE = NamedConstant()
+    # Local state may have changed, or it is time to check whether it has:
+    WAKEUP = NamedConstant()
 
 
 @attributes(["client", "configuration", "state"])
@@ -223,6 +230,8 @@ class ConvergenceLoopStates(Names):
     # Local state is being converged, and once that is done we will
     # immediately stop:
     CONVERGING_STOPPING = NamedConstant()
+    # Waiting for a wakeup before the next iteration of the loop:
+    SLEEPING = NamedConstant()
 
 
 class ConvergenceLoopOutputs(Names):
@@ -234,6 +243,32 @@ class ConvergenceLoopOutputs(Names):
     STORE_INFO = NamedConstant()
     # Start an iteration of the covergence loop:
     CONVERGE = NamedConstant()
+    # Schedule a wakeup to start the next iteration:
+    SLEEP = NamedConstant()
+    # Cancel the scheduled wakeup:
+    CANCEL_SLEEP = NamedConstant()
+    # Don't wait long after the current iteration before starting the next:
+    EXPEDITE = NamedConstant()
+
+
+# The delay before the next iteration of the loop when the last one changed
+# something, or when something changed while it ran:
+_MINIMUM_INTERVAL = 1.0
+
+# The default ceiling for the delay between iterations, reached by doubling
+# the delay after each iteration which found nothing to change:
+_MAXIMUM_INTERVAL = 10.0
+
+# The number of seconds after which local state is sent to the control
+# service again even if it is unchanged, so the control service keeps
+# hearing from agents whose nodes are stable:
+_HEARTBEAT_INTERVAL = 60.0
+
+# The number of seconds after which changes are calculated again even if
+# the inputs are the same as for an iteration which found nothing to change,
+# since deployers may also consult local state that discovery doesn't
+# report:
+_RECALCULATE_INTERVAL = 60.0
 
 
 _FIELD_CONNECTION = Field(
@@ -241,8 +276,8 @@ _FIELD_CONNECTION = Field(
     lambda client: repr(client),
     "The AMP connection to control service")
 
-_FIELD_LOCAL_CHANGES = Field(
-    u"local_changes", repr,
+_FIELD_LOCAL_CHANGES = state_field(
+    u"local_changes",
     "Changes discovered in local state.")
 
 LOG_SEND_TO_CONTROL_SERVICE = ActionType(
@@ -250,12 +285,12 @@ LOG_SEND_TO_CONTROL_SERVICE = ActionType(
     [_FIELD_CONNECTION, _FIELD_LOCAL_CHANGES], [],
     "Send the local state to the control service.")
 
-_FIELD_CLUSTERSTATE = Field(
-    u"cluster_state", repr,
+_FIELD_CLUSTERSTATE = state_field(
+    u"cluster_state",
     "The state of the cluster, according to control service.")
 
-_FIELD_CONFIGURATION = Field(
-    u"desired_configuration", repr,
+_FIELD_CONFIGURATION = state_field(
+    u"desired_configuration",
     "The configuration of the cluster according to the control service.")
 
 _FIELD_ACTIONS = Field(
@@ -272,6 +307,52 @@ LOG_CALCULATED_ACTIONS = MessageType(
     "The actions we're going to attempt.")
 
 
+def _phase_field(phase):
+    """
+    Create a field for the duration of a phase of a convergence iteration.
+
+    :param unicode phase: The name of the phase.
+
+    :return Field: A field which is ``None`` if the phase didn't finish.
+    """
+    return Field.for_types(
+        phase, [float, None],
+        "The number of seconds %s took, or None if it didn't finish." % (
+            phase,))
+
+_FIELD_CHANGE_TIMES = Field(
+    u"change_times", lambda changes: [list(change) for change in changes],
+    "[name, seconds] pairs giving how long each state change took to run.")
+
+LOG_ITERATION_TIMINGS = MessageType(
+    u"flocker:agent:converge:timings",
+    [_phase_field(u"discover_state"), _phase_field(u"calculate_changes"),
+     _phase_field(u"run_changes"), _FIELD_CHANGE_TIMES],
+    "How long the phases of a convergence iteration took.")
+
+_FIELD_STATISTICS = Field(
+    u"statistics", lambda statistics: statistics.to_dict(),
+    "Timings of recent convergence iterations.")
+
+LOG_STATISTICS = MessageType(
+    u"flocker:agent:statistics", [_FIELD_STATISTICS],
+    "Timing statistics of the convergence loop.")
+
+LOG_SKIPPED_CALCULATION = MessageType(
+    u"flocker:agent:converge:unchanged", [],
+    "The configuration and cluster state are the same as in an earlier "
+    "iteration which found nothing to change, so no actions were "
+    "calculated.")
+
+_FIELD_INTERVAL = Field.for_types(
+    u"interval", [float],
+    "The number of seconds until the next iteration of the loop.")
+
+LOG_SLEEP = MessageType(
+    u"flocker:agent:converge:sleep", [_FIELD_INTERVAL],
+    "The loop is waiting before its next iteration.")
+
+
 class ConvergenceLoop(object):
     """
     World object for the convergence loop state machine, executing the actions
@@ -286,101 +367,264 @@ class ConvergenceLoop(object):
     :ivar DeploymentState cluster_state: Actual cluster state.  Initially
         ``None``.
 
+    :ivar float interval: The number of seconds the loop waits, or last
+        waited, between iterations.
+
+    :ivar float maximum_interval: The ceiling for ``interval``.
+
+    :ivar int executed_iterations: The number of iterations which calculated
+        and ran changes.
+
+    :ivar int skipped_iterations: The number of iterations which skipped
+        calculating changes because nothing had changed since an iteration
+        which found nothing to change.
+
+    :ivar ConvergenceStatistics statistics: Timings of the iterations.
+
     :ivar fsm: The finite state machine this is part of.
     """
-    def __init__(self, reactor, deployer):
+    def __init__(self, reactor, deployer, maximum_interval=_MAXIMUM_INTERVAL,
+                 statistics=None):
         """
         :param IReactorTime reactor: Used to schedule delays in the loop.
 
         :param IDeployer deployer: Used to discover local state and calculate
             necessary changes to match desired configuration.
+
+        :param float maximum_interval: The ceiling for the delay between
+            iterations while nothing needs changing.
+
+        :param statistics: The ``ConvergenceStatistics`` to record the
+            timings of iterations in, or ``None`` to create new ones.
         """
+        if statistics is None:
+            statistics = ConvergenceStatistics()
+        self.statistics = statistics
         self.reactor = reactor
         self.deployer = deployer
+        self.client = None
+        self.configuration = None
         self.cluster_state = None
+        self.interval = _MINIMUM_INTERVAL
+        self.maximum_interval = float(maximum_interval)
+        # Whether something happened during the current iteration which
+        # means the next one shouldn't wait long:
+        self._changed = False
+        # Whether the current iteration found nothing to change:
+        self._converged = False
+        # The ``IDelayedCall`` which will wake the loop up when sleeping:
+        self._wakeup = None
+        # The client and state changes the control service last
+        # acknowledged receiving:
+        self._acknowledged = None
+        # When local state must next be sent even if it is unchanged:
+        self._next_heartbeat = 0
+        self.executed_iterations = 0
+        self.skipped_iterations = 0
+        # The configuration and cluster state of the last iteration which
+        # found nothing to change, or ``None``:
+        self._quiet_inputs = None
+        # When changes must next be calculated even if the inputs are the
+        # same as ``_quiet_inputs``:
+        self._recalculate_at = 0
+
+    def _expedite(self):
+        """
+        Start the next iteration promptly: immediately if sleeping, otherwise
+        after the minimum delay once the current iteration finishes.
+        """
+        self._changed = True
+        if self._wakeup is not None and self._wakeup.active():
+            self._wakeup.reset(0)
+
+    def _send_state(self, state_changes):
+        """
+        Send discovered local state to the control service, unless the
+        control service has already acknowledged exactly that state on the
+        current connection and no heartbeat is due.
+
+        :param tuple state_changes: The discovered local state.
+        """
+        sent = (self.client, state_changes)
+        if (sent == self._acknowledged and
+                self.reactor.seconds() < self._next_heartbeat):
+            return
+        self._next_heartbeat = self.reactor.seconds() + _HEARTBEAT_INTERVAL
+        with LOG_SEND_TO_CONTROL_SERVICE(
+                self.fsm.logger, connection=self.client,
+                local_changes=list(state_changes)) as context:
+            d = self.client.callRemote(NodeStateCommand,
+                                       state_changes=state_changes,
+                                       eliot_context=context)
+
+        def acknowledged(_):
+            self._acknowledged = sent
+        d.addCallback(acknowledged)
+        d.addErrback(writeFailure, self.fsm.logger, u"")
 
     def output_STORE_INFO(self, context):
+        # The control service sends the cluster state back whenever we
+        # tell it about our own state, so only start the next iteration
+        # promptly if the update has something new:
+        if (context.client is not self.client or
+                context.configuration != self.configuration or
+                context.state != self.cluster_state):
+            self._expedite()
         self.client, self.configuration, self.cluster_state = (
             context.client, context.configuration, context.state)
 
+    def output_EXPEDITE(self, context):
+        self._expedite()
+
+    def output_SLEEP(self, context):
+        if self._converged and not self._changed:
+            self.interval = min(self.interval * 2, self.maximum_interval)
+        else:
+            self.interval = _MINIMUM_INTERVAL
+        LOG_SLEEP(interval=self.interval).write(self.fsm.logger)
+        self._wakeup = self.reactor.callLater(
+            self.interval, self.fsm.receive, ConvergenceLoopInputs.WAKEUP)
+
+    def output_CANCEL_SLEEP(self, context):
+        if self._wakeup.active():
+            self._wakeup.cancel()
+        self._wakeup = None
+
     def output_CONVERGE(self, context):
+        self._changed = False
+        self._converged = False
         known_local_state = self.cluster_state.get_node(
             self.deployer.node_uuid, hostname=self.deployer.hostname)
+        timings = IterationTimings(self.reactor)
 
         with LOG_CONVERGE(self.fsm.logger, cluster_state=self.cluster_state,
                           desired_configuration=self.configuration).context():
+            discovered = timings.time_phase(u"discover_state")
             d = DeferredContext(
                 self.deployer.discover_state(known_local_state))
 
         def got_local_state(state_changes):
+            discovered()
             # Current cluster state is likely out of date as regards the local
             # state, so update it accordingly.
             for state in state_changes:
                 self.cluster_state = state.update_cluster_state(
                     self.cluster_state
                 )
-            with LOG_SEND_TO_CONTROL_SERVICE(
-                    self.fsm.logger, connection=self.client,
-                    local_changes=list(state_changes)) as context:
-                self.client.callRemote(NodeStateCommand,
-                                       state_changes=state_changes,
-                                       eliot_context=context)
+            self._send_state(tuple(state_changes))
+            inputs = (self.configuration, self.cluster_state)
+            if (inputs == self._quiet_inputs and
+                    self.reactor.seconds() < self._recalculate_at):
+                self.skipped_iterations += 1
+                LOG_SKIPPED_CALCULATION().write(self.fsm.logger)
+                self._converged = True
+                return
+            self.executed_iterations += 1
+            calculated = timings.time_phase(u"calculate_changes")
             action = self.deployer.calculate_changes(
                 self.configuration, self.cluster_state
             )
+            calculated()
             LOG_CALCULATED_ACTIONS(calculated_actions=action).write(
                 self.fsm.logger)
-            return run_state_change(action, self.deployer)
+            self._converged = no_changes(action)
+            if self._converged:
+                self._quiet_inputs = inputs
+                self._recalculate_at = (
+                    self.reactor.seconds() + _RECALCULATE_INTERVAL)
+            else:
+                self._quiet_inputs = None
+            ran = timings.time_phase(u"run_changes")
+            running = run_state_change(
+                action, self.deployer, timings.time_change)
+
+            def finished(result):
+                ran()
+                return result
+            return running.addBoth(finished)
         d.addCallback(got_local_state)
         # If an error occurred we just want to log it and then try
         # converging again; hopefully next time we'll have more success.
         d.addErrback(writeFailure, self.fsm.logger, u"")
 
-        # It would be better to have a "quiet time" state in the FSM and
-        # transition to that next, then have a timeout input kick the machine
-        # back around to the beginning of the loop in the FSM.  However, we're
-        # not going to keep this sleep-for-a-bit solution in the long term.
-        # Instead, we'll be more event driven.  So just going with the simple
-        # solution and inserting a side-effect-y delay directly here.
-
+        def record_timings(_):
+            LOG_ITERATION_TIMINGS(
+                discover_state=timings.phases.get(u"discover_state"),
+                calculate_changes=timings.phases.get(u"calculate_changes"),
+                run_changes=timings.phases.get(u"run_changes"),
+                change_times=timings.changes,
+            ).write(self.fsm.logger)
+            self.statistics.record(timings)
+        d.addCallback(record_timings)
+
+        # The iteration may have finished synchronously, in which case we
+        # are still inside this FSM's handling of the input that started
+        # it, so deliver the next input from the reactor instead:
         d.addCallback(
             lambda _:
                 self.reactor.callLater(
-                    1.0, self.fsm.receive, ConvergenceLoopInputs.ITERATION_DONE
+                    0, self.fsm.receive, ConvergenceLoopInputs.ITERATION_DONE
                 )
         )
         d.addActionFinish()
 
 
-def build_convergence_loop_fsm(reactor, deployer):
+def build_convergence_loop_fsm(reactor, deployer,
+                               maximum_interval=_MAXIMUM_INTERVAL,
+                               statistics=None):
     """
     Create a convergence loop FSM.
 
+    After each iteration the loop sleeps, starting the next iteration when
+    woken up by a change in the cluster status or a ``WAKEUP`` input, or
+    after a delay which doubles, up to ``maximum_interval``, for each
+    iteration in a row which found nothing to change.
+
     :param IReactorTime reactor: Used to schedule delays in the loop.
 
     :param IDeployer deployer: Used to discover local state and calcualte
         necessary changes to match desired configuration.
+
+    :param float maximum_interval: The ceiling for the delay between
+        iterations.
+
+    :param statistics: The ``ConvergenceStatistics`` to record the timings
+        of iterations in, or ``None`` to create new ones.
     """
     I = ConvergenceLoopInputs
     O = ConvergenceLoopOutputs
     S = ConvergenceLoopStates
 
     table = TransitionTable()
-    table = table.addTransition(
-        S.STOPPED, I.STATUS_UPDATE, [O.STORE_INFO, O.CONVERGE], S.CONVERGING)
+    table = table.addTransitions(
+        S.STOPPED, {
+            I.STATUS_UPDATE: ([O.STORE_INFO, O.CONVERGE], S.CONVERGING),
+            # Nothing to converge with until we hear from the control
+            # service:
+            I.WAKEUP: ([], S.STOPPED),
+        })
     table = table.addTransitions(
         S.CONVERGING, {
             I.STATUS_UPDATE: ([O.STORE_INFO], S.CONVERGING),
+            I.WAKEUP: ([O.EXPEDITE], S.CONVERGING),
             I.STOP: ([], S.CONVERGING_STOPPING),
-            I.ITERATION_DONE: ([O.CONVERGE], S.CONVERGING),
+            I.ITERATION_DONE: ([O.SLEEP], S.SLEEPING),
         })
     table = table.addTransitions(
         S.CONVERGING_STOPPING, {
             I.STATUS_UPDATE: ([O.STORE_INFO], S.CONVERGING),
+            I.WAKEUP: ([], S.CONVERGING_STOPPING),
             I.ITERATION_DONE: ([], S.STOPPED),
         })
+    table = table.addTransitions(
+        S.SLEEPING, {
+            # Storing new information wakes us up promptly:
+            I.STATUS_UPDATE: ([O.STORE_INFO], S.SLEEPING),
+            I.WAKEUP: ([O.CANCEL_SLEEP, O.CONVERGE], S.CONVERGING),
+            I.STOP: ([O.CANCEL_SLEEP], S.STOPPED),
+        })
 
-    loop = ConvergenceLoop(reactor, deployer)
+    loop = ConvergenceLoop(reactor, deployer, maximum_interval, statistics)
     fsm = constructFiniteStateMachine(
         inputs=I, outputs=O, states=S, initial=S.STOPPED, table=table,
         richInputs=[_ClientStatusUpdate], inputContext={},
@@ -390,7 +634,9 @@ def build_convergence_loop_fsm(reactor, deployer):
 
 
 @implementer(IConvergenceAgent)
-@attributes(["reactor", "deployer", "host", "port"])
+@attributes(["reactor", "deployer", "host", "port",
+             Attribute("maximum_interval", default_value=_MAXIMUM_INTERVAL),
+             Attribute("statistics_signal", default_value=None)])
 class AgentLoopService(object, MultiService):
     """
     Service in charge of running the convergence loop.
@@ -400,14 +646,23 @@ class AgentLoopService(object, MultiService):
             then changing it.
     :ivar host: Host to connect to.
     :ivar port: Port to connect to.
+    :ivar maximum_interval: The ceiling for the delay between iterations of
+        the convergence loop.
+    :ivar statistics_signal: If not ``None``, the number of a signal which
+        causes the statistics to be logged while the service is running.
+    :ivar ConvergenceStatistics statistics: Timings of the iterations of
+        the convergence loop.
+    :ivar convergence_loop: A convergence loop FSM.
     :ivar cluster_status: A cluster status FSM.
     :ivar factory: The factory used to connect to the control service.
     """
 
     def __init__(self):
         MultiService.__init__(self)
-        convergence_loop = build_convergence_loop_fsm(
-            self.reactor, self.deployer
+        self.statistics = ConvergenceStatistics()
+        self.convergence_loop = convergence_loop = build_convergence_loop_fsm(
+            self.reactor, self.deployer, self.maximum_interval,
+            self.statistics
         )
         self.logger = convergence_loop.logger
         self.cluster_status = build_cluster_status_fsm(convergence_loop)
@@ -416,13 +671,42 @@ class AgentLoopService(object, MultiService):
 
     def startService(self):
         MultiService.startService(self)
+        if self.statistics_signal is not None:
+            self._previous_handler = signal.signal(
+                self.statistics_signal, self._statistics_signalled)
         self.reactor.connectTCP(self.host, self.port, self.factory)
 
     def stopService(self):
         MultiService.stopService(self)
+        if self.statistics_signal is not None:
+            previous = self._previous_handler
+            if previous is None:
+                # The handler wasn't installed from Python:
+                previous = signal.SIG_DFL
+            signal.signal(self.statistics_signal, previous)
         self.factory.stopTrying()
         self.cluster_status.receive(ClusterStatusInputs.SHUTDOWN)
 
+    def _statistics_signalled(self, signum, frame):
+        """
+        Signal handler which logs the statistics from the reactor thread.
+        """
+        self.reactor.callFromThread(self.dump_statistics)
+
+    def dump_statistics(self):
+        """
+        Log the timings of recent iterations of the convergence loop and
+        histograms of how long their phases took.
+        """
+        LOG_STATISTICS(statistics=self.statistics).write(self.logger)
+
+    def local_state_changed(self):
+        """
+        Notify the convergence loop that local state may have changed, so
+        that it converges promptly rather than when its delay expires.
+        """
+        self.convergence_loop.receive(ConvergenceLoopInputs.WAKEUP)
+
     # IConvergenceAgent methods:
 
     def connected(self, client):
@@ -0,0 +1,168 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+# -*- test-case-name: flocker.node.test.test_stats -*-
+
+"""
+Timing statistics for the iterations of a convergence loop, so slow nodes
+and slow phases of convergence can be found.
+"""
+
+from collections import deque, defaultdict
+
+
+# The upper bounds, in seconds, of the buckets of a ``Histogram``:
+_BUCKETS = (0.001, 0.01, 0.1, 1.0, 10.0, 100.0)
+
+
+class Histogram(object):
+    """
+    Counts of durations, in buckets whose bounds grow by powers of ten.
+
+    :ivar list counts: The number of durations in each bucket of
+        ``_BUCKETS``, followed by the number longer than all of them.
+    :ivar int count: The number of durations.
+    :ivar float total: The sum of the durations.
+    :ivar float maximum: The longest duration.
+    """
+    def __init__(self):
+        self.counts = [0] * (len(_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def add(self, seconds):
+        """
+        Count a duration.
+
+        :param float seconds: The duration.
+        """
+        for position, bound in enumerate(_BUCKETS):
+            if seconds <= bound:
+                break
+        else:
+            position = len(_BUCKETS)
+        self.counts[position] += 1
+        self.count += 1
+        self.total += seconds
+        self.maximum = max(self.maximum, seconds)
+
+    def to_dict(self):
+        """
+        :return: A JSON-compatible ``dict`` describing the histogram.
+        """
+        labels = [u"<=%g" % (bound,) for bound in _BUCKETS]
+        labels.append(u">%g" % (_BUCKETS[-1],))
+        return {
+            u"buckets": dict(zip(labels, self.counts)),
+            u"count": self.count,
+            u"total": self.total,
+            u"maximum": self.maximum,
+        }
+
+
+class IterationTimings(object):
+    """
+    How long the phases of one iteration of a convergence loop took.
+
+    :ivar float started: When the iteration started.
+    :ivar dict phases: Maps the names of the phases which have finished to
+        the number of seconds each took.
+    :ivar list changes: ``(name, seconds)`` tuples giving the type name of
+        each ``IStateChange`` provider which has finished running and the
+        number of seconds it took.
+    """
+    def __init__(self, clock):
+        """
+        :param IReactorTime clock: Used to measure durations.
+        """
+        self._clock = clock
+        self.started = clock.seconds()
+        self.phases = {}
+        self.changes = []
+
+    def _time(self, record):
+        """
+        Start timing something.
+
+        :param record: A one-argument callable to call with the duration.
+
+        :return: A no-argument callable to call when it finishes.
+        """
+        started = self._clock.seconds()
+
+        def finished():
+            record(self._clock.seconds() - started)
+        return finished
+
+    def time_phase(self, phase):
+        """
+        Start timing a phase of the iteration.
+
+        :param unicode phase: The name of the phase.
+
+        :return: A no-argument callable to call when the phase finishes.
+        """
+        def record(seconds):
+            self.phases[phase] = seconds
+        return self._time(record)
+
+    def time_change(self, change):
+        """
+        Start timing a state change.  Suitable as the ``timer`` argument to
+        ``run_state_change``.
+
+        :param change: The ``IStateChange`` provider which is starting.
+
+        :return: A no-argument callable to call when the change finishes.
+        """
+        def record(seconds):
+            self.changes.append((type(change).__name__, seconds))
+        return self._time(record)
+
+    def to_dict(self):
+        """
+        :return: A JSON-compatible ``dict`` describing the timings.
+        """
+        return {
+            u"started": self.started,
+            u"phases": dict(self.phases),
+            u"changes": [[name, seconds] for name, seconds in self.changes],
+        }
+
+
+class ConvergenceStatistics(object):
+    """
+    Timings of the iterations of a convergence loop.
+
+    :ivar deque iterations: The ``IterationTimings`` of the most recent
+        iterations.
+    :ivar dict histograms: Maps the names of phases, and the type names of
+        state changes, to ``Histogram`` instances of how long they took.
+    """
+    def __init__(self, history=100):
+        """
+        :param int history: The number of recent iterations to keep.
+        """
+        self.iterations = deque(maxlen=history)
+        self.histograms = defaultdict(Histogram)
+
+    def record(self, timings):
+        """
+        Add the timings of a finished iteration.
+
+        :param IterationTimings timings: The timings.
+        """
+        self.iterations.append(timings)
+        for phase, seconds in timings.phases.items():
+            self.histograms[phase].add(seconds)
+        for name, seconds in timings.changes:
+            self.histograms[name].add(seconds)
+
+    def to_dict(self):
+        """
+        :return: A JSON-compatible ``dict`` describing the statistics.
+        """
+        return {
+            u"iterations": [timings.to_dict() for timings in self.iterations],
+            u"histograms": {name: histogram.to_dict()
+                            for name, histogram in self.histograms.items()},
+        }
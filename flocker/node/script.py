@@ -8,6 +8,7 @@ The command-line ``flocker-*-agent`` tools.
 from functools import partial
 from socket import socket
 from os import getpid
+from signal import SIGUSR1
 
 import yaml
 
@@ -158,7 +159,8 @@ class ZFSAgentScript(object):
         deployer = P2PManifestationDeployer(ip, volume_service,
                                             node_uuid=node_uuid)
         loop = AgentLoopService(reactor=reactor, deployer=deployer,
-                                host=host, port=port)
+                                host=host, port=port,
+                                statistics_signal=SIGUSR1)
         volume_service.setServiceParent(loop)
         return main_for_service(reactor, loop)
 
@@ -269,6 +271,8 @@ class AgentServiceFactory(PRecord):
             deployer=self.deployer_factory(node_uuid=ip_to_uuid(ip),
                                            hostname=ip),
             host=host, port=port,
+            # ``kill -USR1`` logs the convergence loop's timings:
+            statistics_signal=SIGUSR1,
         )
 
 
@@ -15,6 +15,7 @@ from ..testtools import (
 )
 
 from .. import sequentially, in_parallel, run_state_change
+from .._change import no_changes
 
 from .istatechange import (
     DummyStateChange, RunSpyStateChange, make_istatechange_tests,
@@ -353,3 +354,78 @@ class RunStateChangeTests(SynchronousTestCase):
         action._logger = logger
         failure = self.failureResultOf(run_state_change(action, DEPLOYER))
         self.assertEqual(failure.getErrorMessage(), "Oh no")
+
+    def test_timer(self):
+        """
+        If a ``timer`` is given it is called with each ``IStateChange``
+        provider as it starts, and what it returns is called when that
+        change finishes.
+        """
+        events = []
+
+        def timer(change):
+            events.append((u"started", change))
+            return lambda: events.append((u"finished", change))
+        first = ControllableAction(result=Deferred())
+        second = ControllableAction(result=succeed(None))
+        run_state_change(
+            sequentially(changes=[in_parallel(changes=[first]), second]),
+            DEPLOYER, timer)
+        before = list(events)
+        first.result.callback(None)
+        self.assertEqual(
+            (before, events),
+            ([(u"started", first)],
+             [(u"started", first), (u"finished", first),
+              (u"started", second), (u"finished", second)]))
+
+    def test_timer_failed(self):
+        """
+        What the ``timer`` returns is called when a change fails too, and the
+        failure is still the result.
+        """
+        finished = []
+        action = ControllableAction(result=fail(Exception("Oh no")))
+        result = run_state_change(
+            action, DEPLOYER, lambda change: lambda: finished.append(change))
+        failure = self.failureResultOf(result)
+        self.assertEqual(
+            (finished, failure.getErrorMessage()), ([action], "Oh no"))
+
+
+class NoChangesTests(SynchronousTestCase):
+    """
+    Tests for ``no_changes``.
+    """
+    def test_empty(self):
+        """
+        Empty ``sequentially`` and ``in_parallel`` results make no changes.
+        """
+        self.assertEqual(
+            (no_changes(sequentially(changes=[])),
+             no_changes(in_parallel(changes=[]))),
+            (True, True))
+
+    def test_nested_empty(self):
+        """
+        Nested empty ``sequentially`` and ``in_parallel`` results make no
+        changes.
+        """
+        self.assertTrue(no_changes(sequentially(changes=[
+            in_parallel(changes=[]), sequentially(changes=[])])))
+
+    def test_change(self):
+        """
+        An ``IStateChange`` provider makes changes.
+        """
+        self.assertFalse(no_changes(ControllableAction(result=succeed(None))))
+
+    def test_nested_change(self):
+        """
+        An ``IStateChange`` provider nested in ``sequentially`` and
+        ``in_parallel`` results makes changes.
+        """
+        self.assertFalse(no_changes(sequentially(changes=[
+            in_parallel(changes=[]),
+            in_parallel(changes=[ControllableAction(result=succeed(None))]),
+        ])))
@@ -5,8 +5,11 @@ Tests for ``flocker.node._loop``.
 """
 
 from uuid import uuid4
+from signal import SIGUSR1, SIG_DFL, signal, getsignal
 
-from eliot.testing import validate_logging, assertHasAction, assertHasMessage
+from eliot.testing import (
+    validate_logging, assertHasAction, assertHasMessage, LoggedMessage,
+)
 from machinist import LOG_FSM_TRANSITION
 
 from twisted.trial.unittest import SynchronousTestCase
@@ -21,8 +24,12 @@ from .._loop import (
     _StatusUpdate, _ConnectedToControlService, ConvergenceLoopInputs,
     ConvergenceLoopStates, build_convergence_loop_fsm, AgentLoopService,
     ClusterStatus, ConvergenceLoop, LOG_SEND_TO_CONTROL_SERVICE,
-    LOG_CONVERGE, LOG_CALCULATED_ACTIONS,
+    LOG_CONVERGE, LOG_CALCULATED_ACTIONS, LOG_SLEEP, LOG_SKIPPED_CALCULATION,
+    LOG_ITERATION_TIMINGS, LOG_STATISTICS, _HEARTBEAT_INTERVAL,
+    _RECALCULATE_INTERVAL,
     )
+from .._stats import ConvergenceStatistics
+from .. import in_parallel
 from ..testtools import ControllableDeployer, ControllableAction, to_node
 from ...control import (
     NodeState, Deployment, Manifestation, Dataset, DeploymentState,
@@ -429,13 +436,15 @@ class ConvergenceLoopFSMTests(SynchronousTestCase):
 
     def test_convergence_done_start_new_iteration(self):
         """
-        After a short delay, an FSM completing the changes from one convergence
-        iteration starts another iteration.
+        After sleeping for a short delay, an FSM completing the changes from
+        one convergence iteration starts another iteration.
         """
         local_state = NodeState(hostname=u'192.0.2.123')
-        local_state2 = NodeState(hostname=u'192.0.2.123')
+        # Different from the first state, so it is sent too:
+        local_state2 = NodeState(hostname=u'192.0.2.123', used_ports=[80])
         configuration = Deployment(nodes=frozenset([to_node(local_state)]))
         state = DeploymentState(nodes=[local_state])
+        state2 = DeploymentState(nodes=[local_state2])
         action = ControllableAction(result=succeed(None))
         # Because the second action result is unfired Deferred, the second
         # iteration will never finish; applying its changes waits for this
@@ -450,13 +459,15 @@ class ConvergenceLoopFSMTests(SynchronousTestCase):
         loop = build_convergence_loop_fsm(reactor, deployer)
         loop.receive(_ClientStatusUpdate(
             client=client, configuration=configuration, state=state))
-        reactor.advance(1.0)
+        # The iteration finishes on the next turn of the reactor, then the
+        # loop sleeps for the minimum interval before starting another:
+        reactor.pump([0, 1.0])
         # Calculating actions happened, result was run... and then we did
         # whole thing again:
         self.assertTupleEqual(
             (deployer.calculate_inputs, client.calls),
             ([(local_state, configuration, state),
-              (local_state2, configuration, state)],
+              (local_state2, configuration, state2)],
              [(NodeStateCommand, dict(state_changes=(local_state,))),
               (NodeStateCommand, dict(state_changes=(local_state2,)))])
         )
@@ -484,7 +495,9 @@ class ConvergenceLoopFSMTests(SynchronousTestCase):
         self.patch(loop, "logger", logger)
         loop.receive(_ClientStatusUpdate(
             client=client, configuration=configuration, state=state))
-        reactor.advance(1.0)
+        # The iteration finishes on the next turn of the reactor, then the
+        # loop sleeps for the minimum interval before starting another:
+        reactor.pump([0, 1.0])
         # Calculating actions happened, result was run and caused error...
         # but we started on loop again and are thus in discovery state,
         # which we can tell because all faked local states have been
@@ -526,7 +539,9 @@ class ConvergenceLoopFSMTests(SynchronousTestCase):
         # which happens with second set of client, desired configuration
         # and cluster state:
         action.result.callback(None)
-        reactor.advance(1.0)
+        # The iteration finishes on the next turn of the reactor, then the
+        # loop sleeps for the minimum interval before starting another:
+        reactor.pump([0, 1.0])
 
         self.assertTupleEqual(
             (deployer.calculate_inputs, client.calls, client2.calls),
@@ -623,7 +638,9 @@ class ConvergenceLoopFSMTests(SynchronousTestCase):
         # which happens with second set of client, desired configuration
         # and cluster state:
         action.result.callback(None)
-        reactor.advance(1.0)
+        # The iteration finishes on the next turn of the reactor, then the
+        # loop sleeps for the minimum interval before starting another:
+        reactor.pump([0, 1.0])
         self.assertTupleEqual(
             (deployer.calculate_inputs, client.calls, client2.calls),
             ([(local_state, configuration, state),
@@ -632,6 +649,459 @@ class ConvergenceLoopFSMTests(SynchronousTestCase):
              [(NodeStateCommand, dict(state_changes=(local_state2,)))]))
 
 
+def _logged_intervals(logger):
+    """
+    Get the intervals the convergence loop logged when sleeping.
+
+    :param logger: A ``MemoryLogger``.
+
+    :return: ``list`` of ``float``.
+    """
+    return [message.message[u"interval"]
+            for message in LoggedMessage.ofType(logger.messages, LOG_SLEEP)]
+
+
+class _RunningLoopMixin(object):
+    """
+    Helpers for tests of convergence loops which keep on iterating.
+    """
+    def setUp(self):
+        self.local_state = NodeState(hostname=u"192.0.2.123")
+        self.configuration = Deployment(
+            nodes=frozenset([to_node(self.local_state)]))
+        self.state = DeploymentState(nodes=[self.local_state])
+        self.client = FakeAMPClient()
+        self.reactor = Clock()
+
+    def start_loop(self, actions, logger, local_states=None, **kwargs):
+        """
+        Start a convergence loop whose iterations discover the given local
+        states and calculate the given actions.  Discovery for any further
+        iteration never finishes.
+
+        :param list actions: The results of ``calculate_changes``.
+        :param logger: A ``MemoryLogger`` for the loop.
+        :param list local_states: The results of ``discover_state``, by
+            default ``local_state`` for each of ``actions``.
+        :param kwargs: Additional arguments for
+            ``build_convergence_loop_fsm``.
+
+        :return: ``(loop, deployer)`` tuple.
+        """
+        if local_states is None:
+            local_states = [self.local_state] * len(actions)
+        for local_state in local_states:
+            self.client.register_response(
+                NodeStateCommand, dict(state_changes=(local_state,)),
+                {"result": None})
+        deployer = ControllableDeployer(
+            self.local_state.hostname,
+            [succeed(local_state) for local_state in local_states] +
+            [Deferred()],
+            actions)
+        loop = build_convergence_loop_fsm(self.reactor, deployer, **kwargs)
+        self.patch(loop, "logger", logger)
+        loop.receive(_ClientStatusUpdate(
+            client=self.client, configuration=self.configuration,
+            state=self.state))
+        self.reactor.advance(0)
+        return loop, deployer
+
+    def changing_local_states(self, count):
+        """
+        :param int count: The number of local states.
+
+        :return: ``list`` of different local states, so that changes are
+            calculated for each of them.
+        """
+        return [NodeState(hostname=self.local_state.hostname,
+                          used_ports=[port]) for port in range(count)]
+
+    def advance(self):
+        """
+        Advance the clock to the next scheduled wakeup.
+        """
+        [wakeup] = self.reactor.getDelayedCalls()
+        self.reactor.advance(wakeup.getTime() - self.reactor.seconds())
+
+
+class ConvergenceLoopSleepTests(_RunningLoopMixin, SynchronousTestCase):
+    """
+    Tests for how the FSM created by ``build_convergence_loop_fsm`` waits
+    between iterations.
+    """
+    @validate_logging(None)
+    def test_converged_backs_off(self, logger):
+        """
+        While iterations find nothing to change the delay before the next
+        iteration doubles, up to the given maximum.
+        """
+        self.start_loop(
+            [in_parallel(changes=[]) for i in range(5)], logger,
+            maximum_interval=10)
+        for i in range(4):
+            self.advance()
+        self.assertEqual(
+            _logged_intervals(logger), [2.0, 4.0, 8.0, 10.0, 10.0])
+
+    @validate_logging(None)
+    def test_changes_reset_interval(self, logger):
+        """
+        After an iteration which changes something the next iteration starts
+        after the minimum delay.
+        """
+        action = ControllableAction(result=succeed(None))
+        self.start_loop(
+            [in_parallel(changes=[]), in_parallel(changes=[]), action],
+            logger, local_states=self.changing_local_states(3))
+        self.advance()
+        self.advance()
+        self.assertEqual(_logged_intervals(logger), [2.0, 4.0, 1.0])
+
+    @validate_logging(None)
+    def test_failure_resets_interval(self, logger):
+        """
+        After an iteration which fails the next iteration starts after the
+        minimum delay.
+        """
+        action = ControllableAction(result=fail(RuntimeError()))
+        self.start_loop(
+            [in_parallel(changes=[]), action], logger,
+            local_states=self.changing_local_states(2))
+        self.advance()
+        self.assertEqual(
+            (_logged_intervals(logger),
+             len(logger.flush_tracebacks(RuntimeError))),
+            ([2.0, 1.0], 1))
+
+    @validate_logging(None)
+    def test_sleeping_status_update(self, logger):
+        """
+        A sleeping FSM which receives a status update with new information
+        starts the next iteration immediately.
+        """
+        loop, deployer = self.start_loop(
+            [in_parallel(changes=[]), in_parallel(changes=[])], logger)
+        other = NodeState(hostname=u"192.0.2.124")
+        configuration = Deployment(nodes=frozenset([
+            to_node(self.local_state), to_node(other)]))
+        loop.receive(_ClientStatusUpdate(
+            client=self.client, configuration=configuration,
+            state=self.state))
+        self.reactor.advance(0)
+        self.assertEqual(
+            (len(deployer.calculate_inputs), deployer.calculate_inputs[-1][1]),
+            (2, configuration))
+
+    @validate_logging(None)
+    def test_sleeping_same_status_update(self, logger):
+        """
+        A sleeping FSM which receives a status update with nothing new keeps
+        sleeping.
+        """
+        loop, deployer = self.start_loop([in_parallel(changes=[])], logger)
+        loop.receive(_ClientStatusUpdate(
+            client=self.client, configuration=self.configuration,
+            state=self.state))
+        self.reactor.advance(0)
+        self.assertEqual(
+            (len(deployer.calculate_inputs), loop.state,
+             [call.getTime() for call in self.reactor.getDelayedCalls()]),
+            (1, ConvergenceLoopStates.SLEEPING, [2.0]))
+
+    @validate_logging(None)
+    def test_sleeping_wakeup(self, logger):
+        """
+        A sleeping FSM which receives a ``WAKEUP`` input starts the next
+        iteration immediately and no longer has a wakeup scheduled.
+        """
+        loop, deployer = self.start_loop([in_parallel(changes=[])], logger)
+        loop.receive(ConvergenceLoopInputs.WAKEUP)
+        self.assertEqual(
+            (len(deployer.local_states), loop.state,
+             self.reactor.getDelayedCalls()),
+            (0, ConvergenceLoopStates.CONVERGING, []))
+
+    @validate_logging(None)
+    def test_converging_wakeup(self, logger):
+        """
+        An FSM which receives a ``WAKEUP`` input while converging starts the
+        next iteration after the minimum delay, even if the current
+        iteration finds nothing to change.
+        """
+        loop, deployer = self.start_loop([in_parallel(changes=[])], logger)
+        discovery = Deferred()
+        deployer.local_states[:] = [discovery, Deferred()]
+        deployer.calculated_actions.append(in_parallel(changes=[]))
+        loop.receive(ConvergenceLoopInputs.WAKEUP)
+        loop.receive(ConvergenceLoopInputs.WAKEUP)
+        discovery.callback(self.local_state)
+        self.reactor.advance(0)
+        self.assertEqual(_logged_intervals(logger), [2.0, 1.0])
+
+    @validate_logging(None)
+    def test_sleeping_stop(self, logger):
+        """
+        A sleeping FSM which receives a stop input stops and no longer has a
+        wakeup scheduled.
+        """
+        loop, deployer = self.start_loop([in_parallel(changes=[])], logger)
+        loop.receive(ConvergenceLoopInputs.STOP)
+        self.assertEqual(
+            (loop.state, self.reactor.getDelayedCalls()),
+            (ConvergenceLoopStates.STOPPED, []))
+
+    def test_stopped_wakeup(self):
+        """
+        A stopped FSM ignores ``WAKEUP`` inputs.
+        """
+        deployer = ControllableDeployer(u"192.168.1.1", [], [])
+        loop = build_convergence_loop_fsm(self.reactor, deployer)
+        loop.receive(ConvergenceLoopInputs.WAKEUP)
+        self.assertEqual(
+            (loop.state, self.reactor.getDelayedCalls()),
+            (ConvergenceLoopStates.STOPPED, []))
+
+
+class _UnacknowledgingAMPClient(FakeAMPClient):
+    """
+    A ``FakeAMPClient`` which never gets responses to its commands.
+    """
+    def callRemote(self, command, **kwargs):
+        self.calls.append((command, kwargs))
+        return Deferred()
+
+
+class ConvergenceLoopSendTests(_RunningLoopMixin, SynchronousTestCase):
+    """
+    Tests for when the FSM created by ``build_convergence_loop_fsm`` sends
+    local state to the control service.
+    """
+    def sent(self, client):
+        """
+        :param client: A ``FakeAMPClient``.
+
+        :return: ``list`` of the state changes sent using ``client``.
+        """
+        return [kwargs["state_changes"] for command, kwargs in client.calls
+                if command is NodeStateCommand]
+
+    @validate_logging(None)
+    def test_unchanged_not_sent(self, logger):
+        """
+        Local state which the control service has acknowledged receiving on
+        the current connection is not sent again.
+        """
+        self.start_loop(
+            [in_parallel(changes=[]), in_parallel(changes=[])], logger)
+        self.advance()
+        self.assertEqual(self.sent(self.client), [(self.local_state,)])
+
+    @validate_logging(None)
+    def test_unacknowledged_sent(self, logger):
+        """
+        Local state which the control service has not acknowledged receiving
+        is sent again.
+        """
+        self.client = _UnacknowledgingAMPClient()
+        self.start_loop(
+            [in_parallel(changes=[]), in_parallel(changes=[])], logger)
+        self.advance()
+        self.assertEqual(
+            self.sent(self.client), [(self.local_state,), (self.local_state,)])
+
+    @validate_logging(None)
+    def test_new_connection_sent(self, logger):
+        """
+        Local state acknowledged on a previous connection is sent again on a
+        new connection.
+        """
+        loop, deployer = self.start_loop(
+            [in_parallel(changes=[]), in_parallel(changes=[])], logger)
+        client = FakeAMPClient()
+        client.register_response(
+            NodeStateCommand, dict(state_changes=(self.local_state,)),
+            {"result": None})
+        loop.receive(_ClientStatusUpdate(
+            client=client, configuration=self.configuration,
+            state=self.state))
+        self.reactor.advance(0)
+        self.assertEqual(
+            (self.sent(self.client), self.sent(client)),
+            ([(self.local_state,)], [(self.local_state,)]))
+
+    @validate_logging(None)
+    def test_heartbeat(self, logger):
+        """
+        Unchanged local state is sent again once the heartbeat interval has
+        passed.
+        """
+        self.start_loop(
+            [in_parallel(changes=[]), in_parallel(changes=[])], logger)
+        self.reactor.advance(_HEARTBEAT_INTERVAL)
+        self.assertEqual(
+            self.sent(self.client), [(self.local_state,), (self.local_state,)])
+
+
+class ConvergenceLoopSkipTests(_RunningLoopMixin, SynchronousTestCase):
+    """
+    Tests for when the FSM created by ``build_convergence_loop_fsm`` skips
+    calculating changes.
+    """
+    @validate_logging(assertHasMessage, LOG_SKIPPED_CALCULATION)
+    def test_unchanged_skipped(self, logger):
+        """
+        Changes aren't calculated when the configuration and cluster state
+        are the same as in the previous iteration, which found nothing to
+        change.
+        """
+        loop, deployer = self.start_loop(
+            [in_parallel(changes=[]), in_parallel(changes=[])], logger)
+        self.advance()
+        world = loop._fsm._world.original
+        self.assertEqual(
+            (len(deployer.calculate_inputs), world.executed_iterations,
+             world.skipped_iterations),
+            (1, 1, 1))
+
+    @validate_logging(None)
+    def test_skipped_backs_off(self, logger):
+        """
+        Skipped iterations count as having found nothing to change.
+        """
+        self.start_loop(
+            [in_parallel(changes=[])], logger,
+            local_states=[self.local_state] * 3)
+        self.advance()
+        self.advance()
+        self.assertEqual(_logged_intervals(logger), [2.0, 4.0, 8.0])
+
+    @validate_logging(None)
+    def test_changed_configuration_calculated(self, logger):
+        """
+        Changes are calculated when the configuration has changed.
+        """
+        loop, deployer = self.start_loop(
+            [in_parallel(changes=[]), in_parallel(changes=[])], logger)
+        configuration = Deployment(nodes=frozenset([
+            to_node(self.local_state),
+            to_node(NodeState(hostname=u"192.0.2.124"))]))
+        loop.receive(_ClientStatusUpdate(
+            client=self.client, configuration=configuration,
+            state=self.state))
+        self.reactor.advance(0)
+        self.assertEqual(len(deployer.calculate_inputs), 2)
+
+    @validate_logging(None)
+    def test_after_changes_calculated(self, logger):
+        """
+        Changes are calculated when the previous iteration changed something,
+        even if the inputs are the same.
+        """
+        action = ControllableAction(result=succeed(None))
+        loop, deployer = self.start_loop(
+            [action, in_parallel(changes=[])], logger)
+        self.advance()
+        self.assertEqual(len(deployer.calculate_inputs), 2)
+
+    @validate_logging(None)
+    def test_recalculated(self, logger):
+        """
+        Changes are calculated again once the recalculation interval has
+        passed, even if the inputs are the same.
+        """
+        loop, deployer = self.start_loop(
+            [in_parallel(changes=[]), in_parallel(changes=[])], logger)
+        self.reactor.advance(_RECALCULATE_INTERVAL)
+        self.assertEqual(len(deployer.calculate_inputs), 2)
+
+
+class ConvergenceLoopTimingTests(_RunningLoopMixin, SynchronousTestCase):
+    """
+    Tests for the timings recorded by the FSM created by
+    ``build_convergence_loop_fsm``.
+    """
+    def run_iteration(self, logger, statistics=None):
+        """
+        Run an iteration whose discovery takes 3 seconds and whose only
+        change takes 2 seconds.
+
+        :param logger: A ``MemoryLogger`` for the loop.
+        :param statistics: ``ConvergenceStatistics`` for the loop, or
+            ``None``.
+        """
+        discovery = Deferred()
+        action = ControllableAction(result=Deferred())
+        deployer = ControllableDeployer(
+            self.local_state.hostname, [discovery, Deferred()], [action])
+        self.client.register_response(
+            NodeStateCommand, dict(state_changes=(self.local_state,)),
+            {"result": None})
+        loop = build_convergence_loop_fsm(
+            self.reactor, deployer, statistics=statistics)
+        self.patch(loop, "logger", logger)
+        loop.receive(_ClientStatusUpdate(
+            client=self.client, configuration=self.configuration,
+            state=self.state))
+        self.reactor.advance(3)
+        discovery.callback(self.local_state)
+        self.reactor.advance(2)
+        action.result.callback(None)
+
+    def assert_timings_logged(self, logger):
+        """
+        The timings of the phases of the iteration are logged within the
+        convergence action.
+        """
+        converge = assertHasAction(self, logger, LOG_CONVERGE, True)
+        timings = assertHasMessage(
+            self, logger, LOG_ITERATION_TIMINGS,
+            {u"discover_state": 3.0, u"calculate_changes": 0.0,
+             u"run_changes": 2.0,
+             u"change_times": [(u"ControllableAction", 2.0)]})
+        self.assertIn(timings, converge.children)
+
+    @validate_logging(assert_timings_logged)
+    def test_timings_logged(self, logger):
+        """
+        The duration of each phase of an iteration and of each state change
+        is logged.
+        """
+        self.run_iteration(logger)
+
+    @validate_logging(None)
+    def test_statistics(self, logger):
+        """
+        The timings of each iteration are recorded in the given
+        ``ConvergenceStatistics``.
+        """
+        statistics = ConvergenceStatistics()
+        self.run_iteration(logger, statistics)
+        [timings] = statistics.iterations
+        self.assertEqual(
+            timings.to_dict(),
+            {u"started": 0.0,
+             u"phases": {u"discover_state": 3.0,
+                         u"calculate_changes": 0.0,
+                         u"run_changes": 2.0},
+             u"changes": [[u"ControllableAction", 2.0]]})
+
+    @validate_logging(None)
+    def test_skipped_timings(self, logger):
+        """
+        Phases which are skipped because nothing changed are logged as
+        ``None``.
+        """
+        self.start_loop([in_parallel(changes=[])] * 2, logger)
+        self.advance()
+        [first, second] = LoggedMessage.ofType(
+            logger.messages, LOG_ITERATION_TIMINGS)
+        self.assertEqual(
+            (second.message[u"calculate_changes"],
+             second.message[u"run_changes"]),
+            (None, None))
+
+
 class AgentLoopServiceTests(SynchronousTestCase):
     """
     Tests for ``AgentLoopService``.
@@ -727,6 +1197,68 @@ class AgentLoopServiceTests(SynchronousTestCase):
         self.assertEqual(fsm.inputted, [_StatusUpdate(configuration=config,
                                                       state=state)])
 
+    def test_local_state_changed(self):
+        """
+        When ``local_state_changed()`` is called a
+        ``ConvergenceLoopInputs.WAKEUP`` input is passed to the convergence
+        loop FSM.
+        """
+        service = AgentLoopService(
+            reactor=None, deployer=object(), host=u"example.com", port=1234)
+        service.convergence_loop = fsm = StubFSM()
+        service.local_state_changed()
+        self.assertEqual(fsm.inputted, [ConvergenceLoopInputs.WAKEUP])
+
+    @validate_logging(None)
+    def test_dump_statistics(self, logger):
+        """
+        ``dump_statistics()`` logs the service's statistics, which are those
+        the convergence loop records iterations in.
+        """
+        service = AgentLoopService(
+            reactor=None, deployer=object(), host=u"example.com", port=1234)
+        self.patch(service, "logger", logger)
+        service.dump_statistics()
+        loop_statistics = (
+            service.convergence_loop._fsm._world.original.statistics)
+        assertHasMessage(
+            self, logger, LOG_STATISTICS,
+            {u"statistics": service.statistics})
+        self.assertIs(loop_statistics, service.statistics)
+
+    def test_statistics_signal(self):
+        """
+        While the service runs, receiving its ``statistics_signal`` causes
+        ``dump_statistics()`` to be called in the reactor thread.  Stopping
+        the service restores the previous handler.
+        """
+        self.addCleanup(signal, SIGUSR1, getsignal(SIGUSR1))
+        signal(SIGUSR1, SIG_DFL)
+        reactor = MemoryReactorClock()
+        called = []
+        reactor.callFromThread = lambda f, *args: called.append(f)
+        service = AgentLoopService(
+            reactor=reactor, deployer=object(), host=u"example.com",
+            port=1234, statistics_signal=SIGUSR1)
+        service.cluster_status = StubFSM()
+        service.startService()
+        getsignal(SIGUSR1)(SIGUSR1, None)
+        service.stopService()
+        self.assertEqual(
+            (called, getsignal(SIGUSR1)), ([service.dump_statistics], SIG_DFL))
+
+    def test_maximum_interval(self):
+        """
+        The convergence loop FSM is configured with the given maximum
+        interval.
+        """
+        service = AgentLoopService(
+            reactor=None, deployer=object(), host=u"example.com", port=1234,
+            maximum_interval=30.0)
+        self.assertEqual(
+            service.convergence_loop._fsm._world.original.maximum_interval,
+            30.0)
+
 
 def _build_service(test):
     """
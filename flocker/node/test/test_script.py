@@ -3,6 +3,8 @@
 """
 Tests for :module:`flocker.node.script`.
 """
+from signal import SIGUSR1, signal, getsignal
+
 import netifaces
 import yaml
 
@@ -30,6 +32,8 @@ class ZFSAgentScriptTests(SynchronousTestCase):
     Tests for ``ZFSAgentScript``.
     """
     def setUp(self):
+        # The started convergence loop service installs a signal handler:
+        self.addCleanup(signal, SIGUSR1, getsignal(SIGUSR1))
         scratch_directory = FilePath(self.mktemp())
         scratch_directory.makedirs()
         self.config = scratch_directory.child('dataset-config.yml')
@@ -82,7 +86,8 @@ class ZFSAgentScriptTests(SynchronousTestCase):
                          (AgentLoopService(reactor=test_reactor,
                                            deployer=None,
                                            host=u"10.0.0.1",
-                                           port=1234),
+                                           port=1234,
+                                           statistics_signal=SIGUSR1),
                           P2PManifestationDeployer, service, True))
 
 
@@ -146,6 +151,7 @@ class AgentServiceFactoryTests(SynchronousTestCase):
                 deployer=deployer,
                 host=b"10.0.0.2",
                 port=1234,
+                statistics_signal=SIGUSR1,
             ),
             service_factory.get_service(reactor, options)
         )
@@ -0,0 +1,138 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+
+"""
+Tests for ``flocker.node._stats``.
+"""
+
+from twisted.trial.unittest import SynchronousTestCase
+from twisted.internet.task import Clock
+
+from .._stats import Histogram, IterationTimings, ConvergenceStatistics
+from ..testtools import ControllableAction
+
+
+class HistogramTests(SynchronousTestCase):
+    """
+    Tests for ``Histogram``.
+    """
+    def test_empty(self):
+        """
+        A new histogram has no durations.
+        """
+        self.assertEqual(
+            Histogram().to_dict(),
+            {u"buckets": {u"<=0.001": 0, u"<=0.01": 0, u"<=0.1": 0,
+                          u"<=1": 0, u"<=10": 0, u"<=100": 0, u">100": 0},
+             u"count": 0, u"total": 0.0, u"maximum": 0.0})
+
+    def test_add(self):
+        """
+        Durations are counted in the smallest bucket they fit in, or in the
+        last bucket if they fit in none.
+        """
+        histogram = Histogram()
+        for seconds in [0.0009765625, 0.5, 1.0, 2.0, 512.0]:
+            histogram.add(seconds)
+        self.assertEqual(
+            histogram.to_dict(),
+            {u"buckets": {u"<=0.001": 1, u"<=0.01": 0, u"<=0.1": 0,
+                          u"<=1": 2, u"<=10": 1, u"<=100": 0, u">100": 1},
+             u"count": 5, u"total": 515.5009765625, u"maximum": 512.0})
+
+
+class IterationTimingsTests(SynchronousTestCase):
+    """
+    Tests for ``IterationTimings``.
+    """
+    def test_phases(self):
+        """
+        ``IterationTimings.time_phase`` records how long a phase took once it
+        finishes.
+        """
+        clock = Clock()
+        clock.advance(5)
+        timings = IterationTimings(clock)
+        discovered = timings.time_phase(u"discover_state")
+        clock.advance(2)
+        unfinished = timings.time_phase(u"calculate_changes")
+        discovered()
+        self.assertEqual(
+            (unfinished is not None, timings.to_dict()),
+            (True, {u"started": 5.0, u"phases": {u"discover_state": 2.0},
+                    u"changes": []}))
+
+    def test_changes(self):
+        """
+        ``IterationTimings.time_change`` records the type name of each state
+        change and how long it took, in the order they finish.
+        """
+        clock = Clock()
+        timings = IterationTimings(clock)
+        first = timings.time_change(ControllableAction(result=None))
+        second = timings.time_change(object())
+        clock.advance(1)
+        second()
+        clock.advance(2)
+        first()
+        self.assertEqual(
+            timings.changes,
+            [(u"object", 1.0), (u"ControllableAction", 3.0)])
+
+
+class ConvergenceStatisticsTests(SynchronousTestCase):
+    """
+    Tests for ``ConvergenceStatistics``.
+    """
+    def timings(self, seconds):
+        """
+        :param float seconds: How long the phase and change took.
+
+        :return: ``IterationTimings`` with a ``discover_state`` phase and an
+            ``object`` change which took the given time.
+        """
+        clock = Clock()
+        timings = IterationTimings(clock)
+        discovered = timings.time_phase(u"discover_state")
+        changed = timings.time_change(object())
+        clock.advance(seconds)
+        discovered()
+        changed()
+        return timings
+
+    def test_history(self):
+        """
+        Only the given number of most recent iterations are kept.
+        """
+        statistics = ConvergenceStatistics(history=2)
+        timings = [self.timings(seconds) for seconds in (1, 2, 3)]
+        for iteration in timings:
+            statistics.record(iteration)
+        self.assertEqual(list(statistics.iterations), timings[1:])
+
+    def test_histograms(self):
+        """
+        The durations of all recorded phases and changes are counted in
+        histograms named after them.
+        """
+        statistics = ConvergenceStatistics(history=1)
+        for seconds in (0.5, 5):
+            statistics.record(self.timings(seconds))
+        self.assertEqual(
+            {name: (histogram.count, histogram.total)
+             for name, histogram in statistics.histograms.items()},
+            {u"discover_state": (2, 5.5), u"object": (2, 5.5)})
+
+    def test_to_dict(self):
+        """
+        ``ConvergenceStatistics.to_dict`` describes the recent iterations and
+        the histograms.
+        """
+        statistics = ConvergenceStatistics()
+        timings = self.timings(1)
+        statistics.record(timings)
+        self.assertEqual(
+            statistics.to_dict(),
+            {u"iterations": [timings.to_dict()],
+             u"histograms": {
+                 name: histogram.to_dict()
+                 for name, histogram in statistics.histograms.items()}})
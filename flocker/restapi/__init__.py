@@ -5,13 +5,15 @@ Infrastructure for publishing a REST HTTP API.
 """
 
 from ._infrastructure import (
-    structured, EndpointResponse, user_documentation,
+    structured, EndpointResponse, user_documentation, versioned,
+    OutputValidation, set_output_validation,
     )
 
-from ._error import makeBadRequest as make_bad_request
+from ._error import makeBadRequest as make_bad_request, BadRequest
 
 
 __all__ = [
-    "structured", "EndpointResponse", "user_documentation",
-    "make_bad_request",
+    "structured", "EndpointResponse", "user_documentation", "versioned",
+    "OutputValidation", "set_output_validation", "make_bad_request",
+    "BadRequest",
 ]
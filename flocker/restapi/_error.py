@@ -8,9 +8,10 @@ __all__ = [
     "BadRequest", "InvalidRequestJSON", "makeBadRequest",
 
     "DECODING_ERROR_DESCRIPTION", "ILLEGAL_CONTENT_TYPE_DESCRIPTION",
+    "QUERY_DECODING_ERROR_DESCRIPTION", "REQUEST_TOO_LARGE_DESCRIPTION",
 
     "DECODING_ERROR", "ILLEGAL_CONTENT_TYPE", "UNAUTHORIZED",
-    "ENTITY_NOT_FOUND",
+    "ENTITY_NOT_FOUND", "QUERY_DECODING_ERROR", "REQUEST_TOO_LARGE",
 
     "NameCollision",
 
@@ -19,7 +20,8 @@ __all__ = [
 
 from inspect import cleandoc
 
-from twisted.web.http import BAD_REQUEST, FORBIDDEN, NOT_FOUND
+from twisted.web.http import (
+    BAD_REQUEST, FORBIDDEN, NOT_FOUND, REQUEST_ENTITY_TOO_LARGE)
 
 # HTTP response code indicating the request is syntactically correct but
 # semantically wrong, as defined in
@@ -62,9 +64,15 @@ DECODING_ERROR_DESCRIPTION = cleandoc(u"""
     The request body could not be decoded according to the value of the
     Content-Type header.
     """)
+QUERY_DECODING_ERROR_DESCRIPTION = cleandoc(u"""
+    The query arguments could not be decoded as UTF-8.
+    """)
 ILLEGAL_CONTENT_TYPE_DESCRIPTION = cleandoc(u"""
     The request Content-Type was not a supported type (application/json).
     """)
+REQUEST_TOO_LARGE_DESCRIPTION = cleandoc(u"""
+    The request body is larger than this endpoint accepts.
+    """)
 NOT_FOUND_DESCRIPTION = cleandoc(u"""
     The specified entity either does not exist or you are not allowed to access
     it.
@@ -74,8 +82,12 @@ UNAUTHORIZED_DESCRIPTION = cleandoc("""
     """)
 
 DECODING_ERROR = makeBadRequest(description=DECODING_ERROR_DESCRIPTION)
+QUERY_DECODING_ERROR = makeBadRequest(
+    description=QUERY_DECODING_ERROR_DESCRIPTION)
 ILLEGAL_CONTENT_TYPE = makeBadRequest(
     description=ILLEGAL_CONTENT_TYPE_DESCRIPTION)
+REQUEST_TOO_LARGE = makeBadRequest(
+    code=REQUEST_ENTITY_TOO_LARGE, description=REQUEST_TOO_LARGE_DESCRIPTION)
 ENTITY_NOT_FOUND = makeBadRequest(
     code=NOT_FOUND, description=NOT_FOUND_DESCRIPTION)
 UNAUTHORIZED = makeBadRequest(
@@ -6,22 +6,33 @@ This module implements tools for exposing Python methods as API endpoints.
 from __future__ import absolute_import
 
 __all__ = [
-    "EndpointResponse", "structured", "user_documentation",
+    "EndpointResponse", "structured", "user_documentation", "versioned",
+    "OutputValidation", "set_output_validation",
     ]
 
 from functools import wraps
+from itertools import chain, islice
+from random import random
+from weakref import WeakKeyDictionary
 
 from json import loads, dumps
 
-from twisted.internet.defer import maybeDeferred
-from twisted.web.http import OK, INTERNAL_SERVER_ERROR
+from twisted.internet.defer import maybeDeferred, CancelledError
+from twisted.internet.task import (
+    cooperate as _cooperate, TaskDone, TaskStopped)
+from twisted.python.constants import Names, NamedConstant
+from twisted.web.http import (
+    OK, INTERNAL_SERVER_ERROR, NOT_MODIFIED, PRECONDITION_FAILED,
+)
 
 from eliot import Logger, writeFailure
 from eliot.twisted import DeferredContext
 
 from ._error import (
-    ILLEGAL_CONTENT_TYPE, DECODING_ERROR, BadRequest, InvalidRequestJSON)
-from ._logging import LOG_SYSTEM, REQUEST, JSON_REQUEST
+    ILLEGAL_CONTENT_TYPE, DECODING_ERROR, QUERY_DECODING_ERROR,
+    REQUEST_TOO_LARGE, BadRequest, InvalidRequestJSON)
+from ._logging import (
+    LOG_SYSTEM, REQUEST, JSON_REQUEST, INPUT_VALIDATION, OUTPUT_VALIDATION)
 from ._schema import getValidator
 
 _ASCENDING = b"ascending"
@@ -30,6 +41,139 @@ _DESCENDING = b"descending"
 _logger = Logger()
 
 
+class OutputValidation(Names):
+    """
+    Policies for validating response bodies against their output schemas.
+
+    :ivar ALWAYS: Validate every response.  This is the default, and catches
+        endpoints which don't match their documented schema.
+    :ivar SAMPLED: Validate a random sample of responses, at the rate given
+        by each endpoint.
+    :ivar NEVER: Don't validate responses.
+    """
+    ALWAYS = NamedConstant()
+    SAMPLED = NamedConstant()
+    NEVER = NamedConstant()
+
+
+_output_validation = OutputValidation.ALWAYS
+
+
+def set_output_validation(policy):
+    """
+    Choose how response bodies are validated by all ``structured``
+    endpoints.
+
+    :param NamedConstant policy: One of the ``OutputValidation`` constants.
+    """
+    global _output_validation
+    _output_validation = policy
+
+
+def _should_validate(rate):
+    """
+    Decide whether to validate a response body.
+
+    :param float rate: The fraction of responses an endpoint wants validated
+        when responses are sampled.
+
+    :return bool: Whether to validate this response.
+    """
+    if _output_validation is OutputValidation.ALWAYS:
+        return True
+    if _output_validation is OutputValidation.NEVER:
+        return False
+    return random() < rate
+
+
+# Arrays with more items than this are streamed by endpoints which allow it:
+_STREAM_THRESHOLD = 1000
+
+# The number of items of a streamed array encoded between giving other work
+# a chance to run:
+_STREAM_CHUNK_SIZE = 100
+
+
+class _StreamedArray(object):
+    """
+    A JSON array response body which is encoded and written a chunk at a
+    time.
+
+    :ivar items: An iterator of the JSON-encodeable items of the array.
+    """
+    def __init__(self, items):
+        self.items = items
+
+
+def _start_stream(items):
+    """
+    Decide whether to stream the items of an array.
+
+    :param items: An iterable of JSON-encodeable items.
+
+    :return: A ``list`` of all the items if there are at most
+        ``_STREAM_THRESHOLD`` of them, otherwise a ``_StreamedArray``.
+    """
+    items = iter(items)
+    head = list(islice(items, _STREAM_THRESHOLD + 1))
+    if len(head) <= _STREAM_THRESHOLD:
+        return head
+    return _StreamedArray(chain(head, items))
+
+
+def _write_array(request, items, validate, logger):
+    """
+    Write a JSON array to a request ``_STREAM_CHUNK_SIZE`` items at a time,
+    letting the reactor do other work between chunks.
+
+    Once part of the array has been written the response can no longer be
+    turned into an error, so if getting, validating or encoding a later
+    chunk fails the failure is logged and the connection is aborted, rather
+    than finishing a truncated array the client might mistake for the whole
+    result.
+
+    :param request: The ``IRequest`` to write to.
+    :param items: An iterator of the JSON-encodeable items of the array.
+    :param validate: A one-argument callable which is passed each ``list``
+        of items before it is written, and raises an exception if they are
+        invalid.
+    :param logger: The ``eliot.Logger`` to log failures to.
+
+    :return: A ``Deferred`` that fires with ``b""`` once the whole array
+        has been written, the client has gone away or the connection has
+        been aborted.
+    """
+    def write_chunks():
+        request.write(b"[")
+        separator = b""
+        while True:
+            chunk = list(islice(items, _STREAM_CHUNK_SIZE))
+            if not chunk:
+                break
+            validate(chunk)
+            request.write(
+                separator + b",".join(dumps(item) for item in chunk))
+            separator = b","
+            yield
+        request.write(b"]")
+
+    task = _cooperate(write_chunks())
+
+    def disconnected(reason):
+        try:
+            task.stop()
+        except TaskDone:
+            pass
+    request.notifyFinish().addErrback(disconnected)
+
+    def stopped(reason):
+        if not reason.check(TaskStopped, CancelledError):
+            writeFailure(reason, logger, LOG_SYSTEM)
+            request.transport.abortConnection()
+        return b""
+    return task.whenDone().addCallbacks(lambda _: b"", stopped)
+
+
 class EndpointResponse(object):
     """
     An endpoint can return an L{EndpointResponse} instance to return a custom
@@ -109,38 +253,55 @@ def _logging(original):
     return logger
 
 
-def _serialize(outputValidator):
+def _serialize(outputValidator, validation_rate, endpoint):
     """
     Decorate a function so that its return value is automatically JSON encoded
     into a structure indicating a successful result.
 
     @param outputValidator: A L{jsonschema} validator for the returned JSON.
+    @param float validation_rate: The fraction of results to validate when
+        output validation is L{OutputValidation.SAMPLED}.
+    @param unicode endpoint: The name of the endpoint, for logging.
 
     @return: A decorator that decorates a function with the signature
         of a Klein route endpoint that may return a Deferred.
     """
     def deco(original):
-        def success(result, request):
+        def success(result, request, logger):
             code = OK
             if isinstance(result, EndpointResponse):
                 code = result.code
                 result = result.result
-            outputValidator.validate(result)
+            validating = _should_validate(validation_rate)
+
+            def validate(json):
+                if validating:
+                    # The action's duration is the cost of validation:
+                    with OUTPUT_VALIDATION(logger, endpoint=endpoint):
+                        outputValidator.validate(json)
+            if not isinstance(result, _StreamedArray):
+                validate(result)
             request.responseHeaders.setRawHeaders(
                 b"content-type", [b"application/json"])
             request.setResponseCode(code)
+            if isinstance(result, _StreamedArray):
+                # Each chunk is itself a valid array:
+                return _write_array(
+                    request, result.items, validate, logger)
             return dumps(result)
 
         def doit(self, request, **routeArguments):
             result = maybeDeferred(original, self, request, **routeArguments)
-            result.addCallback(success, request)
+            result.addCallback(success, request, _get_logger(self))
             return result
 
         return doit
     return deco
 
 
-def structured(inputSchema, outputSchema, schema_store=None):
+def structured(inputSchema, outputSchema, schema_store=None,
+               output_validation_rate=1.0, query_arguments=False,
+               stream_output=False, maximum_body_size=None):
     """
     Decorate a Klein-style endpoint method so that the request body is
     automatically decoded and the response body is automatically encoded.
@@ -158,11 +319,33 @@ def structured(inputSchema, outputSchema, schema_store=None):
     The encoded form of the object returned by C{original} will define the
     response body.
 
+    If ``query_arguments`` is true the query arguments of ``GET`` requests
+    are passed the same way, as ``unicode`` strings, and validated against
+    ``inputSchema``.  For example ``?foo=bar`` also results in the call
+    above.
+
+    If ``stream_output`` is true C{original} returns an iterable of the items
+    of a JSON array, rather than the array itself.  Arrays of up to
+    ``_STREAM_THRESHOLD`` items are handled like any other result.  Longer
+    arrays are encoded and written a chunk at a time, so that neither the
+    items nor the encoded body need be in memory all at once and other
+    requests are served in between.  Each chunk is validated separately,
+    so ``outputSchema`` must not constrain the array as a whole.
+
     :param inputSchema: JSON Schema describing the request body.
     :param outputSchema: JSON Schema describing the response body.
     :param schema_store: A mapping between schema paths
         (e.g. ``b/v1/types.json``) and the JSON schema structure, allowing
         input/output schemas to just be references.
+    :param float output_validation_rate: The fraction of response bodies to
+        validate against ``outputSchema`` when output validation is
+        ``OutputValidation.SAMPLED``.  See ``set_output_validation``.
+    :param bool query_arguments: Whether ``GET`` requests take arguments
+        from the query string.
+    :param bool stream_output: Whether to stream long array results.
+    :param maximum_body_size: The size in bytes of the largest request body
+        to accept, or ``None`` for no limit.  Larger request bodies get a
+        I{REQUEST ENTITY TOO LARGE} response without being decoded.
     """
     if schema_store is None:
         schema_store = {}
@@ -170,11 +353,28 @@ def structured(inputSchema, outputSchema, schema_store=None):
     outputValidator = getValidator(outputSchema, schema_store)
 
     def deco(original):
+        endpoint = original.__name__.decode("ascii")
+
+        def _validate(logger, objects):
+            # The action's duration is the cost of validation:
+            with INPUT_VALIDATION(logger, endpoint=endpoint):
+                errors = [error.message
+                          for error in inputValidator.iter_errors(objects)]
+            if errors:
+                raise InvalidRequestJSON(errors=errors, schema=inputSchema)
+
         @wraps(original)
         @_logging
-        @_serialize(outputValidator)
+        @_serialize(outputValidator, output_validation_rate, endpoint)
         def loadAndDispatch(self, request, **routeArguments):
-            if request.method in (b"GET", b"DELETE"):
+            if request.method == b"GET" and query_arguments:
+                try:
+                    objects = {name: values[-1].decode("utf-8")
+                               for name, values in request.args.items()}
+                except UnicodeDecodeError:
+                    raise QUERY_DECODING_ERROR
+                _validate(_get_logger(self), objects)
+            elif request.method in (b"GET", b"DELETE"):
                 objects = {}
             else:
                 contentType = request.requestHeaders.getRawHeaders(
@@ -182,17 +382,17 @@ def structured(inputSchema, outputSchema, schema_store=None):
                 if contentType != b"application/json":
                     raise ILLEGAL_CONTENT_TYPE
 
-                body = request.content.read()
+                if maximum_body_size is None:
+                    body = request.content.read()
+                else:
+                    body = request.content.read(maximum_body_size + 1)
+                    if len(body) > maximum_body_size:
+                        raise REQUEST_TOO_LARGE
                 try:
                     objects = loads(body)
                 except ValueError:
                     raise DECODING_ERROR
-
-                errors = []
-                for error in inputValidator.iter_errors(objects):
-                    errors.append(error.message)
-                if errors:
-                    raise InvalidRequestJSON(errors=errors, schema=inputSchema)
+                _validate(_get_logger(self), objects)
 
             eliot_action = JSON_REQUEST(_get_logger(self), json=objects.copy())
             with eliot_action.context():
@@ -211,6 +411,11 @@ def structured(inputSchema, outputSchema, schema_store=None):
                     if isinstance(result, EndpointResponse):
                         code = result.code
                         json = result.result
+                    elif stream_output:
+                        result = json = _start_stream(result)
+                        if isinstance(result, _StreamedArray):
+                            # Too long to log, and not yet computed:
+                            json = None
                     eliot_action.add_success_fields(code=code, json=json)
                     return result
                 d.addCallback(got_result)
@@ -218,6 +423,7 @@ def structured(inputSchema, outputSchema, schema_store=None):
                 return d.result
 
         loadAndDispatch.inputSchema = inputSchema
+        loadAndDispatch.queryArguments = query_arguments
         loadAndDispatch.outputSchema = outputSchema
         return loadAndDispatch
     return deco
@@ -241,3 +447,183 @@ def user_documentation(doc, examples=None):
         f.examples = examples
         return f
     return deco
+
+
+def _etag(version):
+    """
+    Create an entity tag.
+
+    :param unicode version: Identifies a version of a resource.
+
+    :return bytes: The value of an ``ETag`` header for the version.
+    """
+    return b'"%s"' % (version.encode("ascii"),)
+
+
+def _etag_matches(header, etag, weak=False, wildcard=True):
+    """
+    Determine whether an ``If-Match`` or ``If-None-Match`` header matches an
+    entity tag.
+
+    :param bytes header: The value of the header.
+    :param bytes etag: The entity tag of the current version of the resource.
+    :param bool weak: Whether to use weak comparison, as for
+        ``If-None-Match``, rather than strong comparison, as for
+        ``If-Match``.  Weak entity tags only match using weak comparison
+        (RFC 7232 section 2.3.2).
+    :param bool wildcard: Whether ``*`` matches.
+
+    :return bool: Whether any of the entity tags in the header match.
+    """
+    for candidate in header.split(b","):
+        candidate = candidate.strip()
+        if candidate.startswith(b"W/"):
+            if not weak:
+                continue
+            candidate = candidate[2:]
+        if candidate == etag or (wildcard and candidate == b"*"):
+            return True
+    return False
+
+
+# The longest time, in seconds, a request may wait for a resource to
+# change:
+_MAXIMUM_WAIT = 300
+
+
+def _requested_wait(request):
+    """
+    Find how long a client is prepared to wait for a resource to change,
+    from a ``Prefer: wait=<seconds>`` header (RFC 7240).
+
+    :param request: The ``IRequest``.
+
+    :return: The number of seconds to wait, at most ``_MAXIMUM_WAIT``, or
+        ``None`` if the client doesn't want to wait.
+    """
+    header = request.getHeader(b"prefer")
+    if header is None:
+        return None
+    for preference in header.replace(b";", b",").split(b","):
+        name, _, value = preference.strip().partition(b"=")
+        if name.lower() == b"wait":
+            try:
+                return max(0, min(int(value), _MAXIMUM_WAIT))
+            except ValueError:
+                return None
+    return None
+
+
+def versioned(get_version, wait_for_change=None, cache_responses=False):
+    """
+    Decorate a Klein-style endpoint method to support conditional requests
+    using entity tags.
+
+    Responses include an ``ETag`` header identifying the version of the
+    resource after the request.  ``GET`` requests with a matching
+    ``If-None-Match`` header get a I{NOT MODIFIED} response without the
+    endpoint being called, and requests with an ``If-Match`` header which
+    doesn't match get a I{PRECONDITION FAILED} response.
+
+    If ``wait_for_change`` is given, ``GET`` requests with an
+    ``If-None-Match`` header naming the current version and a
+    ``Prefer: wait=<seconds>`` header are long polls: the response is
+    delayed until the resource changes or the time is up, whichever is
+    sooner.
+
+    If ``cache_responses`` is true the body of the latest successful ``GET``
+    response without query arguments is kept, and sent in response to such
+    requests for the same version without calling the endpoint again.  This
+    is only suitable for endpoints without route arguments whose response
+    depends on nothing but the version of the resource and the query.
+    Streamed responses are not kept.
+
+    This should be applied outside ``structured``.
+
+    :param get_version: A one-argument callable which is passed the object
+        the endpoint is a method of and returns a ``unicode`` identifier for
+        the current version of the resource.  It must change whenever the
+        resource does.
+    :param wait_for_change: ``None``, or a two-argument callable which is
+        passed the object the endpoint is a method of and a number of
+        seconds, and returns a ``Deferred`` which fires with ``None`` once
+        the resource may have changed or the time is up.  Cancelling the
+        ``Deferred`` stops waiting.
+    :param bool cache_responses: Whether to reuse response bodies.
+    """
+    def deco(original):
+        # Mapping from the object the endpoint is a method of to the entity
+        # tag and body of its latest cached response:
+        cache = WeakKeyDictionary()
+
+        def respond(self, request, routeArguments):
+            etag = _etag(get_version(self))
+            request.setHeader(b"etag", etag)
+            if_none_match = request.getHeader(b"if-none-match")
+            if (request.method in (b"GET", b"HEAD") and
+                    if_none_match is not None and
+                    _etag_matches(if_none_match, etag, weak=True)):
+                request.setResponseCode(NOT_MODIFIED)
+                return b""
+            caching = (cache_responses and request.method == b"GET" and
+                       not request.args)
+            if caching:
+                cached = cache.get(self)
+                if cached is not None and cached[0] == etag:
+                    request.setHeader(b"content-type", b"application/json")
+                    return cached[1]
+            result = maybeDeferred(original, self, request, **routeArguments)
+            # Streamed responses may be written before they are finished, so
+            # the version is recorded both now and once they are finished,
+            # in case the endpoint makes changes asynchronously:
+            new_etag = _etag(get_version(self))
+            request.setHeader(b"etag", new_etag)
+
+            def finished(body):
+                request.setHeader(b"etag", _etag(get_version(self)))
+                return body
+            result.addCallback(finished)
+            if caching and new_etag == etag:
+                def store(body):
+                    # Streamed bodies have been written already rather than
+                    # returned, and are too long to keep anyway:
+                    if request.code == OK and body:
+                        cache[self] = (etag, body)
+                    return body
+                result.addCallback(store)
+            return result
+
+        @wraps(original)
+        def versioning(self, request, **routeArguments):
+            etag = _etag(get_version(self))
+            if_match = request.getHeader(b"if-match")
+            if if_match is not None and not _etag_matches(if_match, etag):
+                request.setHeader(b"etag", etag)
+                request.setResponseCode(PRECONDITION_FAILED)
+                request.setHeader(b"content-type", b"application/json")
+                return dumps({u"description":
+                              u"The resource has been modified."})
+            if_none_match = request.getHeader(b"if-none-match")
+            wait = _requested_wait(request)
+            # ``*`` matches every version, so waiting for it not to match
+            # would only delay the same I{NOT MODIFIED} response:
+            if (wait_for_change is not None and wait and
+                    request.method == b"GET" and
+                    if_none_match is not None and
+                    _etag_matches(if_none_match, etag, weak=True,
+                                  wildcard=False)):
+                waiting = wait_for_change(self, wait)
+                # Stop waiting if the client goes away:
+                request.notifyFinish().addErrback(
+                    lambda _: waiting.cancel())
+
+                def cancelled(reason):
+                    reason.trap(CancelledError)
+                    return b""
+                waiting.addCallbacks(
+                    lambda _: respond(self, request, routeArguments),
+                    cancelled)
+                return waiting
+            return respond(self, request, routeArguments)
+        return versioning
+    return deco
@@ -5,7 +5,9 @@ This module defines the Eliot log events emitted by the API implementation.
 """
 
 __all__ = [
+    "INPUT_VALIDATION",
     "JSON_REQUEST",
+    "OUTPUT_VALIDATION",
     "REQUEST",
     ]
 
@@ -21,6 +23,9 @@ REQUEST_PATH = Field(
 JSON = Field.forTypes(
     u"json", [unicode, bytes, dict, list, None, bool, float],
     u"JSON, either request or response depending on context.")
+ENDPOINT = Field.forTypes(
+    u"endpoint", [unicode],
+    u"The name of the method implementing an endpoint.")
 RESPONSE_CODE = Field.forTypes(
     u"code", [int],
     u"The response code for the request.")
@@ -38,3 +43,14 @@ JSON_REQUEST = ActionType(
     [JSON],
     [RESPONSE_CODE, JSON],
     u"A request containing JSON request and response bodies.")
+INPUT_VALIDATION = ActionType(
+    LOG_SYSTEM + u":input_validation",
+    [ENDPOINT],
+    [],
+    u"A request body or query was validated against the endpoint's input "
+    u"schema.")
+OUTPUT_VALIDATION = ActionType(
+    LOG_SYSTEM + u":output_validation",
+    [ENDPOINT],
+    [],
+    u"A response body was validated against the endpoint's output schema.")
@@ -14,6 +14,9 @@ __all__ = [
 ]
 
 import copy
+from collections import OrderedDict
+from hashlib import sha256
+from json import dumps
 
 from jsonschema.validators import RefResolver, validator_for
 from jsonschema import draft4_format_checker
@@ -33,24 +36,109 @@ class LocalRefResolver(RefResolver):
         raise SchemaNotProvided(uri)
 
 
+def _dereference(schema, resolver, resolving=()):
+    """
+    Replace the I{$ref} JSON references in a JSON Schema with the schema
+    they refer to.
+
+    Unlike L{resolveSchema} the schema store is left unchanged, and
+    recursive references are kept, made absolute so they can still be
+    resolved from anywhere.
+
+    @param schema: A part of a JSON Schema.
+    @param LocalRefResolver resolver: The resolver for references, in the
+        resolution scope of C{schema}.
+    @param tuple resolving: The absolute URIs of the references being
+        replaced by the enclosing parts of the schema.
+
+    @return: A copy of C{schema} without non-recursive references.
+    """
+    if isinstance(schema, list):
+        return [_dereference(item, resolver, resolving) for item in schema]
+    if not isinstance(schema, dict):
+        return schema
+    if u"$ref" not in schema:
+        return {key: _dereference(value, resolver, resolving)
+                for key, value in schema.items()}
+    with resolver.in_scope(schema[u"$ref"]):
+        uri = resolver.resolution_scope
+    if uri in resolving:
+        return {u"$ref": uri}
+    with resolver.resolving(schema[u"$ref"]) as resolved:
+        return _dereference(resolved, resolver, resolving + (uri,))
+
+
+# The maximum number of validators kept in ``_validators``:
+_VALIDATOR_CACHE_SIZE = 256
+
+# Mapping from the digest of a schema store and the canonical encoding of a
+# schema to a validator, least recently used first:
+_validators = OrderedDict()
+
+# The maximum number of schema stores kept in ``_store_digests``:
+_STORE_DIGEST_CACHE_SIZE = 16
+
+# Mapping from the identity of a schema store to the store, kept to stop its
+# identity being reused, and the digest of its canonical encoding, least
+# recently used first:
+_store_digests = OrderedDict()
+
+
+def _store_digest(schema_store):
+    """
+    Get the digest of the canonical encoding of a schema store, only
+    encoding stores which haven't been seen recently.
+
+    @param dict schema_store: A schema store, which must not be changed
+        once it has been used.
+
+    @return bytes: The digest.
+    """
+    entry = _store_digests.pop(id(schema_store), None)
+    if entry is None:
+        entry = (schema_store,
+                 sha256(dumps(schema_store, sort_keys=True)).digest())
+    _store_digests[id(schema_store)] = entry
+    while len(_store_digests) > _STORE_DIGEST_CACHE_SIZE:
+        _store_digests.popitem(last=False)
+    return entry[1]
+
+
 def getValidator(schema, schema_store):
     """
     Get a L{jsonschema} validator for C{schema}.
 
+    The references in C{schema} are replaced with the schemas they refer to
+    up front, rather than every time something is validated, and the most
+    recently used validators are shared by all callers asking for the same
+    schema from a store with the same contents.  Stores are only encoded
+    the first time they are seen, so a store must not be changed once it
+    has been used.
+
     @param schema: The JSON Schema to validate against.
     @type schema: L{dict}
 
     @param dict schema_store: A mapping between schema paths
         (e.g. ``b/v1/types.json``) and the JSON schema structure.
     """
+    key = (_store_digest(schema_store), dumps(schema, sort_keys=True))
+    validator = _validators.pop(key, None)
+    if validator is not None:
+        _validators[key] = validator
+        return validator
     # The base_uri here isn't correct for the schema,
     # but does give proper relative paths.
     resolver = LocalRefResolver(
         base_uri=b'',
         referrer=schema, store=schema_store)
     resolver.resolution_scope = b''
-    return validator_for(schema)(
-        schema, resolver=resolver, format_checker=draft4_format_checker)
+    validator = validator_for(schema)(
+        _dereference(schema, resolver), resolver=resolver,
+        format_checker=draft4_format_checker)
+    _validators[key] = validator
+    while len(_validators) > _VALIDATOR_CACHE_SIZE:
+        _validators.popitem(last=False)
+    return validator
 
 
 def resolveSchema(schema, schemaStore):
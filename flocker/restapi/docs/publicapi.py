@@ -170,6 +170,9 @@ def _introspectRoute(route, exampleByIdentifier, schema_store):
              properties of the schema.
       - C{'input_schema'} I{(optional)}:
              L{dict} including the verbatim input JSON Schema.
+      - C{'query_arguments'}:
+             L{bool} indicating whether the input is taken from the query
+             arguments of C{GET} requests.
       - C{'output'} I{(optional)}:
             see C{'input'}.
       - C{'output_schema'} I{(optional)}:
@@ -192,6 +195,7 @@ def _introspectRoute(route, exampleByIdentifier, schema_store):
     if inputSchema:
         result['input'] = _parseSchema(inputSchema, schema_store)
         result["input_schema"] = inputSchema
+    result['query_arguments'] = route.attributes.get('queryArguments', False)
 
     if outputSchema:
         result['output'] = _parseSchema(outputSchema, schema_store)
@@ -205,7 +209,7 @@ def _introspectRoute(route, exampleByIdentifier, schema_store):
     return result
 
 
-def _formatSchema(data, incoming):
+def _formatSchema(data, incoming, query=False):
     """
     Generate the rst associated to a JSON schema.
 
@@ -214,8 +218,12 @@ def _formatSchema(data, incoming):
     :param data: See L{inspectRoute}.
     :param bool incoming: If True, this is request parameter, otherwise
         this is response.
+    :param bool query: If True, the request parameters are query
+        arguments.
     """
-    if incoming:
+    if query:
+        param = "query"
+    elif incoming:
         param = "<json"
     else:
         param = ">json"
@@ -316,8 +324,11 @@ def _formatRouteBody(data, schema_store):
         yield line
 
     if 'input' in data:
-        for line in _formatActualSchema(data['input_schema'],
-                                        "+ Request JSON Schema",
+        if data['query_arguments']:
+            label = "+ Query Arguments JSON Schema"
+        else:
+            label = "+ Request JSON Schema"
+        for line in _formatActualSchema(data['input_schema'], label,
                                         schema_store):
             yield line
     if 'output' in data:
@@ -332,7 +343,8 @@ def _formatRouteBody(data, schema_store):
             yield line
 
     if 'input' in data:
-        for line in _formatSchema(data['input'], True):
+        for line in _formatSchema(data['input'], True,
+                                  data['query_arguments']):
             yield line
 
     if 'output' in data:
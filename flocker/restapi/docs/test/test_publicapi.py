@@ -244,6 +244,44 @@ class MakeRstTests(SynchronousTestCase):
             '',
             ])
 
+    def test_queryArguments(self):
+        """
+        The input schema of an endpoint which takes query arguments is
+        documented as describing query arguments.
+        """
+        app = Klein()
+
+        @app.route(b"/", methods=[b"GET"])
+        @structured(
+            inputSchema={'$ref': '/v0/test.json#/endpoint'},
+            outputSchema={},
+            schema_store=self.INPUT_SCHEMAS,
+            query_arguments=True,
+        )
+        def f():
+            """
+            Developer docs,
+            """
+
+        rest = list(makeRst(b"/prefix", app, None, self.INPUT_SCHEMAS))
+
+        self.assertEqual(
+            ('       :label: + Query Arguments JSON Schema' in rest,
+             rest[-11:]),
+            (True, [
+                '   :query string optional: TITLE',
+                '   ',
+                '      one',
+                '      two',
+                '      ',
+                '   :query string param: *(required)* TITLE',
+                '   ',
+                '      one',
+                '      two',
+                '      ',
+                '',
+            ]))
+
     INPUT_ARRAY_SCHEMAS = {
         b'/v0/test.json': {
             'endpoint': {
@@ -10,19 +10,25 @@ from eliot.testing import assertHasAction
 
 from twisted.python.constants import Names, NamedConstant
 from twisted.python.failure import Failure
-from twisted.internet.defer import succeed, fail
+from twisted.internet.defer import succeed, fail, Deferred
+from twisted.internet.task import Cooperator
 from twisted.web.http_headers import Headers
 from twisted.web.http import (
     BAD_REQUEST, INTERNAL_SERVER_ERROR, PAYMENT_REQUIRED, GONE,
-    NOT_ALLOWED, NOT_FOUND, OK)
+    NOT_ALLOWED, NOT_FOUND, OK, NOT_MODIFIED, PRECONDITION_FAILED,
+    REQUEST_ENTITY_TOO_LARGE)
 
 from twisted.trial.unittest import SynchronousTestCase
 
+from .. import _infrastructure
 from .._infrastructure import (
-    EndpointResponse, user_documentation, structured)
-from .._logging import REQUEST, JSON_REQUEST
+    EndpointResponse, user_documentation, structured, versioned,
+    OutputValidation, set_output_validation)
+from .._logging import (
+    REQUEST, JSON_REQUEST, INPUT_VALIDATION, OUTPUT_VALIDATION)
 from .._error import (
     ILLEGAL_CONTENT_TYPE_DESCRIPTION, DECODING_ERROR_DESCRIPTION,
+    QUERY_DECODING_ERROR_DESCRIPTION, REQUEST_TOO_LARGE_DESCRIPTION,
     BadRequest)
 
 
@@ -137,6 +143,28 @@ class ResultHandlingApplication(object):
         self.kwargs = kwargs
         return self._constructSuccess({})
 
+    @app.route(b"/foo/query")
+    @structured({
+        'type': 'object',
+        'properties': {'int': {'type': 'string', 'pattern': '^[0-9]+$'}},
+        'additionalProperties': False,
+    }, {}, query_arguments=True)
+    def query(self, **kwargs):
+        self.kwargs = kwargs
+        return self._constructSuccess(self.result)
+
+    @app.route(b"/foo/sampledbadresponse")
+    @structured({}, {'type': 'string'}, output_validation_rate=0.5)
+    def sampledBadResponse(self, **kwargs):
+        self.kwargs = kwargs
+        return self._constructSuccess({})
+
+    @app.route(b"/foo/limited")
+    @structured({}, {}, maximum_body_size=10)
+    def limited(self, **kwargs):
+        self.kwargs = kwargs
+        return self._constructSuccess(self.result)
+
 
 def assertJSONLogged(test, logger, method, path, request, response,
                      code):
@@ -485,6 +513,73 @@ class StructuredJSONTests(SynchronousTestCase):
              len(response[u'errors'])),
             (BAD_REQUEST, FAILED_INPUT_VALIDATION, 2))
 
+    @validateLogging(None)
+    def test_validationLogged(self, logger):
+        """
+        The request body is validated inside an L{INPUT_VALIDATION} action
+        naming the endpoint, which records how long validation took.
+        """
+        request = dummyRequest(
+            b"PUT", b"/foo/validation",
+            Headers({b"content-type": [b"application/json"]}),
+            dumps({u'abc': 1, u'int': 1}))
+        app = self.Application(logger, None)
+        render(app.app.resource(), request)
+        assertHasAction(
+            self, logger, INPUT_VALIDATION, True,
+            {u"endpoint": u"validation"})
+
+    @validateLogging(_assertRequestLogged(b"/foo/query"))
+    def test_queryArguments(self, logger):
+        """
+        If the endpoint takes query arguments they are decoded and passed as
+        keyword arguments to the decorated function.
+        """
+        request = dummyRequest(b"GET", b"/foo/query?int=12", Headers(), b"")
+        app = self.Application(logger, {})
+        render(app.app.resource(), request)
+        self.assertEqual({"int": u"12"}, app.kwargs)
+
+    @validateLogging(_assertRequestLogged(b"/foo/query"))
+    def test_queryValidationError(self, logger):
+        """
+        If the query arguments don't match the provided schema, then the
+        request automatically receives a I{BAD REQUEST} response.
+        """
+        request = dummyRequest(
+            b"GET", b"/foo/query?int=twelve&junk=1", Headers(), b"")
+        app = self.Application(logger, {})
+        render(app.app.resource(), request)
+        response = loads(request._responseBody)
+        self.assertEqual(
+            (request._code, response[u'description'],
+             len(response[u'errors']), app.kwargs),
+            (BAD_REQUEST, FAILED_INPUT_VALIDATION, 2, None))
+
+    @validateLogging(_assertRequestLogged(b"/foo/query"))
+    def test_queryDecodingError(self, logger):
+        """
+        If the query arguments aren't UTF-8 then the request automatically
+        receives a I{BAD REQUEST} response.
+        """
+        request = dummyRequest(b"GET", b"/foo/query?int=%FF", Headers(), b"")
+        app = self.Application(logger, {})
+        render(app.app.resource(), request)
+        self.assertEqual(
+            (request._code, loads(request._responseBody)),
+            (BAD_REQUEST,
+             {u"description": QUERY_DECODING_ERROR_DESCRIPTION}))
+
+    @validateLogging(_assertRequestLogged(b"/foo/bar"))
+    def test_queryIgnored(self, logger):
+        """
+        Query arguments are ignored by endpoints which don't take them.
+        """
+        request = dummyRequest(b"GET", b"/foo/bar?int=12", Headers(), b"")
+        app = self.Application(logger, {})
+        render(app.app.resource(), request)
+        self.assertEqual((request._code, app.kwargs), (OK, {}))
+
     @validateLogging(_assertTracebackLogged(ValidationError))
     # See above
     # @validateLogging(_assertRequestLogged(b"/foo/badresponse"))
@@ -502,6 +597,38 @@ class StructuredJSONTests(SynchronousTestCase):
 
         self.assertEqual(request._code, INTERNAL_SERVER_ERROR)
 
+    @validateLogging(_assertRequestLogged(b"/foo/limited", b"PUT"))
+    def test_maximumBodySize(self, logger):
+        """
+        A request body no larger than C{maximum_body_size} is decoded and
+        passed to the decorated function.
+        """
+        request = dummyRequest(
+            b"PUT", b"/foo/limited",
+            Headers({b"content-type": [b"application/json"]}),
+            dumps({u"a": 1}))
+        app = self.Application(logger, None)
+        render(app.app.resource(), request)
+        self.assertEqual((request._code, app.kwargs), (OK, {u"a": 1}))
+
+    @validateLogging(_assertRequestLogged(b"/foo/limited", b"PUT"))
+    def test_bodyTooLarge(self, logger):
+        """
+        A request body larger than C{maximum_body_size} gets a I{REQUEST
+        ENTITY TOO LARGE} response without the decorated function being
+        called.
+        """
+        request = dummyRequest(
+            b"PUT", b"/foo/limited",
+            Headers({b"content-type": [b"application/json"]}),
+            dumps({u"abc": 12}))
+        app = self.Application(logger, None)
+        render(app.app.resource(), request)
+        self.assertEqual(
+            (request._code, loads(request._responseBody), app.kwargs),
+            (REQUEST_ENTITY_TOO_LARGE,
+             {u"description": REQUEST_TOO_LARGE_DESCRIPTION}, None))
+
     @validateLogging(_assertRequestLogged(b"/foo/bar", b"PUT"))
     def test_wrongContentTypeRequest(self, logger):
         """
@@ -553,6 +680,73 @@ class StructuredJSONTests(SynchronousTestCase):
             {"jsonValue": True, "routingValue": "quux"}, app.kwargs)
 
 
+class OutputValidationTests(SynchronousTestCase):
+    """
+    Tests for L{set_output_validation} and the C{output_validation_rate}
+    of L{structured}.
+    """
+    def setUp(self):
+        self.addCleanup(set_output_validation, OutputValidation.ALWAYS)
+
+    def render(self, logger, path):
+        """
+        Render a C{GET} request.
+
+        @param logger: The logger the application logs to.
+        @param bytes path: The path of the request.
+
+        @return: The rendered request.
+        """
+        request = dummyRequest(b"GET", path, Headers(), b"")
+        app = ResultHandlingApplication(Execution.SYNCHRONOUS, logger, {})
+        render(app.app.resource(), request)
+        return request
+
+    @validateLogging(None)
+    def test_always(self, logger):
+        """
+        By default each response is validated inside an
+        L{OUTPUT_VALIDATION} action naming the endpoint, which records how
+        long validation took.
+        """
+        self.render(logger, b"/foo/bar")
+        assertHasAction(
+            self, logger, OUTPUT_VALIDATION, True, {u"endpoint": u"foo"})
+
+    @validateLogging(None)
+    def test_never(self, logger):
+        """
+        With L{OutputValidation.NEVER} responses are not validated.
+        """
+        set_output_validation(OutputValidation.NEVER)
+        request = self.render(logger, b"/foo/badresponse")
+        self.assertEqual(
+            (request._code,
+             LoggedAction.ofType(logger.messages, OUTPUT_VALIDATION)),
+            (OK, []))
+
+    def test_sampled_skipped(self):
+        """
+        With L{OutputValidation.SAMPLED} a response is not validated if the
+        random sample falls outside the endpoint's rate.
+        """
+        set_output_validation(OutputValidation.SAMPLED)
+        self.patch(_infrastructure, "random", lambda: 0.6)
+        request = self.render(None, b"/foo/sampledbadresponse")
+        self.assertEqual(request._code, OK)
+
+    @validateLogging(_assertTracebackLogged(ValidationError))
+    def test_sampled(self, logger):
+        """
+        With L{OutputValidation.SAMPLED} a response is validated if the
+        random sample falls within the endpoint's rate.
+        """
+        set_output_validation(OutputValidation.SAMPLED)
+        self.patch(_infrastructure, "random", lambda: 0.4)
+        request = self.render(logger, b"/foo/sampledbadresponse")
+        self.assertEqual(request._code, INTERNAL_SERVER_ERROR)
+
+
 class UserDocumentationTests(SynchronousTestCase):
     """
     Tests for L{user_documentation}.
@@ -570,6 +764,510 @@ class UserDocumentationTests(SynchronousTestCase):
         self.assertEqual(f.userDocumentation, "Some text")
 
 
+class VersionedTests(SynchronousTestCase):
+    """
+    Tests for L{versioned}.
+    """
+    class Application(object):
+        app = Klein()
+
+        def __init__(self):
+            self.version = 1
+            self.calls = 0
+
+        @app.route(b"/foo", methods={b"GET", b"POST"})
+        @versioned(lambda application: u"v%d" % (application.version,))
+        @user_documentation("Some text")
+        @structured({}, {})
+        def foo(self):
+            self.calls += 1
+            self.version += 1
+            return {}
+
+        @app.route(b"/later", methods={b"POST"})
+        @versioned(lambda application: u"v%d" % (application.version,))
+        @structured({}, {})
+        def later(self):
+            self.changing = Deferred()
+            return self.changing
+
+    def request(self, app, method, headers):
+        """
+        Render a request.
+
+        @param app: The L{Application} to request from.
+        @param bytes method: The HTTP method of the request.
+        @param dict headers: Mapping of header names to a single value.
+
+        @return: The rendered request.
+        """
+        request = dummyRequest(
+            method, b"/foo",
+            Headers({name: [value] for name, value in headers.items()}),
+            dumps({}))
+        if method != b"GET":
+            request.requestHeaders.setRawHeaders(
+                b"content-type", [b"application/json"])
+        render(app.app.resource(), request)
+        return request
+
+    def test_etag(self):
+        """
+        The response has an C{ETag} header identifying the version of the
+        resource after the request.
+        """
+        request = self.request(self.Application(), b"GET", {})
+        self.assertEqual(
+            (request._code, request.responseHeaders.getRawHeaders(b"etag")),
+            (OK, [b'"v2"']))
+
+    def test_not_modified(self):
+        """
+        A C{GET} request with a matching C{If-None-Match} header gets a
+        I{NOT MODIFIED} response without calling the endpoint.
+        """
+        app = self.Application()
+        request = self.request(
+            app, b"GET", {b"if-none-match": b'"v0", W/"v1"'})
+        self.assertEqual(
+            (request._code, request._responseBody, app.calls),
+            (NOT_MODIFIED, b"", 0))
+
+    def test_modified(self):
+        """
+        A C{GET} request with a C{If-None-Match} header which doesn't match
+        calls the endpoint.
+        """
+        app = self.Application()
+        request = self.request(app, b"GET", {b"if-none-match": b'"v0"'})
+        self.assertEqual((request._code, app.calls), (OK, 1))
+
+    def test_if_match(self):
+        """
+        A request with a matching C{If-Match} header calls the endpoint.
+        """
+        app = self.Application()
+        request = self.request(app, b"POST", {b"if-match": b'"v1"'})
+        self.assertEqual((request._code, app.calls), (OK, 1))
+
+    def test_if_match_failed(self):
+        """
+        A request with a C{If-Match} header which doesn't match gets a
+        I{PRECONDITION FAILED} response without calling the endpoint.
+        """
+        app = self.Application()
+        request = self.request(app, b"POST", {b"if-match": b'"v0"'})
+        self.assertEqual(
+            (request._code, loads(request._responseBody), app.calls),
+            (PRECONDITION_FAILED,
+             {u"description": u"The resource has been modified."}, 0))
+
+    def test_if_match_weak(self):
+        """
+        A weak entity tag in an C{If-Match} header doesn't match, since
+        C{If-Match} uses strong comparison.
+        """
+        app = self.Application()
+        request = self.request(app, b"POST", {b"if-match": b'W/"v1"'})
+        self.assertEqual((request._code, app.calls), (PRECONDITION_FAILED, 0))
+
+    def test_asynchronous_change(self):
+        """
+        The C{ETag} header identifies the version after changes the endpoint
+        makes before its result is ready.
+        """
+        app = self.Application()
+        request = dummyRequest(
+            b"POST", b"/later",
+            Headers({b"content-type": [b"application/json"]}), dumps({}))
+        render(app.app.resource(), request)
+        app.version = 3
+        app.changing.callback({})
+        self.assertEqual(
+            (request._code, request.responseHeaders.getRawHeaders(b"etag")),
+            (OK, [b'"v3"']))
+
+    def test_documentation(self):
+        """
+        The decorated endpoint keeps the attributes used to document it.
+        """
+        self.assertEqual(
+            (self.Application.foo.userDocumentation,
+             self.Application.foo.inputSchema),
+            ("Some text", {}))
+
+
+class VersionedWaitTests(SynchronousTestCase):
+    """
+    Tests for long polls using L{versioned}.
+    """
+    class Application(object):
+        app = Klein()
+
+        def __init__(self):
+            self.version = 1
+            self.waits = []
+            self.cancelled = []
+
+        def wait(self, timeout):
+            waiting = Deferred(canceller=self.cancelled.append)
+            self.waits.append((timeout, waiting))
+            return waiting
+
+        @app.route(b"/foo", methods={b"GET"})
+        @versioned(lambda application: u"v%d" % (application.version,),
+                   lambda application, timeout: application.wait(timeout))
+        @structured({}, {})
+        def foo(self):
+            return {u"version": self.version}
+
+    def request(self, app, headers):
+        """
+        Start rendering a C{GET} request.
+
+        @param app: The L{Application} to request from.
+        @param dict headers: Mapping of header names to a single value.
+
+        @return: The request.
+        """
+        request = dummyRequest(
+            b"GET", b"/foo",
+            Headers({name: [value] for name, value in headers.items()}))
+        render(app.app.resource(), request)
+        return request
+
+    def test_wait(self):
+        """
+        A C{GET} request with a matching C{If-None-Match} header and a
+        C{Prefer: wait} header waits for the given number of seconds.
+        """
+        app = self.Application()
+        request = self.request(
+            app, {b"if-none-match": b'"v1"', b"prefer": b"wait=10"})
+        self.assertEqual(
+            ([timeout for timeout, _ in app.waits], request._finished),
+            ([10], False))
+
+    def test_changed(self):
+        """
+        If the resource has changed once the wait is over, the response has
+        the new version of the resource.
+        """
+        app = self.Application()
+        request = self.request(
+            app, {b"if-none-match": b'"v1"', b"prefer": b"wait=10"})
+        app.version = 2
+        app.waits[0][1].callback(None)
+        self.assertEqual(
+            (request._code, loads(request._responseBody),
+             request.responseHeaders.getRawHeaders(b"etag")),
+            (OK, {u"version": 2}, [b'"v2"']))
+
+    def test_unchanged(self):
+        """
+        If the resource hasn't changed once the wait is over, the response
+        is I{NOT MODIFIED}.
+        """
+        app = self.Application()
+        request = self.request(
+            app, {b"if-none-match": b'"v1"', b"prefer": b"wait=10"})
+        app.waits[0][1].callback(None)
+        self.assertEqual((request._finished, request._code),
+                         (True, NOT_MODIFIED))
+
+    def test_no_wait_if_modified(self):
+        """
+        If the C{If-None-Match} header doesn't match the response is sent
+        without waiting.
+        """
+        app = self.Application()
+        request = self.request(
+            app, {b"if-none-match": b'"v0"', b"prefer": b"wait=10"})
+        self.assertEqual((request._code, app.waits), (OK, []))
+
+    def test_no_wait_for_wildcard(self):
+        """
+        C{If-None-Match: *} matches every version of the resource, so the
+        I{NOT MODIFIED} response is sent without waiting.
+        """
+        app = self.Application()
+        request = self.request(
+            app, {b"if-none-match": b"*", b"prefer": b"wait=10"})
+        self.assertEqual((request._finished, request._code, app.waits),
+                         (True, NOT_MODIFIED, []))
+
+    def test_no_wait_without_preference(self):
+        """
+        Without a C{Prefer: wait} header the response is sent without
+        waiting.
+        """
+        app = self.Application()
+        request = self.request(app, {b"if-none-match": b'"v1"'})
+        self.assertEqual((request._code, app.waits), (NOT_MODIFIED, []))
+
+    def test_maximum_wait(self):
+        """
+        Requests can't wait longer than five minutes.
+        """
+        app = self.Application()
+        self.request(app, {b"if-none-match": b'"v1"',
+                           b"prefer": b"return=minimal; wait=3600"})
+        self.assertEqual([timeout for timeout, _ in app.waits], [300])
+
+    def test_disconnect(self):
+        """
+        If the client disconnects the wait is cancelled.
+        """
+        app = self.Application()
+        request = dummyRequest(
+            b"GET", b"/foo",
+            Headers({b"if-none-match": [b'"v1"'], b"prefer": [b"wait=10"]}))
+        rendering = render(app.app.resource(), request)
+        request._finishedChannel.errback(Failure(ArbitraryException()))
+        self.failureResultOf(rendering, ArbitraryException)
+        self.assertEqual(app.cancelled, [app.waits[0][1]])
+
+
+class VersionedCacheTests(SynchronousTestCase):
+    """
+    Tests for L{versioned} with C{cache_responses}.
+    """
+    class Application(object):
+        app = Klein()
+
+        def __init__(self):
+            self.version = 1
+            self.calls = 0
+            self.fail = False
+
+        @app.route(b"/foo", methods={b"GET", b"POST"})
+        @versioned(lambda application: u"v%d" % (application.version,),
+                   cache_responses=True)
+        @structured({}, {})
+        def foo(self):
+            self.calls += 1
+            if self.fail:
+                raise BadRequest(BAD_REQUEST, {u"calls": self.calls})
+            return {u"version": self.version}
+
+    def request(self, app, method=b"GET"):
+        """
+        Render a request.
+
+        @param app: The L{Application} to request from.
+        @param bytes method: The HTTP method of the request.
+
+        @return: The rendered request.
+        """
+        request = dummyRequest(method, b"/foo", Headers(), dumps({}))
+        if method != b"GET":
+            request.requestHeaders.setRawHeaders(
+                b"content-type", [b"application/json"])
+        render(app.app.resource(), request)
+        return request
+
+    def test_cached(self):
+        """
+        A second C{GET} request for the same version gets the same response
+        without calling the endpoint again.
+        """
+        app = self.Application()
+        first = self.request(app)
+        second = self.request(app)
+        self.assertEqual(
+            (second._code, second._responseBody,
+             second.responseHeaders.getRawHeaders(b"content-type"),
+             second.responseHeaders.getRawHeaders(b"etag"), app.calls),
+            (OK, first._responseBody, [b"application/json"], [b'"v1"'], 1))
+
+    def test_new_version(self):
+        """
+        A C{GET} request after the version has changed calls the endpoint.
+        """
+        app = self.Application()
+        self.request(app)
+        app.version = 2
+        request = self.request(app)
+        self.assertEqual(
+            (loads(request._responseBody), app.calls),
+            ({u"version": 2}, 2))
+
+    def test_other_methods_not_cached(self):
+        """
+        Requests other than C{GET} always call the endpoint.
+        """
+        app = self.Application()
+        self.request(app)
+        self.request(app, b"POST")
+        self.assertEqual(app.calls, 2)
+
+    def test_errors_not_cached(self):
+        """
+        Unsuccessful responses are not cached.
+        """
+        app = self.Application()
+        app.fail = True
+        self.request(app)
+        request = self.request(app)
+        self.assertEqual(
+            (request._code, loads(request._responseBody), app.calls),
+            (BAD_REQUEST, {u"calls": 2}, 2))
+
+
+class StreamedOutputTests(SynchronousTestCase):
+    """
+    Tests for the C{stream_output} option of L{structured}.
+    """
+    class Application(object):
+        app = Klein()
+
+        def __init__(self, count):
+            self.items = range(count)
+            self.calls = 0
+
+        @app.route(b"/foo", methods={b"GET"})
+        @versioned(lambda application: u"v1", cache_responses=True)
+        @structured({}, {u"type": u"array", u"items": {u"type": u"integer"}},
+                    stream_output=True)
+        def foo(self):
+            self.calls += 1
+            return iter(self.items)
+
+    def setUp(self):
+        # One iteration of a task per step, with the steps run by hand
+        # rather than by a Clock, which would run work scheduled by other
+        # work in the same advance:
+        self.scheduled = []
+        cooperator = Cooperator(
+            terminationPredicateFactory=lambda: lambda: True,
+            scheduler=self.scheduled.append)
+        self.patch(_infrastructure, "_cooperate", cooperator.cooperate)
+        self.patch(_infrastructure, "_STREAM_THRESHOLD", 2)
+        self.patch(_infrastructure, "_STREAM_CHUNK_SIZE", 2)
+
+    def step(self):
+        """
+        Run the work scheduled by the cooperator so far.
+        """
+        scheduled = self.scheduled[:]
+        del self.scheduled[:]
+        for work in scheduled:
+            work()
+
+    def run_all(self):
+        """
+        Step the cooperator until it has no more work.
+        """
+        while self.scheduled:
+            self.step()
+
+    def request(self, app):
+        """
+        Start rendering a C{GET} request.
+
+        @param app: The L{Application} to request from.
+
+        @return: A tuple of the request and the L{Deferred} returned by
+            L{render}.
+        """
+        request = dummyRequest(b"GET", b"/foo", Headers(), b"")
+        return request, render(app.app.resource(), request)
+
+    def test_short(self):
+        """
+        Results of up to C{_STREAM_THRESHOLD} items are written at once, and
+        are cached like any other.
+        """
+        app = self.Application(2)
+        self.request(app)
+        request, rendering = self.request(app)
+        self.successResultOf(rendering)
+        self.assertEqual(
+            (loads(request._responseBody), app.calls), ([0, 1], 1))
+
+    def test_chunks(self):
+        """
+        Longer results are written C{_STREAM_CHUNK_SIZE} items at a time,
+        giving other work a chance to run between chunks.
+        """
+        app = self.Application(5)
+        request, rendering = self.request(app)
+        bodies = []
+        while not request._finished:
+            self.step()
+            bodies.append(request._responseBody)
+        self.successResultOf(rendering)
+        self.assertEqual(
+            (bodies[:3], loads(request._responseBody), request._code,
+             request.responseHeaders.getRawHeaders(b"content-type")),
+            ([b"[0,1", b"[0,1,2,3", b"[0,1,2,3,4"], [0, 1, 2, 3, 4], OK,
+             [b"application/json"]))
+
+    def test_empty_chunks(self):
+        """
+        A streamed result that ends on a chunk boundary is still a valid
+        JSON array.
+        """
+        app = self.Application(4)
+        request, rendering = self.request(app)
+        self.run_all()
+        self.successResultOf(rendering)
+        self.assertEqual(loads(request._responseBody), [0, 1, 2, 3])
+
+    def test_not_cached(self):
+        """
+        Streamed results are not cached.
+        """
+        app = self.Application(5)
+        for i in range(2):
+            request, rendering = self.request(app)
+            self.run_all()
+        self.assertEqual(
+            (loads(request._responseBody), app.calls), (range(5), 2))
+
+    @validateLogging(None)
+    def test_validated(self, logger):
+        """
+        Each chunk of a streamed result is validated separately.
+        """
+        app = self.Application(5)
+        app.logger = logger
+        request, rendering = self.request(app)
+        self.run_all()
+        self.assertEqual(
+            len(LoggedAction.ofType(logger.messages, OUTPUT_VALIDATION)), 3)
+
+    def test_disconnect(self):
+        """
+        If the client goes away no more of a streamed result is written.
+        """
+        app = self.Application(5)
+        request, rendering = self.request(app)
+        self.step()
+        request._finishedChannel.errback(Failure(ArbitraryException()))
+        self.run_all()
+        self.failureResultOf(rendering, ArbitraryException)
+        self.assertEqual(request._responseBody, b"[0,1")
+
+    @validateLogging(None)
+    def test_invalid_chunk(self, logger):
+        """
+        If a chunk after the first is invalid the failure is logged and the
+        connection is aborted, leaving the partial array unterminated
+        rather than appending an error to it.
+        """
+        app = self.Application(5)
+        app.logger = logger
+        app.items[2] = u"two"
+        request, rendering = self.request(app)
+        self.run_all()
+        self.successResultOf(rendering)
+        self.assertEqual(
+            (request._responseBody, request.transport.aborted,
+             len(logger.flushTracebacks(ValidationError))),
+            (b"[0,1", True, 1))
+
+
 class NotAllowedTests(SynchronousTestCase):
     """
     Tests for the HTTP method restriction functionality imposed by the routing
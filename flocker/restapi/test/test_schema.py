@@ -4,11 +4,13 @@ Tests for ``flocker.restapi._schema``.
 """
 
 import copy
+from collections import OrderedDict
 
 from twisted.trial.unittest import SynchronousTestCase
 
 from jsonschema.exceptions import RefResolutionError, ValidationError
 
+from .. import _schema
 from .._schema import (
     LocalRefResolver, SchemaNotProvided, getValidator, resolveSchema)
 
@@ -64,6 +66,93 @@ class GetValidatorTests(SynchronousTestCase):
                                  {'schema.json': {'type': 'string'}})
         self.assertRaises(ValidationError, validator.validate, {})
 
+    def test_shared(self):
+        """
+        L{getValidator} returns the same validator when asked for the same
+        schema from the same store again.
+        """
+        store = {'schema.json': {'type': 'string'}}
+        self.assertIs(getValidator({u'$ref': u'schema.json'}, store),
+                      getValidator({u'$ref': u'schema.json'}, store))
+
+    def test_otherStore(self):
+        """
+        L{getValidator} does not share validators between schema stores.
+        """
+        validator = getValidator({u'$ref': u'schema.json'},
+                                 {'schema.json': {'type': 'string'}})
+        other = getValidator({u'$ref': u'schema.json'},
+                             {'schema.json': {'type': 'integer'}})
+        self.assertEqual(
+            (list(validator.iter_errors(u"abc")),
+             len(list(other.iter_errors(u"abc")))),
+            ([], 1))
+
+    def test_storeEncodedOnce(self):
+        """
+        L{getValidator} only encodes a schema store the first time it is
+        used, so validators are shared cheaply.
+        """
+        store = {'schema.json': {'type': 'string'}}
+        getValidator({u'$ref': u'schema.json'}, store)
+        encoded = []
+        original_dumps = _schema.dumps
+
+        def dumps(obj, **kwargs):
+            encoded.append(obj)
+            return original_dumps(obj, **kwargs)
+        self.patch(_schema, "dumps", dumps)
+        getValidator({u'type': u'integer'}, store)
+        getValidator({u'$ref': u'schema.json'}, store)
+        self.assertNotIn(store, encoded)
+
+    def test_bounded(self):
+        """
+        L{getValidator} only keeps the most recently used
+        C{_VALIDATOR_CACHE_SIZE} validators.
+        """
+        self.patch(_schema, "_VALIDATOR_CACHE_SIZE", 2)
+        self.patch(_schema, "_validators", OrderedDict())
+        store = {}
+        first = getValidator({u'type': u'string'}, store)
+        getValidator({u'type': u'integer'}, store)
+        self.assertIs(getValidator({u'type': u'string'}, store), first)
+        getValidator({u'type': u'boolean'}, store)
+        self.assertEqual(
+            (len(_schema._validators),
+             getValidator({u'type': u'string'}, store) is first),
+            (2, True))
+
+    def test_dereferenced(self):
+        """
+        The schema of the validator returned by L{getValidator} has the
+        references replaced by the schemas they refer to, including
+        references relative to other documents, without changing the store.
+        """
+        store = {b'/v1/types.json': {'string': {'type': 'string'}},
+                 b'/v1/endpoints.json': {
+                     'array': {'type': 'array',
+                               'items': {'$ref': 'types.json#/string'}}}}
+        original = copy.deepcopy(store)
+        validator = getValidator({u'$ref': u'/v1/endpoints.json#/array'},
+                                 store)
+        self.assertEqual(
+            (validator.schema, store),
+            ({'type': 'array', 'items': {'type': 'string'}}, original))
+
+    def test_recursive(self):
+        """
+        Recursive references are kept, and still resolved when validating.
+        """
+        store = {b'/v1/types.json': {
+            'tree': {'type': 'object',
+                     'properties': {'children': {
+                         'type': 'array', 'items': {'$ref': '#/tree'}}}}}}
+        validator = getValidator({u'$ref': u'/v1/types.json#/tree'}, store)
+        validator.validate({'children': [{'children': []}]})
+        self.assertRaises(ValidationError, validator.validate,
+                          {'children': [{'children': 1}]})
+
 
 class ResolveSchemaTests(SynchronousTestCase):
     """
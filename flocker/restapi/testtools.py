@@ -263,6 +263,20 @@ class EventChannel(object):
         return d
 
 
+class _AbortableStringTransport(StringTransport):
+    """
+    A L{StringTransport} which can also be aborted, like a TCP or TLS
+    transport.
+
+    @ivar aborted: Whether C{abortConnection} has been called.
+    """
+    aborted = False
+
+    def abortConnection(self):
+        self.aborted = True
+        self.loseConnection()
+
+
 class _DummyRequest(Request):
 
     # Request has code and code_message attributes.  They're not part of
@@ -283,7 +297,7 @@ class _DummyRequest(Request):
 
         channel = HTTPChannel()
         host = IPv4Address(b"TCP", b"127.0.0.1", 80)
-        channel.makeConnection(StringTransport(hostAddress=host))
+        channel.makeConnection(_AbortableStringTransport(hostAddress=host))
 
         Request.__init__(self, channel, False)
 